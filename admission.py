@@ -0,0 +1,119 @@
+""" Admission control of searches, so that each datacenter gets at most
+a fixed number of concurrent searches from this process.
+
+Searches beyond the limit wait in a bounded queue.  Waiting searches are
+started by priority, polls of live tails first, and round-robin over the
+users within a priority, so that one user opening many heavy queries
+does not starve the others. """
+
+import asyncio
+import collections
+import time
+
+TAIL, INTERACTIVE, HEAVY = 0, 1, 2
+PRIORITY_NAMES = ["tail", "interactive", "heavy"]
+
+
+class Overloaded(Exception):
+    """ Raised if a search cannot be queued because the queue is full. """
+
+
+class Limiter:
+    """ Limits the concurrent searches to one datacenter. """
+
+    def __init__(self, max_concurrent, max_queued):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.active = 0
+        # futures of waiting searches, by priority and then by user, in
+        # the order the users are served
+        self.waiting = [collections.OrderedDict() for _ in PRIORITY_NAMES]
+        self.num_waiting = 0
+
+    async def acquire(self, user, priority):
+        """ Waits until a search of user may start, returns how long it waited in seconds.
+
+        Raises Overloaded if the queue is full.  Every successful call must
+        be followed by release() once the search is done. """
+
+        if self.active < self.max_concurrent and self.num_waiting == 0:
+            self.active += 1
+            return 0.0
+        if self.num_waiting >= self.max_queued:
+            raise Overloaded(f"{self.num_waiting} searches are queued already, at most {self.max_concurrent} "
+                             "run concurrently")
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[priority].setdefault(user, collections.deque()).append(future)
+        self.num_waiting += 1
+        start = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._remove(priority, user, future)
+            else:
+                # the slot was handed over already, pass it on
+                self.release()
+            raise
+        return time.monotonic() - start
+
+    def release(self):
+        """ Hands the slot of a finished search to the next waiting one. """
+
+        # after the limit was lowered, slots are given up until it is reached
+        future = self._next() if self.active <= self.max_concurrent else None
+        if future is None:
+            self.active -= 1
+        else:
+            future.set_result(None)
+
+    def resize(self, max_concurrent, max_queued):
+        """ Changes the limits, e.g. after the config was reloaded. """
+
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        while self.active < self.max_concurrent:
+            future = self._next()
+            if future is None:
+                break
+            self.active += 1
+            future.set_result(None)
+
+    def _next(self):
+        for by_user in self.waiting:
+            while by_user:
+                user, futures = next(iter(by_user.items()))
+                future = futures.popleft()
+                if futures:
+                    by_user.move_to_end(user)
+                else:
+                    del by_user[user]
+                self.num_waiting -= 1
+                if not future.done():
+                    return future
+        return None
+
+    def _remove(self, priority, user, future):
+        futures = self.waiting[priority].get(user)
+        if futures is None or future not in futures:
+            return
+        futures.remove(future)
+        if not futures:
+            del self.waiting[priority][user]
+        self.num_waiting -= 1
+
+
+# limiters by datacenter
+LIMITERS = {}
+
+
+def limiter(datacenter, max_concurrent, max_queued):
+    """ Returns the limiter of datacenter, with the given limits. """
+
+    lim = LIMITERS.get(datacenter)
+    if lim is None:
+        lim = LIMITERS[datacenter] = Limiter(max_concurrent, max_queued)
+    elif (lim.max_concurrent, lim.max_queued) != (max_concurrent, max_queued):
+        lim.resize(max_concurrent, max_queued)
+    return lim
@@ -0,0 +1,307 @@
+""" A fake elasticsearch for benchmarks, serving synthetic log documents.
+
+Documents are not stored, they are generated from their position in
+time: there are docs_per_second documents per second, up to now, so that
+live tails see new documents arriving at that rate.  Only the parts of
+the search api that es-stream-logs uses are supported, i.e. `_search`
+and `_msearch` with a time range, sorting by @timestamp, date_histogram
+aggregations with terms and percentiles sub-aggregations (also within a
+random_sampler, which does not sample but passes the counts on), point in time
+ids, `_field_caps` and getting documents by id. """
+
+import argparse
+import asyncio
+from datetime import datetime, timezone
+import json
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+from query import parse_offset, parse_timestamp
+
+LEVELS = ["INFO", "INFO", "INFO", "WARN", "ERROR"]
+MAX_TOTAL_HITS = 10_000
+
+WORDS = ["request", "user", "timeout", "order", "payment", "cache", "retry", "shipping", "queue", "session"]
+
+
+class FakeLogs:
+    """ Generates log documents, document i has timestamp i / docs_per_second. """
+
+    def __init__(self, docs_per_second=10, num_fields=10, field_size=20, seed=0):
+        self.docs_per_second = docs_per_second
+        self.num_fields = num_fields
+        self.field_size = field_size
+        self.seed = seed
+
+    def index_at(self, timestamp_ms):
+        """ Returns the index of the first document at or after timestamp_ms. """
+        return -(-int(timestamp_ms) * self.docs_per_second // 1000)
+
+    def now_index(self):
+        return self.index_at(time.time() * 1000)
+
+    def timestamp_ms(self, idx):
+        return idx * 1000 // self.docs_per_second
+
+    def document(self, idx):
+        rnd = random.Random(self.seed * 1_000_003 + idx)
+        timestamp = datetime.fromtimestamp(self.timestamp_ms(idx) / 1000, tz=timezone.utc)
+        doc = {
+            "@timestamp": timestamp.strftime("%Y-%m-%dT%H:%M:%S.") + f"{timestamp.microsecond // 1000:03d}Z",
+            "level": LEVELS[idx % len(LEVELS)],
+            "message": " ".join(rnd.choice(WORDS) for _ in range(max(1, self.field_size // 6))),
+            "status": {"code": rnd.choice([200, 200, 200, 404, 500])},
+            "timings": {"duration": rnd.randint(1, 5000)},
+        }
+        for field in range(self.num_fields):
+            doc[f"field_{field}"] = "".join(rnd.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(self.field_size))
+        return doc
+
+    def hit(self, index, idx):
+        return {"_index": index, "_id": f"doc-{idx}", "_score": None, "_source": self.document(idx),
+                "sort": [self.timestamp_ms(idx)]}
+
+
+def _time_range(query):
+    """ Returns the @timestamp range of query as (from_ms, to_ms), without bounds for missing ones. """
+
+    from_ms, to_ms = float("-inf"), float("inf")
+    filters = query.get("bool", {}).get("filter", [])
+    for clause in filters if isinstance(filters, list) else [filters]:
+        timerange = clause.get("range", {}).get("@timestamp")
+        if not timerange:
+            continue
+        for op, value in timerange.items():
+            value_ms = parse_timestamp(str(value)) * 1000
+            if op in ("gte", "gt"):
+                from_ms = max(from_ms, value_ms + (op == "gt"))
+            elif op in ("lt", "lte"):
+                to_ms = min(to_ms, value_ms + (op == "lte"))
+    return from_ms, to_ms
+
+
+class FakeElasticsearch:
+    """ The aiohttp application of the fake elasticsearch, with counters of the requests. """
+
+    def __init__(self, logs: FakeLogs, latency_s=0.0):
+        self.logs = logs
+        self.latency_s = latency_s
+        self.requests = 0
+        self.searches = 0
+        self.pits = {}
+
+        self.app = web.Application(client_max_size=16 * 1024 * 1024)
+        self.app.router.add_get("/", self.info)
+        self.app.router.add_route("*", "/_search", self.search)
+        self.app.router.add_route("*", "/{index}/_search", self.search)
+        self.app.router.add_route("*", "/_msearch", self.msearch)
+        self.app.router.add_route("*", "/{index}/_msearch", self.msearch)
+        self.app.router.add_route("*", "/{index}/_field_caps", self.field_caps)
+        self.app.router.add_get("/{index}/_doc/{id}", self.get)
+        self.app.router.add_post("/{index}/_pit", self.open_pit)
+        self.app.router.add_delete("/_pit", self.close_pit)
+        # not part of the elasticsearch api, for controlling a fake running in another process
+        self.app.router.add_get("/_fake/stats", self.stats)
+        self.app.router.add_post("/_fake/logs", self.configure)
+
+    def respond(self, body, status=200):
+        # the elasticsearch client refuses responses without this header
+        return web.json_response(body, status=status, headers={"X-Elastic-Product": "Elasticsearch"},
+                                 dumps=json.dumps)
+
+    async def info(self, request):
+        return self.respond({"name": "fake", "cluster_name": "fake", "tagline": "You Know, for Search",
+                             "version": {"number": "8.19.0", "build_flavor": "default"}})
+
+    async def search(self, request):
+        self.requests += 1
+        body = await request.json() if request.can_read_body else {}
+        index = request.match_info.get("index")
+        if "pit" in body:
+            index = self.pits.get(body["pit"]["id"])
+            if index is None:
+                return self.respond({"error": {"type": "search_context_missing_exception"}, "status": 404}, 404)
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+        return self.respond(self.execute(index or "_all", body))
+
+    async def msearch(self, request):
+        self.requests += 1
+        lines = [json.loads(line) for line in (await request.text()).splitlines() if line.strip()]
+        default_index = request.match_info.get("index", "_all")
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+        responses = [self.execute(header.get("index", default_index), body)
+                     for header, body in zip(lines[::2], lines[1::2])]
+        return self.respond({"took": sum(resp["took"] for resp in responses), "responses": responses})
+
+    async def field_caps(self, request):
+        self.requests += 1
+        fields = {"@timestamp": {"date": {"type": "date", "searchable": True, "aggregatable": True}},
+                  "level": {"keyword": {"type": "keyword", "searchable": True, "aggregatable": True}},
+                  "message": {"text": {"type": "text", "searchable": True, "aggregatable": False}},
+                  "status.code": {"long": {"type": "long", "searchable": True, "aggregatable": True}},
+                  "timings.duration": {"long": {"type": "long", "searchable": True, "aggregatable": True}}}
+        for field in range(self.logs.num_fields):
+            fields[f"field_{field}"] = {"keyword": {"type": "keyword", "searchable": True, "aggregatable": True}}
+        return self.respond({"indices": [request.match_info["index"]], "fields": fields})
+
+    async def get(self, request):
+        self.requests += 1
+        index, doc_id = request.match_info["index"], request.match_info["id"]
+        idx = int(doc_id.removeprefix("doc-")) if doc_id.removeprefix("doc-").isdigit() else -1
+        if not 0 <= idx < self.logs.now_index():
+            return self.respond({"_index": index, "_id": doc_id, "found": False}, 404)
+        return self.respond({"_index": index, "_id": doc_id, "found": True, "_source": self.logs.document(idx)})
+
+    async def open_pit(self, request):
+        pit_id = uuid.uuid4().hex
+        self.pits[pit_id] = request.match_info["index"]
+        return self.respond({"id": pit_id})
+
+    async def close_pit(self, request):
+        body = await request.json()
+        found = self.pits.pop(body.get("id"), None) is not None
+        return self.respond({"succeeded": found, "num_freed": int(found)})
+
+    async def stats(self, request):
+        return web.json_response({"requests": self.requests, "searches": self.searches})
+
+    async def configure(self, request):
+        """ Changes the attributes of the generated logs, e.g. docs_per_second. """
+        for name, value in (await request.json()).items():
+            if name not in ("docs_per_second", "num_fields", "field_size"):
+                raise web.HTTPBadRequest(text=f"unknown attribute '{name}'")
+            setattr(self.logs, name, int(value))
+        return web.json_response(vars(self.logs))
+
+    def execute(self, index, body):
+        """ Executes a single search. """
+
+        start = time.perf_counter()
+        self.searches += 1
+
+        from_ms, to_ms = _time_range(body.get("query", {}))
+        first = self.logs.index_at(max(from_ms, 0))
+        end = min(self.logs.now_index(), self.logs.index_at(to_ms) if to_ms != float("inf") else self.logs.now_index())
+        end = max(first, end)
+
+        size = int(body.get("size", 10))
+        descending = any(sort.get("@timestamp", {}).get("order") == "desc" for sort in body.get("sort", []))
+        search_after = body.get("search_after")
+        if search_after:
+            if descending:
+                end = min(end, self.logs.index_at(search_after[0]))
+            else:
+                first = max(first, self.logs.index_at(search_after[0] + 1))
+        indices = range(end - 1, max(first, end - size) - 1, -1) if descending else range(first, min(end, first + size))
+
+        resp = {
+            "took": 0,
+            "timed_out": False,
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {
+                "total": {"value": min(end - first, MAX_TOTAL_HITS), "relation": "eq" if end - first <= MAX_TOTAL_HITS else "gte"},
+                "max_score": None,
+                "hits": [self.logs.hit(index, idx) for idx in indices],
+            },
+        }
+        if "pit" in body:
+            resp["pit_id"] = body["pit"]["id"]
+        if body.get("aggs") or body.get("aggregations"):
+            resp["aggregations"] = self.aggregate(body.get("aggs") or body.get("aggregations"), first, end)
+        resp["took"] = int((time.perf_counter() - start) * 1000)
+        return resp
+
+    def aggregate(self, aggs, first, end):
+        result = {}
+        for name, agg in aggs.items():
+            if "date_histogram" in agg:
+                result[name] = self.date_histogram(agg, first, end)
+            elif "terms" in agg:
+                result[name] = self.terms(agg, first, end)
+            elif "percentiles" in agg:
+                result[name] = {"values": {str(p): p * 50.0 for p in agg["percentiles"].get("percents", [50])}}
+            elif "filters" in agg:
+                result[name] = {"buckets": {key: {"doc_count": 0} for key in agg["filters"]["filters"]}}
+                if "other_bucket_key" in agg["filters"]:
+                    result[name]["buckets"][agg["filters"]["other_bucket_key"]] = {"doc_count": end - first}
+            elif "missing" in agg:
+                result[name] = {"doc_count": 0}
+            elif "random_sampler" in agg:
+                # counts are exact, as if the sample matched the scaled up counts perfectly
+                result[name] = {"doc_count": int((end - first) * agg["random_sampler"]["probability"]),
+                                **self.aggregate(agg.get("aggs", {}), first, end)}
+        return result
+
+    def date_histogram(self, agg, first, end):
+        interval_ms = parse_offset(agg["date_histogram"]["fixed_interval"]) * 1000
+        buckets = []
+        if end > first:
+            key = self.logs.timestamp_ms(first) // interval_ms * interval_ms
+            while True:
+                bucket_first = max(first, self.logs.index_at(key))
+                bucket_end = min(end, self.logs.index_at(key + interval_ms))
+                if bucket_first >= end:
+                    break
+                if bucket_end > bucket_first:
+                    bucket = {"key": key, "key_as_string": str(key), "doc_count": bucket_end - bucket_first}
+                    bucket.update(self.aggregate(agg.get("aggs", {}), bucket_first, bucket_end))
+                    buckets.append(bucket)
+                key += interval_ms
+        return {"buckets": buckets}
+
+    def terms(self, agg, first, end):
+        # only the level field has a known distribution, all other fields have a single term
+        field = agg["terms"]["field"]
+        if field.removesuffix(".keyword") != "level":
+            return {"buckets": [{"key": "value", "doc_count": end - first}] if end > first else []}
+        counts = {}
+        for level in LEVELS:
+            counts[level] = 0
+        num_levels = len(LEVELS)
+        for offset in range(num_levels):
+            # documents with idx % num_levels == offset in [first, end)
+            start = first + (offset - first) % num_levels
+            if start < end:
+                counts[LEVELS[offset]] += (end - 1 - start) // num_levels + 1
+        buckets = [{"key": level, "doc_count": count} for level, count in counts.items() if count]
+        buckets.sort(key=lambda bucket: -bucket["doc_count"])
+        return {"buckets": buckets[:agg["terms"].get("size", 10)]}
+
+
+async def start(logs: FakeLogs, host="127.0.0.1", port=0, latency_s=0.0):
+    """ Starts a fake elasticsearch in the running event loop.
+
+    Returns the FakeElasticsearch, its url and the runner to stop it with. """
+
+    fake = FakeElasticsearch(logs, latency_s)
+    runner = web.AppRunner(fake.app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return fake, f"http://{host}:{port}", runner
+
+
+async def serve_forever(args):
+    logs = FakeLogs(docs_per_second=args.docs_per_second, num_fields=args.fields, field_size=args.field_size)
+    _, url, runner = await start(logs, port=args.port, latency_s=args.latency_ms / 1000)
+    print(url, flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves a fake elasticsearch with synthetic logs.")
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--docs-per-second", type=int, default=10)
+    parser.add_argument("--fields", type=int, default=10)
+    parser.add_argument("--field-size", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    asyncio.run(serve_forever(parser.parse_args()))
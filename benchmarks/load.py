@@ -0,0 +1,252 @@
+""" Load test of live tails, to find out how many concurrent streams a
+single worker can serve.
+
+Runs the app (a single uvicorn worker) and a fake elasticsearch in
+separate processes, so that generating the load does not compete with
+them for cpu, opens concurrent /logs streams and /aggregation.svg
+refresh loops and reports, per scenario:
+
+- the latency of rows, from their timestamp until they arrive at the client
+- the latency of histogram refreshes
+- cpu and memory of the app per stream
+- elasticsearch requests per second
+- the event loop lag reported by the app
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.load --streams 1,10,50 --ingest-rates 10,100 --output load.json
+
+This needs Linux, cpu and memory are read from /proc. """
+
+import argparse
+import asyncio
+from datetime import datetime, timezone
+import html
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from benchmarks.run import free_port, git_commit
+
+TIMESTAMP_RE = re.compile(r'"@timestamp": "([^"]+)"')
+
+
+def percentiles(values):
+    """ Returns p50, p90 and p99 of values (in seconds) in milliseconds. """
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {"count": len(values), **{f"p{p}_ms": round(values[min(len(values) - 1, len(values) * p // 100)] * 1000, 1)
+                                     for p in [50, 90, 99]}}
+
+
+def process_stats(pid):
+    """ Returns the cpu time (in seconds) and resident memory (in bytes) of process pid. """
+
+    with open(f"/proc/{pid}/stat") as f:
+        # the process name can contain spaces, the fields after it cannot
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu_s = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    with open(f"/proc/{pid}/statm") as f:
+        rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    return cpu_s, rss
+
+
+def parse_doc_timestamp(timestamp):
+    """ Parses timestamps of the fake elasticsearch, into seconds since the epoch. """
+    return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc).timestamp()
+
+
+async def tail(session, url, deadline, latencies):
+    """ Follows the live tail at url until deadline, collecting the latency of new rows. """
+
+    buffered = ""
+    initial = True
+    async with session.get(url) as resp:
+        resp.raise_for_status()
+        async for chunk in resp.content.iter_any():
+            now = time.time()
+            buffered += chunk.decode("utf-8", errors="replace")
+            rows = buffered.split('<tr class="row"')
+            buffered = rows.pop()
+            for row in rows:
+                match = TIMESTAMP_RE.search(html.unescape(row))
+                if match and not initial:
+                    latencies.append(now - parse_doc_timestamp(match[1]))
+                # rows of the first results are old, the timing after them
+                # marks the start of the live tail
+                if 'class="server-timing"' in row:
+                    initial = False
+            if now > deadline:
+                break
+
+
+async def refresh(session, url, deadline, interval_s, latencies):
+    """ Refreshes the histogram at url every interval_s until deadline. """
+
+    while time.time() < deadline:
+        start = time.perf_counter()
+        async with session.get(url) as resp:
+            await resp.read()
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(max(0, interval_s - (time.perf_counter() - start)))
+
+
+async def event_loop_lag(session):
+    async with session.get("/metrics") as resp:
+        for line in (await resp.text()).splitlines():
+            if line.startswith("es_stream_logs_event_loop_lag_seconds "):
+                return float(line.split()[1])
+    return None
+
+
+async def fake_es_requests(es_session):
+    async with es_session.get("/_fake/stats") as resp:
+        return (await resp.json())["requests"]
+
+
+async def run_scenario(app_url, pid, es_session, streams, svg_loops, ingest_rate, field_size, args):
+    async with es_session.post("/_fake/logs", json={"docs_per_second": ingest_rate, "field_size": field_size}) as resp:
+        resp.raise_for_status()
+
+    row_latencies = []
+    svg_latencies = []
+    query = f"dc=fake&index=logs-*&from=now-{args.initial_s}s&to=now"
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(app_url, connector=connector,
+                                     timeout=aiohttp.ClientTimeout(total=None, sock_read=60)) as session:
+        cpu_before, rss_before = process_stats(pid)
+        requests_before = await fake_es_requests(es_session)
+        start = time.time()
+        deadline = start + args.seconds
+        tasks = [tail(session, f"/logs?{query}&max_results=all", deadline, row_latencies) for _ in range(streams)]
+        tasks += [refresh(session, f"/aggregation.svg?{query}&aggregation_terms=level", deadline,
+                          args.svg_interval_s, svg_latencies)
+                  for _ in range(svg_loops)]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        duration = time.time() - start
+
+        cpu_after, rss_after = process_stats(pid)
+        requests_after = await fake_es_requests(es_session)
+        lag_s = await event_loop_lag(session)
+
+    errors = [repr(result) for result in results if isinstance(result, Exception)]
+    clients = max(1, streams + svg_loops)
+    return {
+        "streams": streams,
+        "svg_loops": svg_loops,
+        "ingest_rate": ingest_rate,
+        "field_size": field_size,
+        "seconds": round(duration, 2),
+        "row_latency": percentiles(row_latencies),
+        "svg_latency": percentiles(svg_latencies),
+        "cpu_pct_per_client": round((cpu_after - cpu_before) / duration / clients * 100, 2),
+        "cpu_pct": round((cpu_after - cpu_before) / duration * 100, 1),
+        "rss_mb": round(rss_after / 1024 / 1024, 1),
+        "rss_kb_per_client": round((rss_after - rss_before) / 1024 / clients, 1),
+        "es_requests_per_s": round((requests_after - requests_before) / duration, 1),
+        "event_loop_lag_ms": round(lag_s * 1000, 1) if lag_s is not None else None,
+        "errors": errors[:5],
+    }
+
+
+async def start_app(es_url):
+    """ Starts the app with a single worker against es_url, returns its process and url. """
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump({"default_endpoint": "fake", "endpoints": {"fake": [es_url]}, "default_index": "logs-*",
+                   "indices": ["logs-*"], "field_format": {}, "queries": [],
+                   "default_fields": [{"match_params": {"index": ""},
+                                       "fields": ["@timestamp", "level", "message", "field_0", "field_1"]}]}, f)
+    port = free_port()
+    env = {**os.environ, "CONFIG": f.name, "ES_USER": "load", "ES_PASSWORD": "load"}
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "es_stream_logs:app", "--port", str(port),
+                             "--log-level", "warning", "--no-access-log"], env=env)
+
+    url = f"http://127.0.0.1:{port}"
+    async with aiohttp.ClientSession(url) as session:
+        for _ in range(100):
+            try:
+                async with session.get("/favicon.ico") as resp:
+                    if resp.status == 200:
+                        return proc, url, f.name
+            except aiohttp.ClientConnectionError:
+                pass
+            await asyncio.sleep(0.1)
+    proc.terminate()
+    raise Exception("app did not start")
+
+
+async def start_fake_es(args):
+    """ Starts the fake elasticsearch in a separate process, returns it and its url. """
+
+    port = free_port()
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "benchmarks.fake_es", "--port", str(port), "--fields", str(args.fields),
+        "--latency-ms", str(args.latency_ms), stdout=subprocess.PIPE)
+    url = (await proc.stdout.readline()).decode().strip()
+    if not url:
+        raise Exception("fake elasticsearch did not start")
+    return proc, url
+
+
+async def main(args):
+    es_proc, es_url = await start_fake_es(args)
+    proc, app_url, config_path = await start_app(es_url)
+
+    scenarios = []
+    try:
+        async with aiohttp.ClientSession(es_url) as es_session:
+            for streams, ingest_rate, field_size in itertools.product(args.streams, args.ingest_rates,
+                                                                      args.field_sizes):
+                result = await run_scenario(app_url, proc.pid, es_session, streams, args.svg_loops,
+                                            ingest_rate, field_size, args)
+                print(json.dumps(result), file=sys.stderr)
+                scenarios.append(result)
+    finally:
+        proc.terminate()
+        proc.wait()
+        es_proc.terminate()
+        await es_proc.wait()
+        os.unlink(config_path)
+
+    return {"commit": git_commit(), "timestamp": int(time.time()), "params": vars(args), "scenarios": scenarios}
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int_list, default=[1, 10, 50], help="concurrent live tails, comma-separated")
+    parser.add_argument("--svg-loops", type=int, default=2, help="concurrent /aggregation.svg refresh loops")
+    parser.add_argument("--svg-interval-s", type=float, default=5, help="refresh interval of the histograms")
+    parser.add_argument("--ingest-rates", type=int_list, default=[10, 100],
+                        help="documents per second, comma-separated")
+    parser.add_argument("--field-sizes", type=int_list, default=[20],
+                        help="size of the generated fields, comma-separated")
+    parser.add_argument("--fields", type=int, default=10, help="number of generated fields per document")
+    parser.add_argument("--initial-s", type=int, default=10, help="time range of the initial results of a tail")
+    parser.add_argument("--latency-ms", type=float, default=5, help="added latency of the fake elasticsearch")
+    parser.add_argument("--seconds", type=float, default=20, help="duration of each scenario")
+    parser.add_argument("--output", help="file to write the results to, instead of stdout")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    results = asyncio.run(main(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,260 @@
+""" Benchmarks of es-stream-logs against a fake elasticsearch.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.run --output bench.json
+
+and compare the json results between commits. """
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+from starlette.requests import Request
+
+from benchmarks import fake_es
+
+
+def summarize(durations):
+    """ Returns statistics of durations (in seconds) in milliseconds. """
+    durations = sorted(durations)
+    return {
+        "runs": len(durations),
+        "mean_ms": round(statistics.mean(durations) * 1000, 3),
+        "p50_ms": round(durations[len(durations) // 2] * 1000, 3),
+        "p90_ms": round(durations[int(len(durations) * 0.9)] * 1000, 3),
+        "max_ms": round(durations[-1] * 1000, 3),
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def bench_renderers(app, logs, args):
+    """ Rows and bytes per second of rendering hits, without elasticsearch. """
+
+    config = app.CONFIG
+    results = {}
+    fields = ["@timestamp", "level", "message"] + [f"field_{field}" for field in range(min(args.fields, 5))]
+    query = app.Query(config, dc="fake", index="logs-*", fields=",".join(fields))
+    renderers = {"html": lambda: app.render.HTMLRenderer(config, query), "json": app.render.JSONRenderer}
+    for name, new_renderer in renderers.items():
+        hits = [logs.hit("logs-bench", idx) for idx in range(args.rows)]
+        renderer = new_renderer()
+        num_bytes = len(renderer.start())
+        start = time.perf_counter()
+        for hit in hits:
+            source = app.filter_dict(hit["_source"], query.fields)
+            num_bytes += len(renderer.result(hit, source))
+        num_bytes += len(renderer.end())
+        duration = time.perf_counter() - start
+        results[name] = {"rows": args.rows, "seconds": round(duration, 4),
+                         "rows_per_s": round(args.rows / duration), "bytes_per_s": round(num_bytes / duration)}
+    return results
+
+
+def bench_timestamps(app, logs, args):
+    """ Nanoseconds per hit of getting the timestamp of hits, to cursor over them. """
+
+    hits = [logs.hit("logs-bench", idx) for idx in range(args.rows)]
+    nanos = [{**hit["_source"], "@timestamp": hit["_source"]["@timestamp"][:-1] + "123456Z"} for hit in hits]
+    offsets = [{**hit["_source"], "@timestamp": hit["_source"]["@timestamp"][:-1] + "+01:00"} for hit in hits]
+
+    def strptime(hit):
+        return int(app.parse_doc_timestamp(hit["_source"]["@timestamp"]).timestamp() * 1000)
+
+    cases = {
+        "strptime": (strptime, hits),
+        "strptime_nanos": (strptime, [{"_source": source} for source in nanos]),
+        "iso8601": (app.hit_timestamp_ms, [{"_source": hit["_source"]} for hit in hits]),
+        "iso8601_nanos": (app.hit_timestamp_ms, [{"_source": source} for source in nanos]),
+        "iso8601_offset": (app.hit_timestamp_ms, [{"_source": source} for source in offsets]),
+        "sort_values": (app.hit_timestamp_ms, hits),
+    }
+    results = {}
+    for name, (timestamp_ms, case_hits) in cases.items():
+        start = time.perf_counter()
+        for hit in case_hits:
+            timestamp_ms(hit)
+        duration = time.perf_counter() - start
+        results[name] = {"ns_per_hit": round(duration / len(case_hits) * 1e9)}
+    return results
+
+
+async def bench_tail(app, fake, args):
+    """ Overhead of polling for new results of a live tail, per poll. """
+
+    es = app.new_es_client(app.CONFIG, "fake", "bench", "bench")
+    query = app.Query(app.CONFIG, dc="fake", index="logs-*", fields="@timestamp,level,message",
+                      **{"from": "now-1m", "to": "now"})
+    trace = app.tracing.Trace("bench")
+    searches = fake.searches
+    num_bytes = 0
+    stream = app.stream_logs(es, app.render.HTMLRenderer(app.CONFIG, query), query, trace)
+    start = time.perf_counter()
+    try:
+        async for chunk in stream:
+            num_bytes += len(chunk)
+            if time.perf_counter() - start > args.seconds:
+                break
+    finally:
+        await stream.aclose()
+        await es.close()
+
+    polls = fake.searches - searches
+    overhead_s = sum(trace.stages.get(stage, 0) for stage in ["build", "project", "render"])
+    return {"seconds": args.seconds, "polls": polls, "bytes": num_bytes,
+            "overhead_ms_per_poll": round(overhead_s / polls * 1000, 3),
+            "es_wait_ms_per_poll": round(trace.stages.get("es_wait", 0) / polls * 1000, 3),
+            "stages_ms": {stage: round(duration * 1000, 3) for stage, duration in trace.stages.items()}}
+
+
+async def bench_aggregation(app, args):
+    """ Time to build /aggregation.svg, for a few typical queries. """
+
+    es = app.new_es_client(app.CONFIG, "fake", "bench", "bench")
+    queries = {
+        "1h": "dc=fake&index=logs-*&from=now-1h&to=now",
+        "1h_level": "dc=fake&index=logs-*&from=now-1h&to=now&aggregation_terms=level",
+        "7d_level_percentiles": ("dc=fake&index=logs-*&from=now-7d&to=now&resolution=1000"
+                                 "&aggregation_terms=level&percentiles_terms=timings.duration"),
+    }
+    results = {}
+    try:
+        for name, query_string in queries.items():
+            request = Request({"type": "http", "method": "GET", "path": "/aggregation.svg", "headers": [],
+                               "query_string": query_string.encode()})
+            query = app.from_request(app.CONFIG, request)
+            durations = []
+            render_s = 0
+            for _ in range(args.repeat):
+                trace = app.tracing.Trace("bench")
+                start = time.perf_counter()
+                resp = await app.aggregation_svg(es, request, query, trace)
+                durations.append(time.perf_counter() - start)
+                render_s += trace.stages.get("render", 0)
+            results[name] = {**summarize(durations), "render_mean_ms": round(render_s / args.repeat * 1000, 3),
+                             "svg_bytes": len(resp.body)}
+    finally:
+        await es.close()
+    return results
+
+
+async def bench_ttfb(app, args):
+    """ Time to first byte and to the last byte over http, through the whole app. """
+
+    import uvicorn
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app.app, host="127.0.0.1", port=port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    urls = {
+        "logs_html": "/logs?dc=fake&index=logs-*&from=now-1h&to=now-55m&max_results=1000",
+        "logs_json": "/logs?dc=fake&index=logs-*&from=now-1h&to=now-55m&max_results=1000&fmt=json",
+        "raw": "/raw?dc=fake&index=logs-*&from=now-1h&to=now-55m",
+        "aggregation_svg": "/aggregation.svg?dc=fake&index=logs-*&from=now-1h&to=now&aggregation_terms=level",
+    }
+    results = {}
+    try:
+        async with aiohttp.ClientSession(f"http://127.0.0.1:{port}") as session:
+            for name, url in urls.items():
+                first_bytes = []
+                totals = []
+                num_bytes = 0
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    async with session.get(url) as resp:
+                        resp.raise_for_status()
+                        first = True
+                        num_bytes = 0
+                        async for chunk in resp.content.iter_any():
+                            if first:
+                                first_bytes.append(time.perf_counter() - start)
+                                first = False
+                            num_bytes += len(chunk)
+                    totals.append(time.perf_counter() - start)
+                results[name] = {"ttfb": summarize(first_bytes), "total": summarize(totals), "bytes": num_bytes}
+    finally:
+        server.should_exit = True
+        await server_task
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+    logs = fake_es.FakeLogs(docs_per_second=args.docs_per_second, num_fields=args.fields, field_size=args.field_size)
+    fake, url, runner = await fake_es.start(logs, latency_s=args.latency_ms / 1000)
+
+    # the app reads its configuration and credentials on import
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump({"default_endpoint": "fake", "endpoints": {"fake": [url]}, "default_index": "logs-*",
+                   "indices": ["logs-*"], "field_format": {}, "queries": [],
+                   "default_fields": [{"match_params": {"index": ""},
+                                       "fields": ["@timestamp", "level", "message", "field_0", "field_1"]}]}, f)
+    os.environ["CONFIG"] = f.name
+    os.environ["ES_USER"] = os.environ["ES_PASSWORD"] = "bench"
+    import es_stream_logs as app
+
+    results = {}
+    try:
+        results["renderers"] = bench_renderers(app, logs, args)
+        results["timestamps"] = bench_timestamps(app, logs, args)
+        results["tail"] = await bench_tail(app, fake, args)
+        results["aggregation_svg"] = await bench_aggregation(app, args)
+        results["ttfb"] = await bench_ttfb(app, args)
+    finally:
+        await runner.cleanup()
+        os.unlink(f.name)
+
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "timestamp": int(time.time()),
+        "params": vars(args),
+        "results": results,
+    }
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs-per-second", type=int, default=20, help="ingest rate of the fake elasticsearch")
+    parser.add_argument("--fields", type=int, default=10, help="number of additional fields per document")
+    parser.add_argument("--field-size", type=int, default=20, help="size of the additional fields")
+    parser.add_argument("--latency-ms", type=float, default=0, help="added latency of the fake elasticsearch")
+    parser.add_argument("--rows", type=int, default=5000, help="rows to render in the renderer benchmarks")
+    parser.add_argument("--seconds", type=float, default=3, help="duration of the live tail benchmark")
+    parser.add_argument("--repeat", type=int, default=10, help="repetitions of the request benchmarks")
+    parser.add_argument("--output", help="file to write the results to, instead of stdout")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    results = asyncio.run(main(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,65 @@
+""" Small in-process caches. """
+
+from collections import OrderedDict
+import time
+
+
+class Cache:
+    """ A least-recently-used cache with optional expiry per entry.
+
+    Entries without a ttl never expire, but are evicted like all others
+    once more than max_entries are stored.  With max_bytes, the values
+    must be bytes or str and are also evicted once their total length
+    exceeds it. """
+
+    def __init__(self, max_entries=1000, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """ Returns the value for key, or default if it is missing or expired. """
+
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, expires_at, size = entry
+        if expires_at is not None and expires_at < time.monotonic():
+            del self.entries[key]
+            self.size -= size
+            self.misses += 1
+            return default
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """ Stores value for key, expiring after ttl seconds if given. """
+
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        size = len(value) if self.max_bytes is not None else 0
+        self.pop(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        self.entries[key] = (value, expires_at, size)
+        self.size += size
+        while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes):
+            _, (_, _, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def pop(self, key):
+        """ Removes key, if it is stored. """
+
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def __len__(self):
+        return len(self.entries)
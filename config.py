@@ -1,6 +1,6 @@
 """ Configuration parsing and definition. """
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import json
 from typing import Dict, List, Optional
 
@@ -21,6 +21,57 @@ class DefaultFields:
         return None
 
 
+class DefaultFieldsMatcher:
+    """ Finds the first matching default fields, without checking every
+    definition for every query.
+
+    The definitions are indexed by the names of their parameters, so that
+    only definitions whose parameters are all set in the query are
+    checked.  Results are memoized by the values of those parameters. """
+
+    MAX_MEMOIZED = 1000
+
+    def __init__(self, default_fields: List[DefaultFields]):
+        # positions of the definitions, by the names of their parameters
+        self.by_names = {}
+        for pos, default_fields_def in enumerate(default_fields):
+            self.by_names.setdefault(frozenset(default_fields_def.match_params), []).append((pos, default_fields_def))
+        self.names = sorted(set().union(*self.by_names)) if self.by_names else []
+        self.memoized = {}
+
+    def find(self, kwargs):
+        """ Returns the fields of the first matching definition, or None. """
+
+        key = tuple((name, kwargs[name]) for name in self.names if name in kwargs)
+        try:
+            return self.memoized[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # not hashable, e.g. a list of values
+            return self._find(kwargs)
+
+        fields = self._find(kwargs)
+        if len(self.memoized) >= self.MAX_MEMOIZED:
+            self.memoized.clear()
+        self.memoized[key] = fields
+        return fields
+
+    def _find(self, kwargs):
+        found_pos, found = None, None
+        for names, definitions in self.by_names.items():
+            if not names.issubset(kwargs):
+                continue
+            for pos, default_fields_def in definitions:
+                if found_pos is not None and pos > found_pos:
+                    break
+                fields = default_fields_def.matches(kwargs)
+                if fields:
+                    found_pos, found = pos, fields
+                    break
+        return found
+
+
 @dataclass
 class Config:
     """ Encapsulates configuration, e.g. datacenters. """
@@ -36,26 +87,106 @@ class Config:
 
     default_index: Optional[str] = "application-*"
 
+    # how often to refresh the sparklines for queries on the index page,
+    # 0 disables them
+    sparklines_refresh_s: int = 60
+
+    # directory to store histograms of closed time ranges in, disabled if
+    # not set
+    rollups_dir: Optional[str] = None
+    rollups_max_mb: int = 256
+    metrics_dir: Optional[str] = None
+    # directory to keep the results of finished searches over closed time
+    # ranges in, so that they can be rendered again, disabled if not set
+    spool_dir: Optional[str] = None
+    spool_max_mb: int = 1024
+    # where to keep caches, see shared_cache.py
+    cache_url: Optional[str] = None
+    cache_max_mb: int = 256
+    # per datacenter and worker process, searches beyond the limit wait in
+    # a queue of at most max_queued_searches
+    max_concurrent_searches: int = 10
+    max_queued_searches: int = 100
+    # addresses of reverse proxies, whose X-Forwarded-For identifies the
+    # users of searches without credentials of their own
+    trusted_proxies: List[str] = field(default_factory=list)
+    trace_sample_rate: float = 1.0
+    # live tails end after this many seconds, or if there were no new
+    # results for tail_max_idle_s, 0 disables the limits
+    tail_max_lifetime_s: int = 12 * 60 * 60
+    tail_max_idle_s: int = 60 * 60
+    # with several datacenters (dc=dc1,dc2), how long to wait for the
+    # others once the first one responded
+    fanout_deadline_s: float = 5
+
     def __post_init__(self):
         self.default_fields = [DefaultFields(**df) for df in self.default_fields]
+        self.default_fields_matcher = DefaultFieldsMatcher(self.default_fields)
 
     def find_default_fields(self, **kwargs):
         """ Finds default fields defined for query in config.
 
         Returns None if no matching default fields were found. """
 
-        for default_fields in self.default_fields:
-            fields = default_fields.matches(kwargs)
-            if fields:
-                return fields.copy()
+        fields = self.default_fields_matcher.find(kwargs)
+        if fields:
+            return fields.copy()
         return None
 
+    def validate(self):
+        """ Raises ValueError if the config cannot be used. """
+
+        for name, type_ in (("endpoints", dict), ("field_format", dict), ("indices", list), ("queries", list),
+                            ("trusted_proxies", list)):
+            if not isinstance(getattr(self, name), type_):
+                raise ValueError(f"{name} must be {'an object' if type_ is dict else 'a list'}")
+        for name in NUMBERS:
+            value = getattr(self, name)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"{name} must be a number")
+        if not self.endpoints:
+            raise ValueError("no endpoints configured")
+        if self.default_endpoint not in self.endpoints:
+            raise ValueError(f"default_endpoint '{self.default_endpoint}' is not one of the endpoints")
+        for datacenter, urls in self.endpoints.items():
+            if not isinstance(urls, list) or not urls or \
+                    not all(isinstance(url, str) and url.startswith(("http:", "https:")) for url in urls):
+                raise ValueError(f"endpoints of '{datacenter}' must be a non-empty list of http(s) urls")
+        for name, fmt in self.field_format.items():
+            if not isinstance(fmt, str):
+                raise ValueError(f"field_format of '{name}' must be a string")
+        for default_fields in self.default_fields:
+            if not isinstance(default_fields.match_params, dict) or not default_fields.fields:
+                raise ValueError(f"invalid default_fields {default_fields}")
+        if not 0 <= self.trace_sample_rate <= 1:
+            raise ValueError("trace_sample_rate must be between 0 and 1")
+        if self.max_concurrent_searches < 1 or self.max_queued_searches < 0:
+            raise ValueError("max_concurrent_searches must be positive, max_queued_searches not negative")
+        if self.cache_url and not self.cache_url.startswith(("memory", "sqlite:", "redis:")):
+            raise ValueError("cache_url must be memory, sqlite:///path or redis://host:port/db")
+        if self.fanout_deadline_s < 0:
+            raise ValueError("fanout_deadline_s must not be negative")
+        if self.sparklines_refresh_s < 0:
+            raise ValueError("sparklines_refresh_s must not be negative")
+
+
+# settings that have to be numbers
+NUMBERS = ["sparklines_refresh_s", "rollups_max_mb", "spool_max_mb", "cache_max_mb", "max_concurrent_searches",
+           "max_queued_searches", "trace_sample_rate", "tail_max_lifetime_s", "tail_max_idle_s", "fanout_deadline_s"]
+
+# settings that are only read at startup, changes are only applied after
+# a restart, all others also by reloading the config
+RESTART_ONLY = ["metrics_dir", "cache_url", "cache_max_mb"]
+
 
 def from_file(filename):
-    """ Parse config from json in filename. """
+    """ Parse config from json in filename, raises ValueError (or
+    TypeError for unknown keys) if it is invalid. """
 
     with open(filename, 'r') as fpp:
-        return Config(**json.load(fpp))
+        cfg = Config(**json.load(fpp))
+    cfg.validate()
+    return cfg
 
 
 if __name__ == '__main__':
@@ -10,13 +10,20 @@ query than Kibana, at least for ad-hoc queries.
 import asyncio
 import base64
 import binascii
-from datetime import datetime
+import bisect
+import contextlib
+import copy
+import hashlib
+from datetime import datetime, timezone
 import json
 import os
 import time
 import traceback
-from urllib.parse import urlparse, parse_qsl
+from typing import NamedTuple
+import uuid
+from urllib.parse import parse_qsl, quote, urlencode, urlparse
 
+import aiohttp
 from dotenv import load_dotenv
 from elasticsearch import AsyncElasticsearch
 import elasticsearch
@@ -30,12 +37,21 @@ from starlette.datastructures import QueryParams
 from starlette.middleware.base import BaseHTTPMiddleware
 
 # project internal modules
-from color_mapper import ColorMapper
+import admission
 import config
+import fanout
+import histogram
 import kibana
-from query import Query, from_request
+import mappings
+import metrics
+import profiling
+from query import ONLY_ONCE_ARGUMENTS, Query, flatten_params, from_request, parse_offset, parse_timestamp
 import render
+import rollups
+import shared_cache
+import spool
 import tinygraph
+import tracing
 
 
 class FixVivaldiQueryEncoding(BaseHTTPMiddleware):
@@ -62,8 +78,58 @@ class FixVivaldiQueryEncoding(BaseHTTPMiddleware):
         return response
 
 
-app = FastAPI()
+class CloseEsClients:
+    """ Closes the elasticsearch clients created for a request once its
+    response was sent completely, which for streams is when they end. """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        es_clients = scope.setdefault("state", {})["es_clients"] = []
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            for es_client in es_clients:
+                await es_client.close()
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """ Starts and stops background tasks. """
+
+    config = await get_config()
+    shared_cache.configure(shared_cache.from_url(config.cache_url, config.cache_max_mb * 1024 * 1024))
+    sparklines_task = None
+    if ES_USER and ES_PASSWORD:
+        sparklines_task = asyncio.create_task(refresh_sparklines_forever())
+
+    if config.metrics_dir:
+        os.makedirs(config.metrics_dir, exist_ok=True)
+        metrics.REGISTRY.directory = config.metrics_dir
+    monitor_task = asyncio.create_task(monitor_event_loop_forever())
+    tracing.SAMPLE_RATE = config.trace_sample_rate
+    watch_config_task = asyncio.create_task(watch_config_forever())
+
+    yield
+
+    if sparklines_task:
+        sparklines_task.cancel()
+    monitor_task.cancel()
+    watch_config_task.cancel()
+    metrics.REGISTRY.write()
+    await shared_cache.BACKEND.close()
+    if HTTP_SESSION:
+        await HTTP_SESSION.close()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(FixVivaldiQueryEncoding)
+app.add_middleware(CloseEsClients)
+app.add_middleware(metrics.MetricsMiddleware)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
@@ -79,6 +145,52 @@ time.tzset()
 
 favicon_static = StaticFiles(directory="static")
 
+# rendered sparklines of the configured queries by query url, refreshed
+# in the background by one of all workers sharing the cache, so that
+# rendering the index page is cheap
+SPARKLINES = shared_cache.SharedCache("sparklines", shared_cache.TEXT, max_entries=1000)
+SPARKLINE_BUCKETS = 40
+# key in SPARKLINES of the worker refreshing them, until the next refresh
+SPARKLINES_REFRESH_KEY = "refreshing"
+SPARKLINES_TTL_REFRESHES = 3
+
+# field capabilities by credentials, datacenter and index pattern
+FIELD_CAPS_CACHE = shared_cache.SharedCache("field_caps", shared_cache.FIELD_CAPS, max_entries=100)
+FIELD_CAPS_TTL_S = 5 * 60
+
+# histograms for closed time ranges, they never change and are kept until evicted
+HISTOGRAM_CACHE = shared_cache.SharedCache("histograms", shared_cache.HISTOGRAM, max_entries=1000)
+
+# serialized responses of /raw, /query and /aggregation.svg, responses
+# including recent data are only kept briefly because they still change
+RESPONSE_CACHE = shared_cache.SharedCache("responses", max_entries=10_000, max_bytes=64 * 1024 * 1024)
+RESPONSE_CACHE_RECENT_TTL_S = 5
+RESPONSE_CACHE_CLOSED_TTL_S = 60 * 60
+
+EVENT_LOOP_CHECK_INTERVAL_S = 1
+CONFIG_CHECK_INTERVAL_S = 5
+METRICS_WRITE_INTERVAL_S = 5
+
+# histograms with smaller intervals are not stored as rollups, they are
+# usually only used for short time ranges
+ROLLUP_MIN_INTERVAL_S = 60
+
+# searches over longer time ranges are scheduled after the others
+HEAVY_RANGE_S = 24 * 60 * 60
+
+# waiting longer than this for a free search slot is shown in the stream
+QUEUE_NOTICE_S = 0.5
+
+# data might be ingested with a delay, time ranges ending less than this
+# many seconds ago are not considered closed
+CLOSED_AFTER_S = 5 * 60
+
+# documents before and after the one shown by /context, and how far they
+# may be from it
+CONTEXT_DEFAULT_RESULTS = 20
+CONTEXT_MAX_RESULTS = 500
+CONTEXT_WINDOW_S = 24 * 60 * 60
+
 
 @app.get('/favicon.ico')
 async def favicon_route(request: Request):
@@ -113,6 +225,11 @@ async def index_route():
     a .low {
         opacity: 0.25;
     }
+
+    svg.sparkline {
+        vertical-align: middle;
+        border-bottom: 1px solid #ddd;
+    }
     </style>
 </head>
 
@@ -123,7 +240,7 @@ async def index_route():
 
 Loads (much) faster than Kibana, queries can be generated easily.</em>
     <ul>{% for query in queries -%}
-        <li><a href="{{ query | e }}">{{ highlight_query(query) }}</a></li>
+        <li>{{ sparklines[query] or "" }} <a href="{{ query | e }}">{{ highlight_query(query) }}</a></li>
     {%- endfor %}</ul>
 GET /       - documentation
 
@@ -132,12 +249,18 @@ GET /query  - get query that would be sent to elasticsearch (parameters same as
 
 GET /aggregation.svg - get rendered histogram (parameters same as for /logs)
 
+GET /context - logs around a single document, given by `_index` and `_id`, with
+  `n` (default 20) documents before and after it, optionally filtered as for /logs
+
+GET /logs/more - the next `max_results` rows of /logs after the cursor `after`,
+  which is part of the "Load more" link shown when there are more results
+
 GET /logs   - stream logs from elasticsearch
 
   Query parameters:
 
     - <strong>dc</strong>: "dc1", "dc3" or "dc2"
-      defaults to "dc1"
+      defaults to "dc1", several are searched at once with "dc1,dc2"
     - <strong>index</strong>: index to query
       defaults to "application-*"
 
@@ -166,13 +289,25 @@ GET /logs   - stream logs from elasticsearch
 
     - <strong>aggregation_terms</strong>: count number of messages per term, e.g. `aggregation_terms=level` to aggregate per log level.
       each term gets a unique color.  some special colors are used for http status codes and log levels.
-      note that some fields require a '.keyword' suffix to work, e.g. `aggregation_terms=category.keyword`
+      the '.keyword' sub-field is used automatically if the field itself can not be aggregated on.
     - <strong>aggregation_size</strong>: how many terms to aggregate, default is `5`.
+    - <strong>aggregation_mode</strong>: `terms` (default) aggregates the top terms per bucket,
+      `global` finds the top terms over the whole time range first and only counts those per bucket,
+      with all other terms in a separate bucket.  use `global` for fields with many different values.
 
     - <strong>percentiles_terms</strong>: collect percentiles for a field, e.g. `percentiles_terms=duration`.
       for html and svg output this is visualized as lines on each histogram bar.
     - <strong>percentiles</strong>: Percentiles to collect, default is `50,90,99`.
 
+    - <strong>resolution</strong>: number of buckets in the histogram, default is `100`, at most `5000`.
+      only used if `interval` is `auto`.
+    - <strong>request_cache</strong>: `true` to align the histogram time range to the interval and split it into
+      closed buckets and the current one, so that elasticsearch can serve the closed buckets from its request cache.
+    - <strong>profile</strong>: `1` to profile the searches in elasticsearch and show where the time was spent, per shard
+      and per query clause.  The slowest clauses are matched to the url parameters they come from.
+    - <strong>compare</strong>: draw histograms of earlier time ranges as lines on top of the histogram,
+      e.g. `compare=7d` for the same time last week, or `compare=1d,7d`.
+
     Timerange:
 
     - <strong>from</strong>: how far to fetch messages from the past, e.g. 'now-3d'
@@ -191,6 +326,9 @@ GET /logs   - stream logs from elasticsearch
 
     - <strong>timeout</strong>: elasticsearch timeout in seconds, default is `10` seconds.
     - <strong>max_results</strong>: maximum results to load in html view, default is `500`.
+      Further pages of as many results are loaded with the "Load more" link.
+    - <strong>sample</strong>: only show a random sample of this fraction of the
+      results, e.g. `0.01` for huge time ranges.  Counts are estimated from it.
 
     - <strong>fmt</strong>: "html" or "json"
       defaults to "html", "json" outputs one log entry per line as a json object</pre>
@@ -199,7 +337,9 @@ GET /logs   - stream logs from elasticsearch
 </html>""")
 
     config = await get_config()
-    return index.render(queries=config.queries, highlight_query=highlight_query)
+    sparklines = await asyncio.gather(*[SPARKLINES.get(query_url) for query_url in config.queries])
+    return index.render(queries=config.queries, highlight_query=highlight_query,
+                        sparklines=dict(zip(config.queries, sparklines)))
 
 
 def highlight_query(query_url):
@@ -245,318 +385,566 @@ def filter_dict(source, fields):
     return res
 
 
-def parse_offset(offset):
-    """ Parse elastic-search style offset into seconds, e.g. 10s, 1m, 3h, 2d... """
-    suffix = offset[-1]
-    num = int(offset[:-1])
-    offset_in_s = 0
-    if suffix == "s":
-        offset_in_s = num
-    elif suffix == "m":
-        offset_in_s = num * 60
-    elif suffix == "h":
-        offset_in_s = num * 60 * 60
-    elif suffix == "d":
-        offset_in_s = num * 24 * 60 * 60
-    else:
-        raise ValueError(f"could not parse offset '{offset}'")
-    return offset_in_s
+def is_complete(resp):
+    """ Returns whether the search of resp got the results of all shards in time. """
+    return not resp['timed_out'] and not resp['_shards']['failed']
+
 
+async def msearch(es, searches, timeout):
+    """ Runs all searches, given as (header, body), in a single request.
 
-def parse_timestamp(timestamp):
-    """ Parse elasticsearch-style timestamp, e.g. now-3h, 2019-09-09T00:00:00Z or epoch_millis. """
-    now = time.time()
-    if timestamp == "now":
-        return now
-    if timestamp.startswith("now-"):
-        offset = parse_offset(timestamp[len("now-"):])
-        return now - offset
+    The header must contain the index and can contain other search
+    parameters, e.g. request_cache.  Returns the responses in the same
+    order as searches, failed searches have an 'error' key instead of
+    results. """
 
-    # epoch millis
+    start = time.time()
+    if len(searches) == 1:
+        header, body = searches[0]
+        try:
+            resp = await es.search(index=header["index"], body=body, request_cache=header.get("request_cache"),
+                                   request_timeout=timeout)
+        except elasticsearch.ApiError as ex:
+            return [{"error": ex.info}]
+        metrics.observe_search("search", resp['took'], time.time() - start)
+        return [dict(resp)]
+
+    body = []
+    for header, search in searches:
+        body += [header, search]
+    resp = await es.msearch(body=body, request_timeout=timeout)
+    metrics.observe_search("msearch", resp['took'], time.time() - start)
+    return resp['responses']
+
+
+def sparkline_queries(config):
+    """ Parses the configured queries, grouped by datacenter, or the
+    datacenters searched at once (e.g. dc1,dc2). """
+
+    queries = {}
+    for query_url in config.queries:
+        params = QueryParams(urlparse(query_url).query)
+        try:
+            query = Query(config, **flatten_params(params, exceptions=ONLY_ONCE_ARGUMENTS))
+        except ValueError as ex:
+            print(f"invalid query '{query_url}':", ex)
+            continue
+        unknown = [datacenter for datacenter in query.datacenters if datacenter not in config.endpoints]
+        if unknown or not query.datacenters:
+            print(f"skipping sparkline for '{query_url}', unknown datacenters:", ", ".join(unknown))
+            continue
+        queries.setdefault(query.datacenter, []).append((query_url, query))
+    return queries
+
+
+def new_sparklines_client(config, query: Query):
+    """ Creates the client searching the datacenters of query. """
+
+    if len(query.datacenters) == 1:
+        return new_es_client(config, query.datacenter, ES_USER, ES_PASSWORD)
+    return fanout.FanOutClient({datacenter: new_es_client(config, datacenter, ES_USER, ES_PASSWORD)
+                                for datacenter in query.datacenters}, config.fanout_deadline_s)
+
+
+async def refresh_sparklines(config, es_clients):
+    """ Fetches histograms for all configured queries, using one search
+    request per datacenter.  They are kept for a few refreshes, in case
+    the next ones fail. """
+
+    ttl = SPARKLINES_TTL_REFRESHES * config.sparklines_refresh_s
+
+    async def refresh_datacenter(datacenter, queries):
+        searches = []
+        timeranges = []
+        for _, query in queries:
+            from_time = parse_timestamp(query.from_timestamp)
+            to_time = parse_timestamp(query.to_timestamp)
+            interval_s = max(1, tinygraph.time_increment(from_time, to_time, SPARKLINE_BUCKETS))
+            timeranges.append((from_time, to_time, interval_s))
+
+            # only the number of results is of interest here
+            count_query = query.counting()
+            es_query = count_query.to_elasticsearch(query.from_timestamp, num_results=0)
+            es_query["aggs"] = count_query.aggregation("num_results", tinygraph.pretty_duration(interval_s))
+            searches.append(({"index": query.index}, es_query))
+
+        timeout = max(query.timeout for _, query in queries)
+        async with admitted(datacenter, "sparklines", admission.HEAVY):
+            responses = await msearch(es_clients[datacenter], searches, timeout)
+        for (query_url, _), (from_time, to_time, interval_s), resp in zip(queries, timeranges, responses):
+            if 'error' in resp:
+                print(f"sparkline for '{query_url}' failed:", resp['error'])
+                await SPARKLINES.set(query_url, "", ttl=ttl)
+                continue
+            hist = histogram.from_aggregations(resp['aggregations'], interval_s)
+            title = f"{hist.total_count} results, updated at {time.strftime('%H:%M:%S')}"
+            await SPARKLINES.set(query_url, histogram.render_sparkline(hist, int(from_time * 1000), int(to_time * 1000),
+                                                                       title=title),
+                                 ttl=ttl)
+
+    queries = sparkline_queries(config)
+    for datacenter, dc_queries in queries.items():
+        if datacenter not in es_clients:
+            es_clients[datacenter] = new_sparklines_client(config, dc_queries[0][1])
+
+    results = await asyncio.gather(*[refresh_datacenter(datacenter, dc_queries)
+                                     for datacenter, dc_queries in queries.items()],
+                                   return_exceptions=True)
+    for datacenter, result in zip(queries, results):
+        if isinstance(result, Exception):
+            print(f"refreshing sparklines for {datacenter} failed:", result)
+
+
+async def refresh_sparklines_forever():
+    """ Refreshes sparklines periodically, until cancelled.  Uses the
+    current config for every refresh, so that reloaded queries and
+    endpoints are picked up.
+
+    Of all workers sharing the cache, the one that claims the refresh
+    first does it, the others render what it stored. """
+
+    es_clients = {}
+    refreshed_config = None
     try:
-        return int(timestamp) / 1000
-    except ValueError:
-        pass
+        while True:
+            config = await get_config()
+            if config is not refreshed_config:
+                for es_client in es_clients.values():
+                    await es_client.close()
+                es_clients.clear()
+                refreshed_config = config
+            if config.queries and config.sparklines_refresh_s > 0 and \
+                    await SPARKLINES.add(SPARKLINES_REFRESH_KEY, str(os.getpid()), ttl=config.sparklines_refresh_s):
+                await refresh_sparklines(config, es_clients)
+            await asyncio.sleep(config.sparklines_refresh_s or CONFIG_CHECK_INTERVAL_S)
+    finally:
+        for es_client in es_clients.values():
+            await es_client.close()
+
+
+async def monitor_event_loop_forever():
+    """ Measures how late a periodic timer fires, i.e. how long the event
+    loop is blocked, and writes the metrics of this process periodically. """
+
+    last_write = time.monotonic()
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(EVENT_LOOP_CHECK_INTERVAL_S)
+        metrics.EVENT_LOOP_LAG.set(max(0, time.monotonic() - start - EVENT_LOOP_CHECK_INTERVAL_S))
+
+        if time.monotonic() - last_write >= METRICS_WRITE_INTERVAL_S:
+            last_write = time.monotonic()
+            try:
+                metrics.REGISTRY.write()
+            except OSError as ex:
+                print("could not write metrics:", ex)
 
+
+@app.get('/metrics')
+async def serve_metrics():
+    """ Serve metrics of all workers in the Prometheus text format. """
+    return Response(content=metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+def search_user(request: Request):
+    """ Identifies the user of request for fair scheduling of searches, by
+    the user it searches as (see es_client_from) or the client address.
+
+    X-Forwarded-For is only used behind one of the trusted_proxies,
+    anyone else could claim any address with it. """
+
+    user = getattr(request.state, "es_user", None)
+    if user:
+        return user
+    address = request.client.host if request.client else ""
+    trusted_proxies = CONFIG.trusted_proxies
+    if address in trusted_proxies:
+        # proxies append the address they got the request from, the last
+        # one not added by a trusted proxy is the client
+        forwarded_for = [forwarded.strip() for forwarded in request.headers.get("X-Forwarded-For", "").split(",")]
+        untrusted = [forwarded for forwarded in forwarded_for if forwarded and forwarded not in trusted_proxies]
+        if untrusted:
+            address = untrusted[-1]
+    return address
+
+
+def search_priority(query: Query):
+    """ Returns the admission priority of the searches of query. """
+
+    if query.aggregation_terms or query.percentiles_terms:
+        return admission.HEAVY
+    from_time = parse_timestamp(query.from_timestamp)
+    to_time = parse_timestamp(query.to_timestamp)
+    return admission.HEAVY if to_time - from_time > HEAVY_RANGE_S else admission.INTERACTIVE
+
+
+@contextlib.asynccontextmanager
+async def admitted(datacenter, user, priority, trace=None):
+    """ Waits for a free search slot in datacenter and holds it while in
+    the context, yields how long it waited in seconds.
+
+    With several datacenters (dc1,dc2), a slot is held in each of them.
+    Raises admission.Overloaded if too many searches are waiting. """
+
+    datacenters = sorted({dc.strip() for dc in datacenter.split(",")})
+    if len(datacenters) > 1:
+        async with contextlib.AsyncExitStack() as stack:
+            waited_s = 0
+            # always in the same order, so that searches waiting for the
+            # same datacenters do not hold slots the others wait for
+            for dc in datacenters:
+                waited_s += await stack.enter_async_context(admitted(dc, user, priority, trace))
+            yield waited_s
+        return
+
+    trace = trace or tracing.disabled()
+    config = await get_config()
+    limiter = admission.limiter(datacenter, config.max_concurrent_searches, config.max_queued_searches)
+    priority_name = admission.PRIORITY_NAMES[priority]
+    metrics.SEARCHES_QUEUED.inc(datacenter=datacenter)
     try:
-        return time.mktime(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+        with trace.stage("queue"):
+            waited_s = await limiter.acquire(user, priority)
+    except admission.Overloaded:
+        metrics.SEARCHES_REJECTED.inc(datacenter=datacenter, priority=priority_name)
+        raise
+    finally:
+        metrics.SEARCHES_QUEUED.dec(datacenter=datacenter)
+    metrics.SEARCH_QUEUE_WAIT.observe(waited_s, datacenter=datacenter, priority=priority_name)
+
+    try:
+        yield waited_s
+    finally:
+        limiter.release()
+
+
+def credential_scope(request: Request):
+    """ Identifies the credentials used for request, e.g. for cache keys. """
+    auth = request.headers.get("Authorization", "")
+    return hashlib.sha256(auth.encode("utf-8")).hexdigest()[:16]
+
+
+def response_cache_key(route, request: Request, query: Query, *parts):
+    """ Identifies the response of route for query, independent of the
+    order of parameters.  parts must identify everything else the
+    response depends on. """
+
+    params = [(key, val) for key, val in parse_qsl(query.as_params()) if key not in ("from", "to")]
+    return query.cache_key(route, credential_scope(request), query.timerange, sorted(params), *parts)
+
+
+def response_ttl(query: Query):
+    """ Returns how long responses for query may be cached. """
+
+    if query.from_timestamp.startswith("now") or query.to_timestamp.startswith("now") or '_id' in query.args:
+        return RESPONSE_CACHE_RECENT_TTL_S
+    if parse_timestamp(query.to_timestamp) > time.time() - CLOSED_AFTER_S:
+        return RESPONSE_CACHE_RECENT_TTL_S
+    return RESPONSE_CACHE_CLOSED_TTL_S
+
+
+def is_closed(query: Query):
+    """ Returns whether the results of query cannot change anymore. """
+    try:
+        return response_ttl(query) == RESPONSE_CACHE_CLOSED_TTL_S
     except ValueError:
+        # timestamps only elasticsearch understands
+        return False
+
+
+async def cached_response(request: Request, route, key, trace):
+    """ Returns the cached body for key, or None if it is not cached or
+    the client asked for a fresh response (e.g. by reloading). """
+
+    if "no-cache" in request.headers.get("Cache-Control", ""):
+        metrics.RESPONSE_CACHE_REQUESTS.inc(route=route, result="bypass")
+        return None
+    with trace.stage("cache"):
+        body = await RESPONSE_CACHE.get(key)
+    metrics.RESPONSE_CACHE_REQUESTS.inc(route=route, result="miss" if body is None else "hit")
+    return body
+
+
+async def cache_response(key, query: Query, body: bytes):
+    await RESPONSE_CACHE.set(key, body, ttl=response_ttl(query))
+
+
+async def with_field_caps(es, request: Request, query: Query):
+    """ Returns query optimized for the field capabilities of its index.
+
+    The field capabilities are cached, they are only fetched if es is
+    given.  If they are not available, query is returned as is. """
+
+    key = (credential_scope(request), query.datacenter, query.index)
+    field_caps = await FIELD_CAPS_CACHE.get(key)
+    if field_caps is None and es is not None:
         try:
-            return time.mktime(time.strptime(timestamp, '%Y-%m-%d'))
-        except ValueError:
-            pass
+            async with admitted(query.datacenter, search_user(request), admission.INTERACTIVE):
+                field_caps = await mappings.fetch(es, query.index)
+            await FIELD_CAPS_CACHE.set(key, field_caps, ttl=FIELD_CAPS_TTL_S)
+        except (elasticsearch.TransportError, elasticsearch.ApiError, admission.Overloaded) as ex:
+            print(f"could not fetch field caps for '{query.index}':", ex)
 
-    raise ValueError(f"could not parse timestamp '{timestamp}'")
+    if field_caps is None:
+        return query
+    return query.with_field_caps(field_caps)
 
 
-async def aggregation_svg(es, request: Request, query: Query):
-    """ Execute aggregation query and render as an SVG. """
+async def fetch_top_terms(es, query: Query):
+    """ Returns the top terms for the aggregation of query over its whole time range. """
 
-    is_internal = "/logs" in request.headers.get('Referer', '')
-    width = query.args.pop('width', '100%' if is_internal else '1800')
-    width_scale = None
-    if width != '100%':
-        width_scale = tinygraph.Scale(100, (0, 100), (0, int(width)))
-    height = int(query.args.pop('height', '125' if is_internal else '600'))
+    es_query = query.to_elasticsearch(query.from_timestamp, num_results=0)
+    es_query["track_total_hits"] = False
+    es_query["aggs"] = query.sample_aggregations({"top_terms": query.top_terms_aggregation()})
+    resp = await es.search(index=query.index, body=es_query, request_timeout=query.timeout)
+    return [bucket['key'] for bucket in query.sampled_aggregations(resp['aggregations'])['top_terms']['buckets']]
 
-    logs_url = query.as_url('/logs')
 
-    from_time = parse_timestamp(query.from_timestamp)
-    to_time = parse_timestamp(query.to_timestamp)
-    scale = tinygraph.Scale(100, (from_time * 1000, to_time * 1000), (0, 100))
+def rollup_series_key(request: Request, query: Query, top_terms=None):
+    """ Identifies the histograms of query, independent of time range and interval. """
+    return query.cache_key(credential_scope(request), top_terms)
+
+
+def profile_summary(query: Query, responses):
+    """ Summarizes the profiles of the responses of searches for query. """
+    shards = [shard for resp in responses for shard in resp.get("profile", {}).get("shards", [])]
+    return profiling.summarize({"shards": shards}, dict(parse_qsl(query.as_params())))
+
+
+def split_for_request_cache(query: Query, interval_ms):
+    """ Splits query into one for the closed buckets and one for the
+    current bucket, which is still receiving data.
+
+    The query for the closed buckets uses absolute timestamps aligned to
+    the interval, so that it is the same for every refresh during the
+    current bucket and can be served from the elasticsearch request cache. """
+
+    from_ms = int(parse_timestamp(query.from_timestamp) * 1000) // interval_ms * interval_ms
+    to_ms = int(parse_timestamp(query.to_timestamp) * 1000)
+    current_ms = int(time.time() * 1000) // interval_ms * interval_ms
+
+    if to_ms <= current_ms:
+        if query.to_timestamp.startswith("now"):
+            to_ms = -(-to_ms // interval_ms) * interval_ms
+        return [query.with_timerange(str(from_ms), str(to_ms))]
+    if current_ms <= from_ms:
+        return [query]
+    return [query.with_timerange(str(from_ms), str(current_ms)),
+            query.with_timerange(str(current_ms), query.to_timestamp)]
+
+
+def histogram_interval(query: Query, from_time, to_time):
+    """ Returns the interval for histograms of query, as an
+    elasticsearch-style interval and in seconds. """
+
     interval = query.interval
     if interval == "auto":
         try:
-            interval_s = max(1, tinygraph.time_increment(from_time, to_time, 100))
+            interval_s = max(1, tinygraph.time_increment(from_time, to_time, query.resolution))
             interval = tinygraph.pretty_duration(interval_s)
         except ValueError as ex:
             raise ValueError("Could not guess interval: ", ex)
     else:
         interval_s = parse_offset(interval)
+    return interval, interval_s
 
-    es_query = query.to_elasticsearch(query.from_timestamp)
-    es_query["aggs"] = query.aggregation("num_results", interval)
-    resp = await es.search(index=query.index, body=es_query, request_timeout=query.timeout)
 
-    total_count = 0
-    max_count = 0
-    num_results_buckets = resp['aggregations']['num_results']['buckets']
-    for bucket in num_results_buckets:
-        total_count += bucket['doc_count']
-        max_count = max(max_count, bucket['doc_count'])
+async def aggregation_svg(es, request: Request, query: Query, trace=None):
+    """ Execute aggregation query and render as an SVG. """
+
+    trace = trace or tracing.disabled()
+    is_internal = "/logs" in request.headers.get('Referer', '')
+    width = query.width or ('100%' if is_internal else '1800')
+    height = int(query.height or ('125' if is_internal else '600'))
+
+    logs_url = query.as_url('/logs')
+
+    from_time = parse_timestamp(query.from_timestamp)
+    to_time = parse_timestamp(query.to_timestamp)
+    interval, interval_s = histogram_interval(query, from_time, to_time)
+
+    # find the top terms first, to only count those per bucket
+    top_terms = None
+    if query.aggregation_terms and query.aggregation_mode == "global":
+        async with admitted(query.datacenter, search_user(request), admission.HEAVY, trace):
+            with trace.stage("es_wait"):
+                top_terms = await fetch_top_terms(es, query)
+
+    # answer the closed part of the time range from stored rollups, and
+    # only query the part that is not stored yet
+    rollups = await get_rollups()
+    live_query = query
+    rollup_key = None
+    rollup_hist = None
+    interval_ms = interval_s * 1000
+    if rollups and interval_s >= ROLLUP_MIN_INTERVAL_S and not query.sample:
+        from_ms = int(from_time * 1000) // interval_ms * interval_ms
+        closed_ms = int(min(to_time, time.time() - CLOSED_AFTER_S) * 1000) // interval_ms * interval_ms
+        if closed_ms > from_ms:
+            rollup_key = rollup_series_key(request, query, top_terms)
+            live_from = from_ms
+            loaded = await asyncio.to_thread(rollups.load, rollup_key, interval_s, from_ms, closed_ms)
+            if loaded:
+                rollup_hist, live_from = loaded
+            live_query = query.with_timerange(str(live_from), query.to_timestamp)
+
+    # only the aggregations are needed, which allows elasticsearch to cache
+    # the results if request_cache is enabled
+    primary_queries = [live_query]
+    if query.request_cache:
+        primary_queries = split_for_request_cache(live_query, interval_ms)
+    primary_searches = []
+    for primary_query in primary_queries:
+        es_query = primary_query.to_elasticsearch(primary_query.from_timestamp, num_results=0)
+        es_query["aggs"] = primary_query.sample_aggregations(primary_query.aggregation("num_results", interval, top_terms))
+        header = {"index": query.index}
+        if query.request_cache:
+            header["request_cache"] = True
+        primary_searches.append((header, es_query))
+
+    # time-shifted histograms for comparison, fetched in the same request
+    # as the primary one if they are not cached already
+    overlays = {}
+    shifted_searches = {}
+    closed_before_ms = (time.time() - CLOSED_AFTER_S) * 1000
+    # overlays only show the number of results
+    count_query = query.counting()
+    for offset in query.compare:
+        offset_ms = parse_offset(offset) * 1000
+        # align with buckets to get the same time range on every refresh
+        shifted_from = (int(from_time * 1000) - offset_ms) // interval_ms * interval_ms
+        shifted_to = -(-(int(to_time * 1000) - offset_ms) // interval_ms) * interval_ms
+        shifted = count_query.with_timerange(str(shifted_from), str(shifted_to))
+        shifted_query = shifted.to_elasticsearch(shifted.from_timestamp, num_results=0)
+        shifted_query["aggs"] = shifted.sample_aggregations(shifted.aggregation("num_results", interval))
+
+        cache_key = count_query.cache_key(credential_scope(request), interval, shifted_from, shifted_to)
+        cached = await HISTOGRAM_CACHE.get(cache_key)
+        if cached:
+            overlays[offset] = cached
+        else:
+            shifted_searches[offset] = (shifted_query, cache_key, shifted_to <= closed_before_ms)
+
+    searches = primary_searches + [({"index": query.index}, shifted_query)
+                                   for shifted_query, _, _ in shifted_searches.values()]
+    async with admitted(query.datacenter, search_user(request), search_priority(query), trace):
+        with trace.stage("es_wait"):
+            responses = await msearch(es, searches, query.timeout)
+    primary_resps, shifted_resps = responses[:len(primary_searches)], responses[len(primary_searches):]
+    for resp in primary_resps:
+        if 'error' in resp:
+            raise Exception(f"search failed: {resp['error']}")
+    # incomplete histograms, e.g. of several datacenters or with failed
+    # shards, are neither cached nor stored
+    complete = all(is_complete(resp) for resp in primary_resps)
+    missing_datacenters = sorted({datacenter for resp in responses for datacenter in resp.get('missing_datacenters', {})})
+    for (offset, (_, cache_key, is_closed)), shifted_resp in zip(shifted_searches.items(), shifted_resps):
+        if 'error' in shifted_resp:
+            print(f"search for compare={offset} failed:", shifted_resp['error'])
+            continue
+        overlays[offset] = histogram.from_aggregations(query.sampled_aggregations(shifted_resp['aggregations']), interval_s)
+        # past buckets never change, so closed time ranges can be cached
+        # forever, unless their counts are incomplete
+        if is_closed and is_complete(shifted_resp) and not missing_datacenters:
+            await HISTOGRAM_CACHE.set(cache_key, overlays[offset])
+
+    parts = [histogram.from_aggregations(query.sampled_aggregations(resp['aggregations']), interval_s,
+                                         query.aggregation_terms, query.percentiles_terms,
+                                         top_terms=top_terms)
+             for resp in primary_resps]
+    hist = parts[0] if len(parts) == 1 else histogram.concat(parts, interval_s)
+    if rollup_key:
+        if closed_ms > live_from and complete and not missing_datacenters:
+            await asyncio.to_thread(rollups.store, rollup_key, interval_s, hist, live_from, closed_ms)
+        if rollup_hist:
+            hist = histogram.concat([rollup_hist, hist], interval_s)
+
+    # percentiles over the whole time range are only known if it was fetched at once
+    approximate_percentiles = False
+    if query.percentiles_terms and (rollup_hist or len(parts) > 1 or len(query.datacenters) > 1):
+        hist.total_percentiles = histogram.estimate_percentiles(hist)
+        approximate_percentiles = True
+    # counts of samples are scaled up by elasticsearch, they are estimates
+    approximate = "~" if query.sample else ""
 
     query_params = [('dc', query.datacenter), ('index', query.index)]
     query_params += query.args.items()
     query_params += [('from', query.from_timestamp), ('to', query.to_timestamp)]
     query_str = ", ".join([f"{item[0]}={item[1]}" for item in query_params])
 
-    # num_hits = resp['hits']['total']['value']
     avg_count = 0
-
-    if num_results_buckets:
-        avg_count = int(total_count / len(num_results_buckets))
-
-    bucket_width = scale.factor * interval_s * 1000
-
-    buckets = []
-
-    max_percentile = 0
-    percentile_lines = None
-    if query.percentiles_terms:
-        percentile_lines = {}
-        for bucket in num_results_buckets:
-            percentiles = bucket[query.percentiles_terms]['values']
-            for percentile in percentiles.keys():
-                percentile_lines[percentile] = ""
-            max_percentile = max(max_percentile or 0, percentiles[str(query.percentiles[-1])] or 0)
-
-    color_mapper = ColorMapper()
-    for idx, bucket in enumerate(num_results_buckets):
-        count = bucket['doc_count']
-        from_ts = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(bucket['key'] / 1000))
-        to_ts = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime((bucket['key'] + interval_s * 1000) / 1000))
-        label_align = "middle"
-        if idx / len(num_results_buckets) < 0.25:
-            label_align = "start"
-        elif idx / len(num_results_buckets) > (1 - 0.25):
-            label_align = "end"
-        bucket_data = {
-            "count": count,
-            "label": f"count: {count}",
-            "key": bucket['key_as_string'],
-            "label_y": "15%" if is_internal else "50%",
-            "label_align": label_align,
-            "height": max(0.25, int((count / max_count) * 100)) if count > 0 else 0,
-            "pos_x": scale.map(bucket['key']),
-            "from_ts": from_ts,
-            "to_ts": to_ts,
-            "logs_url": logs_url + f"&from={from_ts}&to={to_ts}",
-            "aggregation_terms": query.aggregation_terms,
-        }
-        if query.aggregation_terms:
-            offset_y = 100
-            sub_buckets = bucket[query.aggregation_terms]['buckets']
-            sub_buckets.sort(key=lambda bucket: bucket['key'])
-            bucket_data['sub_buckets'] = []
-            sub_sum = 0
-            for sub_bucket in sub_buckets:
-                sub_count = sub_bucket['doc_count']
-                sub_sum += sub_count
-                sub_percentage = (sub_count / count) * 100
-                sub_height = max(0.25, int((sub_count / max_count) * 100))
-                offset_y -= sub_height
-                bucket_data['sub_buckets'].append({
-                    'key': sub_bucket['key'],
-                    'count': sub_count,
-                    'percentage': f"{sub_percentage:.2f}%",
-                    'height': sub_height,
-                    'offset_y': offset_y,
-                    'color': color_mapper.to_color(sub_bucket['key']),
-                })
-
-            # add buckets for "non-aggregated" values (i.e. missing the field that is being aggregated on)
-            if sub_sum < count:
-                amount = count - sub_sum
-                bucket_data['sub_buckets'].insert(0, {
-                    'key': f"no value for {query.aggregation_terms}",
-                    'count': amount,
-                    'percentage': f"{(amount / max_count) * 100:.2f}%",
-                    'height': int((amount / max_count) * 100),
-                    'offset_y': offset_y - int((amount / max_count) * 100),
-                    'color': '#dddddd',
-                })
-
-        bucket_data['percentile_labels'] = []
-        if query.percentiles_terms:
-            percentiles = bucket[query.percentiles_terms]['values']
-            for val, key in percentiles.items():
-                bucket_data['percentile_labels'].append(f"p{int(float(val)) if float(val).is_integer() else val}: {key or 0:.2f}")
-
-            bucket_data['percentiles'] = []
-            scale_percentile = tinygraph.Scale(1000, (0, max_percentile), (0, 95))
-            for percentile, value in percentiles.items():
-                if not value:
-                    continue
-                pos_y = 100 - scale_percentile.map(value)
-                if width_scale:
-                    percentile_lines[percentile] += f" {width_scale.map(bucket_data['pos_x'] + bucket_width / 2)},{pos_y / 100 * height}"
-
-                percentile = float(percentile)
-                pretty_percentile = int(percentile) if percentile.is_integer() else percentile
-                bucket_data['percentiles'].append({
-                    'pos_y': pos_y,
-                    'name': pretty_percentile,
-                    'value': value,
-                })
-
-        buckets.append(bucket_data)
+    if hist.counts:
+        avg_count = int(hist.total_count / len(hist.counts))
 
     query_title = ""
     if not is_internal:
         query_title += query_str + "\n"
 
-    query_title += f"count per {interval}: max: {max_count}, avg: {avg_count}"
+    query_title += f"count per {interval}: max: {approximate}{hist.max_count}, avg: {approximate}{avg_count}"
+    if query.sample:
+        query_title += f" (estimated from a {query.sample:.2%} sample)"
+    if missing_datacenters:
+        query_title += f" (without {', '.join(missing_datacenters)})"
 
-    if query.percentiles_terms:
-        percentiles = resp["aggregations"][query.percentiles_terms]["values"]
-        query_title += " ("
+    if hist.total_percentiles:
         ps = []
-        for p, val in percentiles.items():
-            val = int(val) if val.is_integer() else '{:.2f}'.format(val)
-            ps.append(f"p{int(float(p)) if float(p).is_integer() else p}: {val}")
-        query_title += ", ".join(ps)
-        query_title += ")"
-
-    template = Template(r"""<?xml version="1.0" encoding="UTF-8"?>
-<svg xmlns="http://www.w3.org/2000/svg" class="chart" width="{{ width }}" height="{{ height }}" xmlns:xlink="http://www.w3.org/1999/xlink">
-
-<title id="title">Aggregation for query: {{ query_str | e }}</title>
-<style>
-svg {
-    font-family: monospace;
-}
-
-rect {
-    fill-opacity: 0.5;
-    stroke-width: 1px;
-}
-
-g.tooltip text {
-    display: none;
-}
-
-g.tooltip:hover text {
-    display: block;
-    background-color: rgba(1, 1, 1, 0.3);
-}
-
-g.tooltip text {
-    pointer-events: none;
-}
-</style>
-
-<text x="10" y="14">{{ query_title | e }}</text>
-
-<g class="buckets">
-{% for bucket in buckets %}
-<g class="bucket">
-{% if bucket.aggregation_terms %}
-{% for sub_bucket in bucket.sub_buckets %}
-    <rect fill="{{ sub_bucket.color }}" stroke="{{ sub_bucket.color }}" width="{{ bucket_width }}%" height="{{ sub_bucket.height }}%" y="{{ sub_bucket.offset_y }}%" x="{{ bucket.pos_x }}%"></rect>
-{% endfor %}
-{% else %}
-    <rect fill="#00b2a5" stroke="#00b2a5" width="{{ bucket_width }}%" height="{{ bucket.height }}%" y="{{ 100-bucket.height }}%" x="{{ bucket.pos_x }}%"></rect>
-{% endif %}
-{% for percentile in bucket.percentiles %}
-    <line stroke="black" x1="{{ bucket.pos_x }}%" x2="{{ bucket.pos_x + bucket_width }}%"
-        y1="{{ percentile.pos_y }}%" y2="{{ percentile.pos_y }}%" />
-{% endfor %}
-</g>
-{% endfor %}
-</g>
-
-{% if percentile_lines %}
-    <polyline id="percentile" fill="none" stroke="rgba(100, 100, 100, 0.7)" points="{{ percentile_lines[list(percentile_lines.keys())[-1]] }}" />
-{% endif %}
-
-<!-- tooltips need to be drawn after buckets to be own top ("implied" z-index for svg) -->
-{% for bucket in buckets %}
-<g class="bucket tooltip">
-    <a target="_parent" alt="Logs from {{ bucket.from_ts }} to {{ bucket.to_ts }}" xlink:href="{{ bucket.logs_url | e }}">
-    <rect fill="transparent" stroke="transparent" width="{{ bucket_width }}%" height="100%" y="0%" x="{{ bucket.pos_x }}%"></rect>
-    </a>
-
-    <text x="{{ bucket.pos_x }}%" y="{{ bucket.label_y }}" text-anchor="{{ bucket.label_align }}">
-        <tspan x="{{ bucket.pos_x }}%" dy="1.5em">{{ bucket.key | e }}</tspan>
-        <tspan x="{{ bucket.pos_x }}%" dy="1.2em">{{ bucket.label | e }}</tspan>
-        {% for sub_bucket in (bucket.sub_buckets | sort(attribute='count') | reverse) %}
-        <tspan x="{{ bucket.pos_x }}%" dy="1.2em">{{ sub_bucket.key | e }}: {{ sub_bucket.count }} ({{ sub_bucket.percentage }})</tspan>
-        {% endfor %}
-        {% if bucket.percentile_labels %}
-        <tspan x="{{ bucket.pos_x }}%" dy="1.2em">&#160;</tspan>
-        {% for percentile_label in bucket.percentile_labels %}
-        <tspan x="{{ bucket.pos_x }}%" dy="1.2em">{{ percentile_label }}</tspan>
-        {% endfor %}
-        {% endif %}
-    </text>
-</g>
-{% endfor %}
-
-<script>
-let dimensions = document.getRootNode().firstChild.getClientRects()[0];
-// mark first bucket as incomplete if it is outside of the document
-document.querySelectorAll("svg .buckets g.bucket:first-of-type rect").forEach((b) => {
-    if (b.getClientRects()[0].left &lt; dimensions.left) {
-        b.style.fillOpacity = 0.2;
-        b.style.strokeOpacity = 0.2;
-    }
-});
-
-// mark last bucket as incomplete if it is outside of the document
-document.querySelectorAll("svg .buckets g.bucket:last-of-type rect").forEach((b) => {
-    if (b.getClientRects()[0].right &gt; dimensions.right) {
-        b.style.fillOpacity = 0.2;
-        b.style.strokeOpacity = 0.2;
-    }
-});
-
-</script>
-</svg>
-""")
-    return Response(content=template.render(list=list, width=width, height=height, query_title=query_title, bucket_width=bucket_width, buckets=buckets, percentile_lines=percentile_lines), media_type="image/svg+xml")
+        for p, val in hist.total_percentiles.items():
+            val = int(val or 0) if (val or 0).is_integer() else '{:.2f}'.format(val)
+            ps.append(f"{'~' if approximate_percentiles or query.sample else ''}p{histogram.pretty_percentile(p)}: {val}")
+        query_title += " (" + ", ".join(ps) + ")"
+
+    profile_lines = []
+    if query.profile:
+        summary = profile_summary(query, primary_resps)
+        profile_lines.append(f"profile: {summary.total_ms:.1f} ms on {len(summary.shards)} shards")
+        for clause in summary.worst():
+            param = f" ({clause.param})" if clause.param else ""
+            profile_lines.append(f"{clause.time_ms:.1f} ms: {clause.type} {clause.description[:80]}{param}")
+
+    with trace.stage("render"):
+        svg = histogram.render_svg(hist, int(from_time * 1000), int(to_time * 1000), width, height, logs_url,
+                                   query_str=query_str, query_title=query_title,
+                                   label_y="15%" if is_internal else "50%",
+                                   no_value_label=f"no value for {query.aggregation_terms}",
+                                   overlays=[(f"{offset} ago", overlays[offset], parse_offset(offset) * 1000)
+                                             for offset in query.compare if offset in overlays],
+                                   profile_lines=profile_lines)
+    headers = {}
+    if missing_datacenters:
+        headers["X-Missing-Datacenters"] = ",".join(missing_datacenters)
+    # e.g. so that the response is not cached
+    if not all('error' not in resp and is_complete(resp) for resp in responses):
+        headers["X-Incomplete-Results"] = "true"
+    return Response(content=svg, media_type="image/svg+xml", headers=headers)
 
 
 @app.get('/aggregation.svg')
 async def serve_aggregation(request: Request):
     """ Serve aggregation view. """
 
-    es_client, resp = await es_client_from(request)
+    trace = tracing.start("aggregation")
+    with trace.stage("client"):
+        es_client, resp = await es_client_from(request)
     if resp:
         return resp
 
-    query = from_request(await get_config(), request)
     try:
-        return await aggregation_svg(es_client, request, query)
+        with trace.stage("build"):
+            query = from_request(await get_config(), request)
+            query = await with_field_caps(es_client, request, query)
+            is_internal = "/logs" in request.headers.get('Referer', '')
+            cache_key = response_cache_key("aggregation.svg", request, query, query.width, query.height, is_internal)
+        # profiles are about this particular search, they are not cached
+        svg = await cached_response(request, "aggregation.svg", cache_key, trace) if not query.profile else None
+        if svg is not None:
+            return Response(content=svg, media_type="image/svg+xml", headers={"X-Cache": "hit", **trace.headers()})
+
+        resp = await aggregation_svg(es_client, request, query, trace)
+        # incomplete histograms are not cached, they might be complete next time
+        if not query.profile and "X-Incomplete-Results" not in resp.headers:
+            await cache_response(cache_key, query, resp.body)
+        resp.headers.update({"X-Cache": "miss", **trace.headers()})
+        return resp
     except Exception as ex:
         traceback.print_exception(type(ex), ex, ex.__traceback__)
         return Response(status_code=200, media_type="image/svg+xml", content=f"""<?xml version="1.0" encoding="UTF-8"?>
@@ -564,58 +952,109 @@ async def serve_aggregation(request: Request):
 <text x="10" y="14" stroke="red">{escape(type(ex).__name__)}: {escape(ex)}</text>
 </svg>
 """)
+    finally:
+        trace.end()
 
 
 @app.get('/raw')
 async def serve_raw(request: Request):
     """ Serve raw query result from elasticsearch. """
 
-    es_client, resp = await es_client_from(request)
+    trace = tracing.start("raw")
+    with trace.stage("client"):
+        es_client, resp = await es_client_from(request)
     if resp:
         return resp
 
-    query = from_request(await get_config(), request)
-    es_query = to_raw_es_query(query)
-
-    resp = await es_client.search(index=query.index, body=es_query, request_timeout=query.timeout)
+    with trace.stage("build"):
+        query = from_request(await get_config(), request)
+        try:
+            query = await with_field_caps(es_client, request, query)
+        except ValueError as ex:
+            return Response(status_code=400, content=str(ex))
+        es_query = to_raw_es_query(query)
+        cache_key = response_cache_key("raw", request, query, query.max_results)
 
     headers = {"Access-Control-Allow-Origin": "*"}
-    return Response(json.dumps(dict(resp), indent=2), headers=headers, media_type="application/json")
+    # profiles are about this particular search, they are not cached
+    content = await cached_response(request, "raw", cache_key, trace) if not query.profile else None
+    if content is not None:
+        trace.end()
+        return Response(content, headers={**headers, "X-Cache": "hit", **trace.headers()},
+                        media_type="application/json")
+
+    try:
+        async with admitted(query.datacenter, search_user(request), search_priority(query), trace):
+            start = time.time()
+            with trace.stage("es_wait"):
+                resp = dict(await es_client.search(index=query.index, body=es_query, request_timeout=query.timeout))
+    except admission.Overloaded as ex:
+        return Response(status_code=503, content=str(ex), headers={"Retry-After": "1"})
+    metrics.observe_search("raw", resp['took'], time.time() - start)
+    trace.add("es", resp['took'] / 1000)
+    if query.profile:
+        resp["profile_summary"] = profile_summary(query, [resp]).to_json()
+
+    with trace.stage("render"):
+        content = json.dumps(resp, indent=2).encode("utf-8")
+    # incomplete results are not cached, they might be complete next time
+    if not query.profile and is_complete(resp):
+        await cache_response(cache_key, query, content)
+    trace.end()
+
+    headers.update({"X-Cache": "miss", **trace.headers()})
+    return Response(content, headers=headers, media_type="application/json")
 
 
 @app.get('/query')
 async def serve_query(request: Request):
     """ Return the query that would be sent to elasticsearch. """
 
-    query = from_request(await get_config(), request)
-    es_query = to_raw_es_query(query)
+    trace = tracing.start("query")
+    with trace.stage("build"):
+        query = from_request(await get_config(), request)
+        try:
+            # there is no client here, use the field caps only if they are known already
+            query = await with_field_caps(None, request, query)
+        except ValueError as ex:
+            return Response(status_code=400, content=str(ex))
+        cache_key = response_cache_key("query", request, query, query.max_results)
+
+    content = await cached_response(request, "query", cache_key, trace)
+    cache_status = "hit"
+    if content is None:
+        cache_status = "miss"
+        with trace.stage("render"):
+            content = json.dumps(to_raw_es_query(query), indent=2).encode("utf-8")
+        await cache_response(cache_key, query, content)
+    trace.end()
 
-    headers = {"Access-Control-Allow-Origin": "*"}
-    return Response(json.dumps(es_query, indent=2), headers=headers, media_type="application/json")
+    headers = {"Access-Control-Allow-Origin": "*", "X-Cache": cache_status, **trace.headers()}
+    return Response(content, headers=headers, media_type="application/json")
 
 
 @app.get('/kibana')
-def serve_kibana(request: Request):
+async def serve_kibana(request: Request):
     """ Parse a Kibana url and redirect to the es-stream-logs version. """
 
-    kibana_url = request.args.get('url', None)
+    kibana_url = request.query_params.get('url', None)
     if not kibana_url:
         return Response(status_code=400, content="missing url parameter")
 
     # guess dc from url
     dc = None
     kibana_base = urlparse(kibana_url).netloc
-    for config_dc in CONFIG.endpoints:
+    for config_dc in (await get_config()).endpoints:
         if config_dc in kibana_base:
             dc = config_dc
             break
     if not dc:
-        dc = request.args.get('dc', None)
+        dc = request.query_params.get('dc', None)
     if not dc:
         return Response(status_code=400, content="missing dc parameter")
 
     try:
-        query = kibana.parse(kibana_url)
+        query = await kibana.parse_async(kibana_url, await get_http_session())
     except Exception as ex:
         return Response(status_code=400, content=f"could not parse kibana url: {ex}")
 
@@ -623,21 +1062,19 @@ def serve_kibana(request: Request):
 
 
 def to_raw_es_query(query):
-    es_query = query.to_elasticsearch(query.from_timestamp, query.max_results)
-    if query.aggregation_terms or query.percentiles_terms:
-        from_time = parse_timestamp(query.from_timestamp)
-        to_time = parse_timestamp(query.to_timestamp)
-        interval = query.interval
-        if interval == "auto":
-            try:
-                interval_s = max(1, tinygraph.time_increment(from_time, to_time, 100))
-                interval = tinygraph.pretty_duration(interval_s)
-            except ValueError as ex:
-                raise ValueError("Could not guess interval: ", ex)
-        else:
-            interval_s = parse_offset(interval)
-
-        es_query["aggs"] = query.aggregation("num_results", interval)
+    if not (query.aggregation_terms or query.percentiles_terms):
+        return query.to_elasticsearch(query.from_timestamp, query.max_results)
+
+    # the aggregations are sampled by the random sampler, the sample of
+    # the results must only filter the hits
+    es_query = query.to_elasticsearch(query.from_timestamp, num_results=0)
+    es_query["size"] = query.max_results
+    if query.sample and query.max_results:
+        es_query["post_filter"] = query.sample_filter()
+    from_time = parse_timestamp(query.from_timestamp)
+    to_time = parse_timestamp(query.to_timestamp)
+    interval, _ = histogram_interval(query, from_time, to_time)
+    es_query["aggs"] = query.sample_aggregations(query.aggregation("num_results", interval))
 
     return es_query
 
@@ -659,6 +1096,27 @@ def parse_doc_timestamp(timestamp: str):
     return parsed
 
 
+def parse_iso8601_ms(timestamp: str):
+    """ Parse an ISO-8601 timestamp, e.g. 2021-11-01T13:49:51.123+01:00,
+    into epoch millis.  Timestamps without timezone are in UTC and digits
+    beyond microseconds are ignored. """
+
+    parsed = datetime.fromisoformat(timestamp)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def hit_timestamp_ms(hit):
+    """ Returns the timestamp of a search hit in epoch millis, from its sort
+    values if present and from its @timestamp otherwise. """
+
+    sort = hit.get('sort')
+    if sort and isinstance(sort[0], int):
+        return sort[0]
+    return parse_iso8601_ms(hit['_source']['@timestamp'])
+
+
 def remove_prefix(text, prefix):
     """ Remove prefix from text if present. """
     if text.startswith(prefix):
@@ -684,115 +1142,424 @@ def collect_fields(cfg, fields, **kwargs):
     return fields
 
 
-async def stream_logs(es, renderer, query: Query):
-    """ Contruct query and stream logs given the elasticsearch client and parameters. """
+class ClientDisconnected(Exception):
+    """ Raised if the client disconnected while waiting for elasticsearch. """
+
+
+async def unless_disconnected(coro, disconnected: asyncio.Event = None):
+    """ Returns the result of coro, or cancels it and raises
+    ClientDisconnected if disconnected is set before it is done. """
+
+    if disconnected is None:
+        return await coro
 
+    task = asyncio.ensure_future(coro)
+    waiter = asyncio.ensure_future(disconnected.wait())
+    try:
+        await asyncio.wait([task, waiter], return_when=asyncio.FIRST_COMPLETED)
+        if not task.done():
+            raise ClientDisconnected()
+    finally:
+        # also if this is cancelled, e.g. on shutdown, which goes on
+        waiter.cancel()
+        if not task.done():
+            # closes the connection, which makes elasticsearch cancel the search
+            task.cancel()
+            await asyncio.wait([task])
+    return task.result()
+
+
+async def wait_disconnected(disconnected: asyncio.Event, timeout_s):
+    """ Waits for timeout_s, returns early with True if the client disconnected. """
+
+    if disconnected is None:
+        await asyncio.sleep(timeout_s)
+        return False
+    try:
+        await asyncio.wait_for(disconnected.wait(), timeout_s)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+def more_results_warning(query: Query, results_total):
+    return f"""Warning: More than {query.max_results} results (of {results_total} total),
+use &max_results=N or &max_results=all to see more results."""
+
+
+def advance_cursor(query: Query, cursor, timestamp):
+    """ Returns the timestamp to continue searching from after a result
+    at timestamp, cursor is the one before (a string at the start). """
+
+    if isinstance(cursor, str):
+        return timestamp
+    return max(timestamp, cursor) if query.sort == "asc" else min(timestamp, cursor)
+
+
+def estimated_total(query: Query, results_total):
+    """ Returns the estimated number of results of all documents if query is sampled, otherwise None. """
+    return round(results_total / query.sample) if query.sample else None
+
+
+def encode_cursor(timestamp_ms, ids):
+    """ Encodes where a page of results ended, as the timestamp of its
+    last result and the ids of the results at that timestamp, which the
+    next page skips. """
+
+    return base64.urlsafe_b64encode(json.dumps([timestamp_ms, ids]).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """ Returns the (timestamp_ms, ids) of cursor, raises ValueError if it is invalid. """
+
+    try:
+        timestamp_ms, ids = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError(f"invalid cursor '{cursor}'")
+    if not isinstance(timestamp_ms, int) or not isinstance(ids, list) or not all(isinstance(_id, str) for _id in ids):
+        raise ValueError(f"invalid cursor '{cursor}'")
+    return timestamp_ms, ids
+
+
+def more_url(query: Query, timestamp_ms, ids):
+    """ Returns the url of the next page of results, after the results
+    at timestamp_ms with the given ids, see serve_more. """
+
+    # relative time ranges would move between pages
+    from_timestamp, to_timestamp = query.from_timestamp, query.to_timestamp
+    if from_timestamp.startswith("now"):
+        from_timestamp = str(int(parse_timestamp(from_timestamp) * 1000))
+    if to_timestamp.startswith("now"):
+        to_timestamp = str(int(parse_timestamp(to_timestamp) * 1000))
+    params = {"max_results": query.max_results, "after": encode_cursor(timestamp_ms, ids)}
+    return query.with_timerange(from_timestamp, to_timestamp).as_url('/logs/more') + "&" + urlencode(params)
+
+
+async def stream_logs(es, renderer, query: Query, trace=None, user="", disconnected: asyncio.Event = None,
+                      max_lifetime_s=0, max_idle_s=0, results_spool: spool.Spool = None, spool_key=None, after=None):
+    """ Contruct query and stream logs given the elasticsearch client and parameters.
+
+    The timing of trace is sent after the first results and at the end.
+    Searches wait for a free slot, polls for new results of live tails
+    first, see admitted.  Once disconnected is set, the search in flight
+    is cancelled and the stream ends.  Live tails end after
+    max_lifetime_s, or if there were no new results for max_idle_s.
+
+    If results_spool is given, the hits are spooled as spool_key once the
+    stream completed, see spool.py.  The writer is only created once
+    results are streamed.
+
+    after is the (timestamp_ms, ids) of the last results of a page that
+    was shown already, only the results after them are streamed.  If there
+    are more than max_results, the warning links to the next page. """
+
+    trace = trace or tracing.disabled()
+    is_live = query.sort == "asc" and query.to_timestamp == "now"
+    started_at = last_result_at = time.monotonic()
     last_timestamp = query.from_timestamp
     seen = {}
+    # timestamp and ids of the last results, where the next page starts
+    page_end = (None, [])
+    if after:
+        after_timestamp, after_ids = after
+        # descending searches are for results before last_timestamp
+        last_timestamp = after_timestamp if query.sort == "asc" else after_timestamp + 1
+        seen = dict.fromkeys(after_ids, True)
+        page_end = (after_timestamp, list(after_ids))
+    # datacenters searched at once continue from their own last results,
+    # so that a missing one neither loses results nor holds back the others
+    datacenter_cursors = None
+    if isinstance(es, fanout.FanOutClient):
+        datacenter_cursors = dict.fromkeys(es.clients, last_timestamp)
+    missing_datacenters = {}
+
+    async def open_spool_writer():
+        nonlocal spool_writer
+        if spool_writer is None:
+            spool_writer = await asyncio.to_thread(results_spool.writer, spool_key)
+        return spool_writer
+
+    spool_results = results_spool is not None
+    spool_writer = None
+    try:
+        yield renderer.start()
 
-    yield renderer.start()
-
-    query_count = 0
-    results_count = 0
-    results_total = 0
-    while True:
-        try:
-            query_count += 1
-            es_query = query.to_elasticsearch(last_timestamp)
-            query_start = time.time()
-            resp = await es.search(index=query.index, body=es_query, request_timeout=query.timeout)
-            took_ms = int((time.time() - query_start) * 1000)
-            if query_count == 1:
-                results_total = resp['hits']['total']['value']
-                took_es_ms = resp['took']
-                yield renderer.num_results(results_total, took_ms, took_es_ms)
-        except elasticsearch.ConnectionTimeout as ex:
-            print(ex)
-            yield renderer.error(ex, es_query)
-            await asyncio.sleep(1)
-            continue
-        except (elasticsearch.TransportError, elasticsearch.ApiError) as ex:
-            print(ex)
-            yield renderer.error(ex, es_query)
-            return
-
-        if resp['_shards']['failed']:
-            print("shard failures:", resp['_shards']['failures'])
-            shard_msg = resp['_shards']['failures'][0]
-            yield renderer.error(f"Error: {resp['_shards']['failed']} shards failed: First error: {shard_msg}", es_query)
-            return
-
-        if query_count <= 1 and not resp['hits']['hits']:
-            yield renderer.warning("Warning: No results matching query (Check details for query)",
-                                   es_query)
-            await asyncio.sleep(1)
-            continue
+        query_count = 0
+        results_count = 0
+        results_total = 0
+        while True:
+            try:
+                query_count += 1
+                with trace.stage("build"):
+                    es_query = query.to_elasticsearch(last_timestamp)
+                    search_kwargs = {}
+                    if datacenter_cursors:
+                        search_kwargs["bodies"] = {datacenter: query.to_elasticsearch(cursor)
+                                                   for datacenter, cursor in datacenter_cursors.items()}
+                    if query_count > 1:
+                        # only the first search is profiled, later ones only poll for new results
+                        for body in [es_query, *search_kwargs.get("bodies", {}).values()]:
+                            body.pop("profile", None)
+                priority = admission.TAIL if is_live and query_count > 1 else search_priority(query)
+
+                async def search():
+                    async with admitted(query.datacenter, user, priority, trace) as waited_s:
+                        metrics.POLLS.inc()
+                        with trace.stage("es_wait"):
+                            return waited_s, await es.search(index=query.index, body=es_query,
+                                                             request_timeout=query.timeout, **search_kwargs)
+
+                query_start = time.time()
+                waited_s, resp = await unless_disconnected(search(), disconnected)
+                if waited_s >= QUEUE_NOTICE_S:
+                    yield renderer.queued(waited_s, es_query)
+                took_ms = int((time.time() - query_start - waited_s) * 1000)
+                metrics.observe_search("logs", resp['took'], time.time() - query_start - waited_s)
+                trace.add("es", resp['took'] / 1000)
+                if query_count == 1:
+                    results_total = resp['hits']['total']['value']
+                    took_es_ms = resp['took']
+                    yield renderer.num_results(results_total, took_ms, took_es_ms, estimated_total(query, results_total))
+                    if query.profile:
+                        yield renderer.profile(profile_summary(query, [resp]))
+            except ClientDisconnected:
+                return
+            except elasticsearch.ConnectionTimeout as ex:
+                print(ex)
+                yield renderer.error(ex, es_query)
+                if await wait_disconnected(disconnected, 1):
+                    return
+                continue
+            except admission.Overloaded as ex:
+                if priority == admission.TAIL:
+                    # try again with the next poll
+                    if await wait_disconnected(disconnected, 1):
+                        return
+                    continue
+                yield renderer.error(ex, es_query)
+                return
+            except (elasticsearch.TransportError, elasticsearch.ApiError) as ex:
+                print(ex)
+                yield renderer.error(ex, es_query)
+                return
 
-        all_hits_seen = True
-        last_seen = {}
-        i = 0
-        for hit in resp['hits']['hits']:
+            if resp['_shards']['failed']:
+                print("shard failures:", resp['_shards']['failures'])
+                shard_msg = resp['_shards']['failures'][0]
+                yield renderer.error(f"Error: {resp['_shards']['failed']} shards failed: First error: {shard_msg}", es_query)
+                return
 
-            i += 1
-            source = hit['_source']
-            _id = hit['_id']
-            last_seen[_id] = True
-            if _id in seen:
+            # searches over several datacenters continue without the ones that are slow or fail
+            if resp.get('missing_datacenters', {}).keys() != missing_datacenters.keys():
+                missing_datacenters = resp.get('missing_datacenters', {})
+                for datacenter, reason in missing_datacenters.items():
+                    yield renderer.warning(f"Warning: Results of {datacenter} are missing: {reason}", es_query)
+                if missing_datacenters and spool_results:
+                    # incomplete results must not be rendered again
+                    spool_results = False
+                    if spool_writer:
+                        await asyncio.to_thread(spool_writer.discard)
+
+            if query_count <= 1 and not resp['hits']['hits']:
+                yield renderer.warning("Warning: No results matching query (Check details for query)",
+                                       es_query)
+                if await wait_disconnected(disconnected, 1):
+                    return
                 continue
 
-            all_hits_seen = False
-            yield "\n"
+            all_hits_seen = True
+            last_seen = {}
+            i = 0
+            for hit in resp['hits']['hits']:
+
+                i += 1
+                source = hit['_source']
+                if '_datacenter' in hit:
+                    source['_datacenter'] = hit['_datacenter']
+                _id = hit['_id']
+                last_seen[_id] = hit.get('_datacenter', True)
+                if _id in seen:
+                    continue
 
-            results_count += 1
-            if query.max_results != "all" and results_count > query.max_results:
-                msg = f"""Warning: More than {query.max_results} results (of {results_total} total),
-use &max_results=N or &max_results=all to see more results."""
-                yield renderer.warning(msg, es_query)
+                all_hits_seen = False
+                yield "\n"
+
+                results_count += 1
+                if query.max_results != "all" and results_count > query.max_results:
+                    if spool_results:
+                        await asyncio.to_thread((await open_spool_writer()).finish, results_total, True)
+                    yield renderer.warning(more_results_warning(query, results_total), es_query,
+                                           more_url=more_url(query, *page_end) if page_end[0] is not None else None)
+                    yield renderer.timing(trace.server_timing())
+                    yield renderer.end()
+                    return
+
+                timestamp = hit_timestamp_ms(hit)
+                if timestamp != page_end[0]:
+                    page_end = (timestamp, [])
+                page_end[1].append(_id)
+                last_timestamp = advance_cursor(query, last_timestamp, timestamp)
+                if datacenter_cursors and '_datacenter' in hit:
+                    datacenter_cursors[hit['_datacenter']] = advance_cursor(query, datacenter_cursors[hit['_datacenter']],
+                                                                            timestamp)
+
+                if spool_results:
+                    with trace.stage("spool"):
+                        spool_writer = await open_spool_writer()
+                        spool_writer.append({key: hit[key] for key in ('_index', '_id', '_source', 'sort', '_datacenter')
+                                             if key in hit})
+                        if spool_writer.should_flush():
+                            await asyncio.to_thread(spool_writer.flush)
+                if query.fields:
+                    with trace.stage("project"):
+                        source = filter_dict(source, query.fields)
+                metrics.ROWS_STREAMED.inc(renderer=type(renderer).__name__)
+                with trace.stage("render"):
+                    rendered = renderer.result(hit, source)
+                yield rendered
+
+            # missing datacenters are searched from their cursor again, their
+            # results there were seen in an earlier response
+            seen = {**{_id: datacenter for _id, datacenter in seen.items() if datacenter in missing_datacenters},
+                    **last_seen}
+
+            if (query.sort == "desc" or query.to_timestamp != 'now') and all_hits_seen:
+                if spool_results:
+                    await asyncio.to_thread((await open_spool_writer()).finish, results_total, False)
+                yield renderer.timing(trace.server_timing())
                 yield renderer.end()
                 return
 
-            timestamp = int(parse_doc_timestamp(hit['_source']['@timestamp']).timestamp() * 1000)
-            if isinstance(last_timestamp, str):
-                last_timestamp = timestamp
-            else:
-                if query.sort == "asc":
-                    last_timestamp = max(timestamp, last_timestamp)
-                else:  # desc
-                    last_timestamp = min(timestamp, last_timestamp)
+            # query for a single document, can only have one result, no need to wait for more
+            if '_id' in query.args:
+                yield renderer.timing(trace.server_timing())
+                yield renderer.end()
+                return
 
-            if query.fields:
-                source = filter_dict(source, query.fields)
-            yield renderer.result(hit, source)
+            if query_count == 1:
+                yield renderer.timing(trace.server_timing())
+
+            now = time.monotonic()
+            if not all_hits_seen:
+                last_result_at = now
+            limit_msg = None
+            if is_live and max_lifetime_s and now - started_at > max_lifetime_s:
+                limit_msg = f"Stopped following new results after {tinygraph.pretty_duration(max_lifetime_s)}."
+            elif is_live and max_idle_s and now - last_result_at > max_idle_s:
+                limit_msg = f"Stopped following new results, there were none for {tinygraph.pretty_duration(max_idle_s)}."
+            if limit_msg:
+                yield renderer.warning(f"{limit_msg} Reload to continue.", es_query)
+                yield renderer.timing(trace.server_timing())
+                yield renderer.end()
+                return
 
-        seen = last_seen
+            # print space to try and keep connection open
+            yield " "
 
-        if (query.sort == "desc" or query.to_timestamp != 'now') and all_hits_seen:
-            yield renderer.end()
-            return
+            if await wait_disconnected(disconnected, 1):
+                return
+    finally:
+        # unless it was finished, e.g. if the client disconnected
+        if spool_writer:
+            await asyncio.to_thread(spool_writer.discard)
 
-        # query for a single document, can only have one result, no need to wait for more
-        if '_id' in query.args:
-            yield renderer.end()
-            return
 
-        # print space to try and keep connection open
-        yield " "
+def spooled_position(spooled: spool.SpooledResults, query: Query, after):
+    """ Returns the position of the first result in spooled after the
+    cursor after, see decode_cursor. """
 
-        await asyncio.sleep(1)
+    timestamp_ms, ids = after
+    if query.sort == "asc":
+        position = bisect.bisect_left(spooled, timestamp_ms, key=hit_timestamp_ms)
+    else:
+        position = bisect.bisect_left(spooled, -timestamp_ms, key=lambda hit: -hit_timestamp_ms(hit))
+    # the results at the timestamp of the cursor that were shown come first
+    ids = set(ids)
+    while position < len(spooled) and spooled[position]['_id'] in ids \
+            and hit_timestamp_ms(spooled[position]) == timestamp_ms:
+        position += 1
+    return position
 
 
-@app.get('/logs')
-async def serve_logs(request: Request):
-    """ Serve logs. """
-    es_client, resp = await es_client_from(request)
-    if resp:
-        return resp
+async def stream_spooled(spooled: spool.SpooledResults, renderer, query: Query, trace=None, start=0):
+    """ Streams the results of a search from the spool, like stream_logs,
+    starting at position start, see spooled_position. """
 
-    headers = {}
+    trace = trace or tracing.disabled()
+    try:
+        yield renderer.start()
+        yield renderer.num_results(spooled.results_total, 0, 0, estimated_total(query, spooled.results_total))
+        end = len(spooled) if query.max_results == "all" else min(len(spooled), start + query.max_results)
+        for idx in range(start, end):
+            yield "\n"
+            with trace.stage("spool"):
+                hit = spooled[idx]
+            source = hit['_source']
+            if '_datacenter' in hit:
+                source['_datacenter'] = hit['_datacenter']
+            if query.fields:
+                with trace.stage("project"):
+                    source = filter_dict(source, query.fields)
+            metrics.ROWS_STREAMED.inc(renderer=type(renderer).__name__)
+            with trace.stage("render"):
+                rendered = renderer.result(hit, source)
+            yield rendered
+        if end > start and (end < len(spooled) or spooled.more):
+            # the next page starts after the last results shown
+            last = end - 1
+            timestamp = hit_timestamp_ms(spooled[last])
+            ids = []
+            while last >= 0 and hit_timestamp_ms(spooled[last]) == timestamp:
+                ids.append(spooled[last]['_id'])
+                last -= 1
+            yield renderer.warning(more_results_warning(query, spooled.results_total),
+                                   query.to_elasticsearch(query.from_timestamp),
+                                   more_url=more_url(query, timestamp, ids))
+        yield renderer.timing(trace.server_timing())
+        yield renderer.end()
+    finally:
+        spooled.close()
+
+
+async def watch_disconnect(request: Request, stream, disconnected: asyncio.Event):
+    """ Passes on stream, setting disconnected as soon as the client
+    disconnects instead of noticing it when sending the next chunk. """
+
+    async def watch():
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+        disconnected.set()
 
-    config = await get_config()
-    query = from_request(config, request)
+    watcher = asyncio.create_task(watch())
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        watcher.cancel()
+        await stream.aclose()
 
+
+async def metered(stream, renderer_name, trace=None):
+    """ Counts the bytes sent by stream and tracks it as active while it
+    is running.  The time spent sending is added to trace. """
+
+    trace = trace or tracing.disabled()
+    metrics.ACTIVE_STREAMS.inc()
+    try:
+        async for chunk in stream:
+            size = len(chunk) if chunk.isascii() else len(chunk.encode("utf-8"))
+            metrics.BYTES_STREAMED.inc(size, renderer=renderer_name)
+            with trace.stage("send"):
+                yield chunk
+    finally:
+        metrics.ACTIVE_STREAMS.dec()
+        trace.end()
+
+
+def renderer_for(request: Request, config, query: Query):
+    """ Returns the renderer for the fmt of request, with its content type and headers. """
+
+    headers = {}
     fmt = request.query_params.get("fmt", "html")
     if fmt == "html":
         renderer = render.HTMLRenderer(config, query)
@@ -812,12 +1579,233 @@ async def serve_logs(request: Request):
         headers["Access-Control-Allow-Origin"] = "*"
     else:
         raise Exception(f"unknown output format '{fmt}'")
+    return renderer, content_type, headers
+
 
-    return StreamingResponse(stream_logs(es_client, renderer, query),
+def spool_key(request: Request, query: Query):
+    """ Returns the key of the spooled results of query. """
+    return query.cache_key("spool", credential_scope(request), query.timerange)
+
+
+@app.get('/logs')
+async def serve_logs(request: Request):
+    """ Serve logs. """
+    trace = tracing.start("logs")
+    with trace.stage("client"):
+        es_client, resp = await es_client_from(request)
+    if resp:
+        return resp
+
+    config = await get_config()
+    with trace.stage("build"):
+        try:
+            query = from_request(config, request)
+            query = await with_field_caps(es_client, request, query)
+        except ValueError as ex:
+            return Response(status_code=400, content=str(ex))
+
+    renderer, content_type, headers = renderer_for(request, config, query)
+
+    # later stages are sent at the end of the stream, see stream_logs
+    headers.update(trace.headers())
+    headers["X-Opaque-Id"] = request.state.opaque_id
+
+    # results of closed time ranges do not change, they are rendered from
+    # the spool if they were streamed before
+    results_spool = await get_spool()
+    key = None
+    if results_spool and not query.profile and is_closed(query):
+        key = spool_key(request, query)
+        spooled = None
+        if "no-cache" in request.headers.get("Cache-Control", ""):
+            metrics.SPOOL_REQUESTS.inc(result="bypass")
+        else:
+            with trace.stage("spool"):
+                spooled = await asyncio.to_thread(results_spool.open, key)
+            if spooled and not spooled.covers(query.max_results):
+                spooled.close()
+                spooled = None
+            metrics.SPOOL_REQUESTS.inc(result="miss" if spooled is None else "hit")
+        if spooled:
+            headers["X-Spool"] = "hit"
+            return StreamingResponse(metered(stream_spooled(spooled, renderer, query, trace),
+                                             type(renderer).__name__, trace),
+                                     headers=headers,
+                                     media_type=content_type)
+
+    disconnected = asyncio.Event()
+    stream = stream_logs(es_client, renderer, query, trace, search_user(request), disconnected,
+                         config.tail_max_lifetime_s, config.tail_max_idle_s,
+                         results_spool if key else None, key)
+    return StreamingResponse(metered(watch_disconnect(request, stream, disconnected), type(renderer).__name__, trace),
                              headers=headers,
                              media_type=content_type)
 
 
+@app.get('/logs/more')
+async def serve_more(request: Request):
+    """ Serve the next page of results of /logs, after the cursor in
+    `after`, as rows to append to the table of the page. """
+
+    trace = tracing.start("more")
+    with trace.stage("client"):
+        es_client, resp = await es_client_from(request)
+    if resp:
+        return resp
+
+    config = await get_config()
+    with trace.stage("build"):
+        params = flatten_params(request.query_params, exceptions=ONLY_ONCE_ARGUMENTS + ["after"])
+        try:
+            after = decode_cursor(params.pop("after", ""))
+            query = await with_field_caps(es_client, request, Query(config, **params))
+        except ValueError as ex:
+            return Response(status_code=400, content=str(ex))
+
+    headers = trace.headers()
+    headers["X-Opaque-Id"] = request.state.opaque_id
+    renderer = render.HTMLRowsRenderer(config, query)
+
+    # pages of spooled results are rendered from the spool, see serve_logs
+    results_spool = await get_spool()
+    if results_spool and not query.profile and is_closed(query) \
+            and "no-cache" not in request.headers.get("Cache-Control", ""):
+        with trace.stage("spool"):
+            spooled = await asyncio.to_thread(results_spool.open, spool_key(request, query))
+            if spooled:
+                start = await asyncio.to_thread(spooled_position, spooled, query, after)
+                if not spooled.covers("all" if query.max_results == "all" else start + query.max_results):
+                    spooled.close()
+                    spooled = None
+        metrics.SPOOL_REQUESTS.inc(result="miss" if spooled is None else "hit")
+        if spooled:
+            headers["X-Spool"] = "hit"
+            return StreamingResponse(metered(stream_spooled(spooled, renderer, query, trace, start),
+                                             type(renderer).__name__, trace),
+                                     headers=headers,
+                                     media_type="text/html")
+
+    disconnected = asyncio.Event()
+    stream = stream_logs(es_client, renderer, query, trace, search_user(request), disconnected,
+                         config.tail_max_lifetime_s, config.tail_max_idle_s, after=after)
+    return StreamingResponse(metered(watch_disconnect(request, stream, disconnected), type(renderer).__name__, trace),
+                             headers=headers,
+                             media_type="text/html")
+
+
+class Context(NamedTuple):
+    before: list
+    doc: dict
+    after: list
+    took_es_ms: int
+
+
+async def fetch_context(es, query: Query, index, doc_id, num_results):
+    """ Returns the document doc_id in index and up to num_results
+    documents matching query before and after it.
+
+    The document is fetched directly, then both sides are searched
+    concurrently with search_after its timestamp, within CONTEXT_WINDOW_S.
+    Documents with the same timestamp are on either side. """
+
+    doc = await es.get(index=index, id=doc_id)
+    timestamp_ms = parse_iso8601_ms(doc['_source']['@timestamp'])
+    window_ms = CONTEXT_WINDOW_S * 1000
+    around = query.with_timerange(str(timestamp_ms - window_ms), str(timestamp_ms + window_ms + 1))
+
+    async def search(sort, search_after):
+        side = copy.copy(around)
+        side.sort = sort
+        # one more, the document itself might be among them
+        es_query = side.to_elasticsearch(side.from_timestamp, num_results + 1)
+        es_query.pop("profile", None)
+        es_query["track_total_hits"] = False
+        es_query["search_after"] = [search_after]
+        start = time.time()
+        resp = await es.search(index=query.index, body=es_query, request_timeout=query.timeout)
+        metrics.observe_search("context", resp['took'], time.time() - start)
+        return resp
+
+    # search_after excludes its value, so both include the same millisecond
+    before, after = await asyncio.gather(search("desc", timestamp_ms + 1), search("asc", timestamp_ms - 1))
+
+    key = (doc['_index'], doc['_id'])
+    before_hits = [hit for hit in before['hits']['hits'] if (hit['_index'], hit['_id']) != key][:num_results]
+    seen = {(hit['_index'], hit['_id']) for hit in before_hits} | {key}
+    after_hits = [hit for hit in after['hits']['hits'] if (hit['_index'], hit['_id']) not in seen][:num_results]
+    doc_hit = {"_index": doc['_index'], "_id": doc['_id'], "_source": doc['_source'], "sort": [timestamp_ms]}
+    return Context(before=before_hits[::-1], doc=doc_hit, after=after_hits,
+                   took_es_ms=max(before['took'], after['took']))
+
+
+def es_error_response(ex):
+    """ Returns the response for a failed request to elasticsearch: with
+    its status if it was rejected (e.g. 403), 504 if it timed out and 502
+    otherwise. """
+
+    if isinstance(ex, elasticsearch.ApiError) and 400 <= ex.meta.status < 500:
+        return Response(status_code=ex.meta.status, content=f"elasticsearch rejected the request: {ex}")
+    if isinstance(ex, elasticsearch.ConnectionTimeout):
+        return Response(status_code=504, content=f"elasticsearch timed out: {ex}")
+    return Response(status_code=502, content=f"elasticsearch failed: {ex}")
+
+
+@app.get('/context')
+async def serve_context(request: Request):
+    """ Serve the logs around a single document, given by _index and _id,
+    as a /logs page.  n is the number of documents before and after it,
+    other parameters filter them as in /logs. """
+
+    trace = tracing.start("context")
+    with trace.stage("client"):
+        es_client, resp = await es_client_from(request)
+    if resp:
+        return resp
+    if isinstance(es_client, fanout.FanOutClient):
+        return Response(status_code=400, content="context needs a single datacenter, e.g. the _datacenter of the row")
+
+    config = await get_config()
+    with trace.stage("build"):
+        params = flatten_params(request.query_params, exceptions=ONLY_ONCE_ARGUMENTS + ["_index", "_id", "n"])
+        index, doc_id = params.pop("_index", None), params.pop("_id", None)
+        if not index or not doc_id:
+            return Response(status_code=400, content="_index and _id are required")
+        try:
+            num_results = max(0, min(int(params.pop("n", CONTEXT_DEFAULT_RESULTS)), CONTEXT_MAX_RESULTS))
+            query = await with_field_caps(es_client, request, Query(config, **params))
+        except ValueError as ex:
+            return Response(status_code=400, content=str(ex))
+
+    start = time.time()
+    try:
+        async with admitted(query.datacenter, search_user(request), admission.INTERACTIVE, trace):
+            with trace.stage("es_wait"):
+                context = await fetch_context(es_client, query, index, doc_id, num_results)
+    except admission.Overloaded as ex:
+        return Response(status_code=503, content=str(ex), headers={"Retry-After": "1"})
+    except elasticsearch.NotFoundError:
+        return Response(status_code=404, content=f"document '{doc_id}' not found in '{index}'")
+    except (elasticsearch.TransportError, elasticsearch.ApiError) as ex:
+        print(ex)
+        return es_error_response(ex)
+    except (KeyError, ValueError) as ex:
+        return Response(status_code=400, content=f"document '{doc_id}' has no valid @timestamp: {ex}")
+    took_ms = int((time.time() - start) * 1000)
+
+    with trace.stage("render"):
+        hits = context.before + [context.doc] + context.after
+        # the page (and its histogram) is about the time range of the context
+        query = query.with_timerange(str(hits[0]['sort'][0]), str(hits[-1]['sort'][0] + 1))
+        renderer, content_type, headers = renderer_for(request, config, query)
+        parts = [renderer.start(), renderer.num_results(len(hits), took_ms, context.took_es_ms)]
+        for hit in hits:
+            source = filter_dict(hit['_source'], query.fields) if query.fields else hit['_source']
+            parts.append(renderer.result(hit, source, highlight=hit is context.doc))
+        parts.append(renderer.end())
+    trace.end()
+    return Response("".join(parts), media_type=content_type, headers={**headers, **trace.headers()})
+
+
 async def es_client_from(request: Request):
     """ Create elastic search client from request. """
 
@@ -841,27 +1829,142 @@ async def es_client_from(request: Request):
                 raise AuthenticationError('Invalid basic auth credentials', ex)
 
             username, _, password = decoded.partition(":")
+            # searches fail with the credentials of someone else
+            request.state.es_user = username
 
     config = await get_config()
-    datacenter = request.query_params.get('dc') or config.default_endpoint
-    if datacenter not in config.endpoints:
-        return None, Response(status_code=400, content=f"unknown datacenter '{datacenter}'")
+    datacenters = list(dict.fromkeys(dc.strip() for dc in
+                                     (request.query_params.get('dc') or config.default_endpoint).split(",")))
+    for datacenter in datacenters:
+        if datacenter not in config.endpoints:
+            return None, Response(status_code=400, content=f"unknown datacenter '{datacenter}'")
+
+    # identifies the searches of this request in the tasks api of elasticsearch
+    request.state.opaque_id = f"es-stream-logs/{quote(search_user(request))}/{uuid.uuid4().hex[:16]}"
+    es_clients = {}
+    for datacenter in datacenters:
+        es_client = new_es_client(config, datacenter, username, password)
+        request.state.es_clients.append(es_client)
+        es_clients[datacenter] = es_client.options(opaque_id=request.state.opaque_id)
+    if len(es_clients) == 1:
+        return next(iter(es_clients.values())), None
+    return fanout.FanOutClient(es_clients, config.fanout_deadline_s), None
+
+
+def new_es_client(config, datacenter, username, password):
+    """ Create elastic search client for datacenter. """
+
+    metrics.ES_CLIENTS.inc(datacenter=datacenter)
 
     ca_certs = ES_CUSTOM_CA_CERTS
     if all(e.startswith("http:") for e in config.endpoints[datacenter]):
         ca_certs = None
 
-    es_client = AsyncElasticsearch(config.endpoints[datacenter],
-                                   ca_certs=ca_certs,
-                                   http_auth=(username, password),
-                                   http_compress=True)
+    return AsyncElasticsearch(config.endpoints[datacenter],
+                              ca_certs=ca_certs,
+                              http_auth=(username, password),
+                              http_compress=True)
 
-    return es_client, None
 
-
-CONFIG = config.from_file(os.environ.get('CONFIG', 'config.json'))
+CONFIG_FILE = os.environ.get('CONFIG', 'config.json')
+CONFIG = config.from_file(CONFIG_FILE)
 
 
 async def get_config():
     """ Loads config from scratch or cached. """
     return CONFIG
+
+
+def config_file_version():
+    """ Returns what changes when the config file is written, or None if it does not exist. """
+    try:
+        stat = os.stat(CONFIG_FILE)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def reload_config():
+    """ Replaces the config with the one in CONFIG_FILE, if it is valid.
+
+    Requests that already started, e.g. live tails, keep using the config
+    they started with.  Returns whether the config was replaced. """
+
+    global CONFIG
+    try:
+        new_config = config.from_file(CONFIG_FILE)
+    except (OSError, ValueError, TypeError) as ex:
+        print(f"not reloading invalid config from {CONFIG_FILE}:", ex)
+        metrics.CONFIG_RELOADS.inc(result="error")
+        return False
+
+    restart_only = [name for name in config.RESTART_ONLY if getattr(new_config, name) != getattr(CONFIG, name)]
+    if restart_only:
+        print(f"changes to {', '.join(restart_only)} are only applied after a restart")
+    CONFIG = new_config
+    tracing.SAMPLE_RATE = new_config.trace_sample_rate
+    metrics.CONFIG_RELOADS.inc(result="ok")
+    print(f"reloaded config from {CONFIG_FILE}")
+    return True
+
+
+async def watch_config_forever():
+    """ Reloads the config when its file changes, until cancelled. """
+
+    version = config_file_version()
+    while True:
+        await asyncio.sleep(CONFIG_CHECK_INTERVAL_S)
+        try:
+            new_version = config_file_version()
+            if new_version is not None and new_version != version:
+                version = new_version
+                reload_config()
+        except Exception as ex:
+            # keep watching, the next change might be valid
+            traceback.print_exception(type(ex), ex, ex.__traceback__)
+            metrics.CONFIG_RELOADS.inc(result="error")
+
+
+ROLLUPS = None
+ROLLUPS_SETTINGS = None
+
+
+async def get_rollups():
+    """ Returns the rollup store, or None if it is not configured.  It is
+    created again when its settings change by reloading the config,
+    searches that use the previous one keep it until they are done. """
+    global ROLLUPS, ROLLUPS_SETTINGS
+    config = await get_config()
+    settings = (config.rollups_dir, config.rollups_max_mb)
+    if settings != ROLLUPS_SETTINGS:
+        ROLLUPS = rollups.RollupStore(config.rollups_dir, config.rollups_max_mb * 1024 * 1024) if config.rollups_dir else None
+        ROLLUPS_SETTINGS = settings
+    return ROLLUPS
+
+
+SPOOL = None
+SPOOL_SETTINGS = None
+
+
+async def get_spool():
+    """ Returns the spool, or None if it is not configured.  It is created
+    again when its settings change, like the rollup store. """
+    global SPOOL, SPOOL_SETTINGS
+    config = await get_config()
+    settings = (config.spool_dir, config.spool_max_mb)
+    if settings != SPOOL_SETTINGS:
+        SPOOL = spool.Spool(config.spool_dir, config.spool_max_mb * 1024 * 1024) if config.spool_dir else None
+        SPOOL_SETTINGS = settings
+    return SPOOL
+
+
+HTTP_SESSION = None
+
+
+async def get_http_session():
+    """ Returns the session for requests to other services, e.g. Kibana,
+    which keeps connections open for reuse. """
+    global HTTP_SESSION
+    if HTTP_SESSION is None:
+        HTTP_SESSION = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=20))
+    return HTTP_SESSION
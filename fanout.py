@@ -0,0 +1,256 @@
+""" Searches in several datacenters at once, e.g. with `dc=dc1,dc2` to
+follow requests of services running active-active.
+
+The datacenters are searched concurrently and their responses merged
+into one, as if it came from a single cluster: hits are merged by their
+sort values and tagged with their datacenter in `_datacenter`, counts
+and aggregations are summed.  A slow datacenter does not hold up the
+others for longer than a deadline, the response is incomplete then and
+lists it in `missing_datacenters`. """
+
+import asyncio
+import contextlib
+import heapq
+
+import elasticsearch
+
+import metrics
+
+# aggregations whose buckets are ordered by key, all others by count
+HISTOGRAM_AGGREGATIONS = {"date_histogram", "histogram"}
+
+
+class FanOutClient:
+    """ Sends searches to the clients of several datacenters, in the
+    same way as to a single AsyncElasticsearch client.
+
+    Once the first datacenter responded, the others get at most
+    deadline_s more.  Datacenters that fail or miss the deadline are left
+    out, only if all of them fail is the error raised. """
+
+    def __init__(self, clients, deadline_s):
+        self.clients = clients
+        self.deadline_s = deadline_s
+
+    async def _gather(self, call):
+        """ Runs call(datacenter, client) for every datacenter, returns the
+        results and the reasons for the missing ones, both by datacenter. """
+
+        loop = asyncio.get_running_loop()
+        tasks = {asyncio.ensure_future(call(datacenter, client)): datacenter
+                 for datacenter, client in self.clients.items()}
+        try:
+            pending = set(tasks)
+            deadline = None
+            while pending:
+                timeout = None if deadline is None else max(0, deadline - loop.time())
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                if deadline is None and any(task.exception() is None for task in done):
+                    deadline = loop.time() + self.deadline_s
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                    with contextlib.suppress(asyncio.CancelledError):
+                        await task
+
+        results, missing, errors = {}, {}, []
+        for task, datacenter in tasks.items():
+            if task.cancelled():
+                missing[datacenter] = f"no response within {self.deadline_s}s after the first datacenter"
+            elif isinstance(task.exception(), (elasticsearch.ApiError, elasticsearch.TransportError)):
+                missing[datacenter] = str(task.exception())
+                errors.append(task.exception())
+            elif task.exception() is not None:
+                raise task.exception()
+            else:
+                results[datacenter] = task.result()
+        if not results:
+            raise errors[0]
+        for datacenter in missing:
+            metrics.FANOUT_MISSING.inc(datacenter=datacenter)
+        return results, missing
+
+    async def search(self, bodies=None, **kwargs):
+        """ Searches all datacenters, with the body of each datacenter in
+        bodies if given, e.g. to continue each from where it stopped. """
+
+        if bodies:
+            kwargs["body"] = next(iter(bodies.values()))
+        responses, missing = await self._gather(
+            lambda datacenter, client: client.search(**{**kwargs, "body": (bodies or {}).get(datacenter, kwargs.get("body"))}))
+        return merge_searches({datacenter: dict(resp) for datacenter, resp in responses.items()},
+                              kwargs.get("body") or {}, missing)
+
+    async def msearch(self, body, **kwargs):
+        responses, missing = await self._gather(lambda datacenter, client: client.msearch(body=body, **kwargs))
+        bodies = body[1::2]
+        merged = []
+        for idx, search_body in enumerate(bodies):
+            parts = {datacenter: resp['responses'][idx] for datacenter, resp in responses.items()}
+            failed = {datacenter: str(part['error']) for datacenter, part in parts.items() if 'error' in part}
+            succeeded = {datacenter: part for datacenter, part in parts.items() if 'error' not in part}
+            if not succeeded:
+                merged.append(next(iter(parts.values())))
+                continue
+            merged.append(merge_searches(succeeded, search_body, {**missing, **failed}))
+        return {"took": max(resp['took'] for resp in responses.values()), "responses": merged}
+
+    async def field_caps(self, **kwargs):
+        responses, _ = await self._gather(lambda datacenter, client: client.field_caps(**kwargs))
+        fields = {}
+        for resp in responses.values():
+            for name, types in resp['fields'].items():
+                merged_types = fields.setdefault(name, {})
+                for type_, caps in types.items():
+                    if type_ not in merged_types:
+                        merged_types[type_] = dict(caps)
+                        continue
+                    # a capability only holds if it holds everywhere
+                    for cap in ("searchable", "aggregatable"):
+                        merged_types[type_][cap] = merged_types[type_].get(cap) and caps.get(cap)
+        indices = sorted({index for resp in responses.values() for index in resp.get('indices', [])})
+        return {"indices": indices, "fields": fields}
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.close()
+
+
+def merge_searches(responses, body, missing=None):
+    """ Merges the search responses of several datacenters, as if they
+    were the response of one search with the given body. """
+
+    missing = missing or {}
+    sort = (body.get("sort") or [{}])[0]
+    descending = any(isinstance(order, dict) and order.get("order") == "desc" for order in sort.values())
+    hit_lists = []
+    for datacenter, resp in responses.items():
+        for hit in resp['hits']['hits']:
+            hit['_datacenter'] = datacenter
+        hit_lists.append(resp['hits']['hits'])
+    # every datacenter returns its hits sorted already
+    hits = list(heapq.merge(*hit_lists, key=lambda hit: hit.get('sort', []), reverse=descending))
+    hits = hits[:body.get("size", 10)]
+
+    totals = [resp['hits'].get('total') for resp in responses.values()]
+    merged = {
+        "took": max(resp['took'] for resp in responses.values()),
+        "timed_out": any(resp['timed_out'] for resp in responses.values()) or bool(missing),
+        "_shards": merge_shards([resp['_shards'] for resp in responses.values()]),
+        "hits": {"max_score": None, "hits": hits},
+    }
+    if all(totals):
+        merged['hits']['total'] = {
+            "value": sum(total['value'] for total in totals),
+            "relation": "gte" if any(total['relation'] == "gte" for total in totals) else "eq",
+        }
+    aggregations = [(resp['aggregations'], resp['hits']['total']['value'] if resp['hits'].get('total') else 1)
+                    for resp in responses.values() if 'aggregations' in resp]
+    if aggregations:
+        merged['aggregations'] = merge_aggregations(aggregations, sub_aggregations(body))
+    profiles = [resp['profile'] for resp in responses.values() if 'profile' in resp]
+    if profiles:
+        merged['profile'] = {"shards": [shard for profile in profiles for shard in profile.get('shards', [])]}
+    if missing:
+        merged['missing_datacenters'] = missing
+    return merged
+
+
+def merge_shards(shards):
+    merged = {key: sum(shard.get(key, 0) for shard in shards) for key in ("total", "successful", "skipped", "failed")}
+    failures = [failure for shard in shards for failure in shard.get('failures', [])]
+    if failures:
+        merged['failures'] = failures
+    return merged
+
+
+def sub_aggregations(body):
+    """ Returns the aggregations requested in body, i.e. in a search
+    body or in the definition of an aggregation, as name -> definition. """
+    return body.get("aggs") or body.get("aggregations") or {}
+
+
+def merge_aggregations(parts, requested=None):
+    """ Merges aggregation results, given as (aggregations, doc_count) of
+    each datacenter.  Counts are summed, buckets with the same key are
+    merged.  Percentiles cannot be merged exactly, they are averaged
+    weighted by the number of documents.
+
+    requested are the definitions of the aggregations, see sub_aggregations. """
+
+    requested = requested or {}
+    merged = {}
+    for name in parts[0][0]:
+        values = [(aggs[name], doc_count) for aggs, doc_count in parts if name in aggs]
+        definition = requested.get(name, {})
+        first = values[0][0]
+        if not isinstance(first, dict):
+            merged[name] = first
+        elif 'buckets' in first:
+            merged[name] = {**first, "buckets": merge_buckets([agg['buckets'] for agg, _ in values], definition)}
+            for key in ("sum_other_doc_count", "doc_count_error_upper_bound"):
+                if key in first:
+                    merged[name][key] = sum(agg.get(key, 0) for agg, _ in values)
+        elif 'values' in first:
+            merged[name] = {"values": merge_percentiles(values)}
+        elif 'doc_count' in first:
+            # single bucket aggregations, e.g. missing
+            merged[name] = {**merge_aggregations([(agg, agg['doc_count']) for agg, _ in values],
+                                                 sub_aggregations(definition)),
+                            "doc_count": sum(agg['doc_count'] for agg, _ in values)}
+        else:
+            merged[name] = first
+    return merged
+
+
+def merge_buckets(bucket_lists, definition):
+    """ Merges the buckets of an aggregation by their keys, definition is
+    the aggregation as requested.
+
+    Keyed buckets (filters) stay keyed.  Histograms stay ordered by key,
+    all others (e.g. terms) are ordered by count and keep their size. """
+
+    requested = sub_aggregations(definition)
+    if isinstance(bucket_lists[0], dict):
+        keys = list(dict.fromkeys(key for buckets in bucket_lists for key in buckets))
+        return {key: merge_bucket([buckets[key] for buckets in bucket_lists if key in buckets], requested)
+                for key in keys}
+
+    by_key = {}
+    for buckets in bucket_lists:
+        for bucket in buckets:
+            by_key.setdefault(bucket['key'], []).append(bucket)
+    merged = [merge_bucket(buckets, requested) for buckets in by_key.values()]
+    # terms of date or boolean fields have a key_as_string as well, only the type tells them apart
+    if HISTOGRAM_AGGREGATIONS & definition.keys():
+        return sorted(merged, key=lambda bucket: bucket['key'])
+    merged.sort(key=lambda bucket: -bucket['doc_count'])
+    return merged[:max(len(buckets) for buckets in bucket_lists)]
+
+
+def merge_bucket(buckets, requested):
+    bucket_keys = {"key", "key_as_string", "doc_count"}
+    merged = {key: buckets[0][key] for key in bucket_keys if key in buckets[0]}
+    merged['doc_count'] = sum(bucket['doc_count'] for bucket in buckets)
+    parts = [({name: agg for name, agg in bucket.items() if name not in bucket_keys}, bucket['doc_count'])
+             for bucket in buckets]
+    merged.update(merge_aggregations(parts, requested))
+    return merged
+
+
+def merge_percentiles(values):
+    merged = {}
+    for percentile in values[0][0]['values']:
+        weighted = [(agg['values'].get(percentile), doc_count) for agg, doc_count in values]
+        weighted = [(value, doc_count) for value, doc_count in weighted if value is not None]
+        total = sum(doc_count for _, doc_count in weighted)
+        if not weighted:
+            merged[percentile] = None
+        elif total:
+            merged[percentile] = sum(value * doc_count for value, doc_count in weighted) / total
+        else:
+            merged[percentile] = weighted[0][0]
+    return merged
@@ -0,0 +1,441 @@
+""" Histogram data and rendering as (compact) SVG.
+
+Buckets are kept as columns, i.e. one list per value (keys, counts, per
+term counts, ...) instead of one dict per bucket, so that the geometry
+for all buckets can be computed at once and every series can be rendered
+as a single svg path, independent of the number of buckets. """
+
+from dataclasses import dataclass, field
+import json
+from typing import Dict, List, Optional
+
+from jinja2 import Template
+
+from color_mapper import ColorMapper
+import tinygraph
+
+DEFAULT_RESOLUTION = 100
+MAX_RESOLUTION = 5000
+
+# height of the chart in svg units, 0 is at the top
+CHART_HEIGHT = 100
+
+# key for documents with terms that are not in the global top terms, see
+# aggregation_mode in query.py
+OTHER_TERM = "__other__"
+OTHER_COLOR = "#aaaaaa"
+MISSING_AGGREGATION = "missing_terms"
+
+OVERLAY_COLORS = ["#444444", "#8a2be2", "#d2691e", "#1e90ff"]
+
+
+@dataclass
+class Histogram:
+    """ Columnar representation of a date_histogram aggregation. """
+
+    interval_s: int
+    keys: List[int] = field(default_factory=list)
+    counts: List[int] = field(default_factory=list)
+    # counts per term, aligned with keys
+    terms: Dict[str, List[int]] = field(default_factory=dict)
+    # values per percentile, aligned with keys
+    percentiles: Dict[str, List[Optional[float]]] = field(default_factory=dict)
+    # percentiles over the whole time range
+    total_percentiles: Dict[str, Optional[float]] = field(default_factory=dict)
+
+    @property
+    def total_count(self):
+        return sum(self.counts)
+
+    @property
+    def max_count(self):
+        return max(self.counts, default=0)
+
+    @property
+    def missing(self):
+        """ Counts of documents without a value for the aggregated term. """
+        if not self.terms:
+            return [0] * len(self.counts)
+        term_sums = [sum(counts) for counts in zip(*self.terms.values())]
+        return [count - term_sum for count, term_sum in zip(self.counts, term_sums)]
+
+
+def from_aggregations(aggregations, interval_s, aggregation_terms=None, percentiles_terms=None, name="num_results",
+                      top_terms=None):
+    """ Collects histogram from the aggregations of an elasticsearch response.
+
+    top_terms are the terms that were aggregated with a filters
+    aggregation, they are needed to restore their original type. """
+
+    buckets = aggregations[name]['buckets']
+    histogram = Histogram(interval_s=interval_s,
+                          keys=[bucket['key'] for bucket in buckets],
+                          counts=[bucket['doc_count'] for bucket in buckets])
+
+    num_buckets = len(buckets)
+    if aggregation_terms:
+        top_terms = {str(term): term for term in top_terms or []}
+        for idx, bucket in enumerate(buckets):
+            sub_buckets = bucket[aggregation_terms]['buckets']
+            if isinstance(sub_buckets, dict):
+                # filters aggregation for global top terms
+                sub_buckets = [{"key": top_terms.get(key, key), "doc_count": sub_bucket['doc_count']}
+                               for key, sub_bucket in sub_buckets.items()]
+            for sub_bucket in sub_buckets:
+                key = sub_bucket['key']
+                count = sub_bucket['doc_count']
+                if key == OTHER_TERM and MISSING_AGGREGATION in bucket:
+                    # the other bucket contains documents without a value as well
+                    count -= bucket[MISSING_AGGREGATION]['doc_count']
+                if key not in histogram.terms:
+                    histogram.terms[key] = [0] * num_buckets
+                histogram.terms[key][idx] = count
+        histogram.terms = dict(sorted(histogram.terms.items(), key=lambda item: str(item[0])))
+
+    if percentiles_terms:
+        for idx, bucket in enumerate(buckets):
+            for percentile, value in bucket[percentiles_terms]['values'].items():
+                if percentile not in histogram.percentiles:
+                    histogram.percentiles[percentile] = [None] * num_buckets
+                histogram.percentiles[percentile][idx] = value
+        if percentiles_terms in aggregations:
+            histogram.total_percentiles = aggregations[percentiles_terms]['values']
+
+    return histogram
+
+
+def concat(histograms, interval_s):
+    """ Concatenates histograms of consecutive time ranges into one. """
+
+    result = Histogram(interval_s=interval_s)
+    for histogram in histograms:
+        offset = len(result.keys)
+        num_buckets = len(histogram.keys)
+        result.keys += histogram.keys
+        result.counts += histogram.counts
+        for term in set(result.terms) | set(histogram.terms):
+            result.terms.setdefault(term, [0] * offset)
+            result.terms[term] += histogram.terms.get(term, [0] * num_buckets)
+        for percentile in set(result.percentiles) | set(histogram.percentiles):
+            result.percentiles.setdefault(percentile, [None] * offset)
+            result.percentiles[percentile] += histogram.percentiles.get(percentile, [None] * num_buckets)
+    result.terms = dict(sorted(result.terms.items(), key=lambda item: str(item[0])))
+    result.percentiles = dict(sorted(result.percentiles.items(), key=lambda item: float(item[0])))
+    return result
+
+
+def _fraction_below(points, value):
+    """ Returns the (linearly interpolated) fraction of values below value,
+    given the percentiles of a bucket as sorted (fraction, value) points. """
+
+    if value < points[0][1]:
+        return 0
+    for (fraction, point), (next_fraction, next_point) in zip(points, points[1:]):
+        if point <= value < next_point:
+            return fraction + (next_fraction - fraction) * (value - point) / (next_point - point)
+    return points[-1][0]
+
+
+def estimate_percentiles(histogram: Histogram):
+    """ Estimates the percentiles over all buckets by combining the
+    percentiles of each bucket, weighted by their number of documents.
+
+    This is only an approximation, elasticsearch does not expose the
+    digests of its percentiles. """
+
+    buckets = []
+    for idx, count in enumerate(histogram.counts):
+        points = sorted((float(percentile) / 100, values[idx])
+                        for percentile, values in histogram.percentiles.items() if values[idx] is not None)
+        if count and points:
+            buckets.append((count, points))
+    if not buckets:
+        return {percentile: None for percentile in histogram.percentiles}
+
+    total = sum(count for count, _ in buckets)
+    min_value = min(points[0][1] for _, points in buckets)
+    max_value = max(points[-1][1] for _, points in buckets)
+
+    estimates = {}
+    for percentile in histogram.percentiles:
+        target = float(percentile) / 100
+        low, high = min_value, max_value
+        for _ in range(30):
+            mid = (low + high) / 2
+            if sum(count * _fraction_below(points, mid) for count, points in buckets) / total < target:
+                low = mid
+            else:
+                high = mid
+        estimates[percentile] = high
+    return estimates
+
+
+def term_label(term):
+    """ Returns the label for term. """
+    return "other terms" if term == OTHER_TERM else str(term)
+
+
+def pretty_percentile(percentile):
+    """ Formats percentile for display, e.g. 50.0 as 50. """
+    percentile = float(percentile)
+    return int(percentile) if percentile.is_integer() else percentile
+
+
+def to_json(data):
+    """ Serializes data as json that can be embedded as text in svg
+    and html documents without further escaping. """
+    return json.dumps(data, separators=(',', ':')) \
+        .replace("<", "\\u003c").replace(">", "\\u003e").replace("&", "\\u0026")
+
+
+SVG_TEMPLATE = Template(r"""<?xml version="1.0" encoding="UTF-8"?>
+<svg xmlns="http://www.w3.org/2000/svg" class="chart" width="{{ width }}" height="{{ height }}" xmlns:xlink="http://www.w3.org/1999/xlink">
+
+<title id="title">Aggregation for query: {{ query_str | e }}</title>
+<style>
+svg {
+    font-family: monospace;
+}
+
+path.bars {
+    fill-opacity: 0.5;
+    stroke-width: 1px;
+}
+
+rect.incomplete {
+    fill: white;
+    fill-opacity: 0.6;
+}
+
+#tooltip {
+    pointer-events: none;
+}
+</style>
+
+<text x="10" y="14">{{ query_title | e }}</text>
+{% if profile_lines %}
+<text class="profile" x="10" y="{{ 42 if overlay_lines else 28 }}">{% for line in profile_lines %}<tspan x="10" dy="{{ 0 if loop.first else 14 }}">{{ line | e }}</tspan>{% endfor %}</text>
+{% endif %}
+{% if overlay_lines %}
+<text x="10" y="28">{% for line in overlay_lines %}<tspan fill="{{ line.color }}">- - {{ line.name | e }} </tspan>{% endfor %}</text>
+{% endif %}
+
+<svg id="chart" width="100%" height="100%" viewBox="0 0 {{ view_width }} {{ chart_height }}" preserveAspectRatio="none">
+<g class="buckets">
+{% for series in bars %}
+    <path class="bars" fill="{{ series.color }}" stroke="{{ series.color }}" vector-effect="non-scaling-stroke" d="{{ series.path }}"><title>{{ series.name | e }}</title></path>
+{% endfor %}
+{% for path in percentile_steps %}
+    <path class="percentile" fill="none" stroke="black" vector-effect="non-scaling-stroke" d="{{ path }}" />
+{% endfor %}
+</g>
+{% for line in overlay_lines %}
+    <path class="overlay" fill="none" stroke="{{ line.color }}" stroke-dasharray="4 2" vector-effect="non-scaling-stroke" d="{{ line.path }}"><title>{{ line.name | e }}</title></path>
+{% endfor %}
+{% if percentile_line %}
+    <path id="percentile" fill="none" stroke="rgba(100, 100, 100, 0.7)" vector-effect="non-scaling-stroke" d="{{ percentile_line }}" />
+{% endif %}
+{% for rect in incomplete %}
+    <rect class="incomplete" x="{{ rect[0] }}" width="{{ rect[1] }}" y="0" height="{{ chart_height }}" />
+{% endfor %}
+    <a id="bucket-link" target="_parent">
+        <rect id="hover" fill="transparent" stroke="none" x="0" width="{{ view_width }}" y="0" height="{{ chart_height }}" />
+    </a>
+</svg>
+
+<!-- the tooltip is filled on demand from #data, only one is ever rendered -->
+<text id="tooltip" y="{{ label_y }}"></text>
+
+<script type="application/json" id="data">{{ data }}</script>
+
+<script><![CDATA[
+const data = JSON.parse(document.getElementById("data").textContent);
+const chart = document.getElementById("chart");
+const link = document.getElementById("bucket-link");
+const tooltip = document.getElementById("tooltip");
+
+function isoTimestamp(ms) {
+    return new Date(ms).toISOString().replace(/\.\d+Z$/, "Z");
+}
+
+function findBucket(x) {
+    let lo = 0, hi = data.x.length - 1;
+    while (lo <= hi) {
+        let mid = (lo + hi) >> 1;
+        if (x < data.x[mid]) {
+            hi = mid - 1;
+        } else if (x >= data.x[mid] + 1) {
+            lo = mid + 1;
+        } else {
+            return mid;
+        }
+    }
+    return -1;
+}
+
+function showTooltip(idx) {
+    let pos = (Math.max(0, data.x[idx]) / data.view_width * 100) + "%";
+    let fraction = idx / data.x.length;
+    tooltip.setAttribute("text-anchor", fraction < 0.25 ? "start" : (fraction > 0.75 ? "end" : "middle"));
+
+    let lines = [isoTimestamp(data.keys[idx]), "count: " + data.counts[idx]];
+    let count = data.counts[idx];
+    data.terms
+        .map(([name, counts]) => [name, counts[idx]])
+        .filter(([name, termCount]) => termCount > 0)
+        .sort(([n1, c1], [n2, c2]) => c2 - c1)
+        .forEach(([name, termCount]) => lines.push(`${name}: ${termCount} (${(termCount / count * 100).toFixed(2)}%)`));
+    data.overlays.forEach(([name, counts]) => lines.push(`${name}: ${counts[idx]}`));
+    if (data.percentiles.length > 0) {
+        lines.push(" ");
+        data.percentiles.forEach(([name, values]) => lines.push(`p${name}: ${(values[idx] || 0).toFixed(2)}`));
+    }
+
+    tooltip.textContent = "";
+    lines.forEach((line, i) => {
+        let tspan = document.createElementNS("http://www.w3.org/2000/svg", "tspan");
+        tspan.setAttribute("x", pos);
+        tspan.setAttribute("dy", i == 0 ? "1.5em" : "1.2em");
+        tspan.textContent = line;
+        tooltip.appendChild(tspan);
+    });
+
+    let from = isoTimestamp(data.keys[idx]);
+    let to = isoTimestamp(data.keys[idx] + data.interval_ms);
+    let href = data.logs_url + "&from=" + from + "&to=" + to;
+    link.setAttribute("href", href);
+    link.setAttributeNS("http://www.w3.org/1999/xlink", "xlink:href", href);
+}
+
+chart.addEventListener("mousemove", function(ev) {
+    let pt = new DOMPoint(ev.clientX, ev.clientY).matrixTransform(chart.getScreenCTM().inverse());
+    let idx = findBucket(pt.x);
+    if (idx < 0) {
+        tooltip.textContent = "";
+        link.removeAttribute("href");
+        link.removeAttributeNS("http://www.w3.org/1999/xlink", "href");
+        return;
+    }
+    showTooltip(idx);
+});
+chart.addEventListener("mouseleave", function() {
+    tooltip.textContent = "";
+});
+]]></script>
+</svg>
+""")
+
+
+def render_svg(histogram: Histogram, from_ms, to_ms, width, height, logs_url,
+               query_str="", query_title="", label_y="50%", no_value_label="no value",
+               overlays=None, profile_lines=None):
+    """ Renders histogram as svg.
+
+    The x axis is measured in buckets, i.e. a bucket is always 1 unit
+    wide, and the y axis in percent of the chart height.
+
+    overlays is a list of (label, histogram, offset_ms) for histograms of
+    earlier time ranges, they are shifted by offset_ms and drawn as lines
+    on top of the bars.  profile_lines are shown below the title, e.g. a
+    summary of the search profile. """
+
+    overlays = overlays or []
+
+    interval_ms = histogram.interval_s * 1000
+    view_width = max(1, (to_ms - from_ms) / interval_ms)
+    scale_x = tinygraph.Scale(CHART_HEIGHT, (from_ms, from_ms + interval_ms), (0, 1))
+    xs = scale_x.map_all(histogram.keys)
+
+    max_count = max([histogram.max_count] + [overlay.max_count for _, overlay, _ in overlays]) or 1
+    scale_y = tinygraph.Scale(CHART_HEIGHT, (0, max_count), (CHART_HEIGHT, 0))
+
+    color_mapper = ColorMapper()
+    bars = []
+    if histogram.terms:
+        series = [(term_label(key), color_mapper.to_color(key), counts) for key, counts in histogram.terms.items()
+                  if key != OTHER_TERM]
+        if OTHER_TERM in histogram.terms:
+            series.append((term_label(OTHER_TERM), OTHER_COLOR, histogram.terms[OTHER_TERM]))
+        # documents without a value for the term are stacked on top
+        series.append((no_value_label, "#dddddd", histogram.missing))
+        stacked = tinygraph.stack([counts for _, _, counts in series])
+        for (name, color, _), (bottoms, tops) in zip(series, stacked):
+            bars.append({
+                "name": name,
+                "color": color,
+                "path": tinygraph.bars_path(xs, scale_y.map_all(bottoms), scale_y.map_all(tops), min_height=0.25),
+            })
+    else:
+        bars.append({
+            "name": "count",
+            "color": "#00b2a5",
+            "path": tinygraph.bars_path(xs, [CHART_HEIGHT] * len(xs), scale_y.map_all(histogram.counts), min_height=0.25),
+        })
+
+    percentile_steps = []
+    percentile_line = None
+    if histogram.percentiles:
+        last_percentile = list(histogram.percentiles.values())[-1]
+        max_percentile = max([value or 0 for value in last_percentile], default=0) or 1
+        scale_percentile = tinygraph.Scale(1000, (0, max_percentile), (CHART_HEIGHT, CHART_HEIGHT * 0.05))
+        for values in histogram.percentiles.values():
+            ys = [scale_percentile.map(value) if value else None for value in values]
+            percentile_steps.append(tinygraph.steps_path(xs, ys))
+        ys = [scale_percentile.map(value) if value else None for value in last_percentile]
+        percentile_line = tinygraph.line_path([x + 0.5 for x in xs], ys)
+
+    overlay_lines = []
+    overlay_counts = []
+    for idx, (label, overlay, offset_ms) in enumerate(overlays):
+        overlay_xs = scale_x.map_all([key + offset_ms + interval_ms / 2 for key in overlay.keys])
+        overlay_lines.append({
+            "name": label,
+            "color": OVERLAY_COLORS[idx % len(OVERLAY_COLORS)],
+            "path": tinygraph.line_path(overlay_xs, scale_y.map_all(overlay.counts)),
+        })
+        counts_by_key = dict(zip(overlay.keys, overlay.counts))
+        overlay_counts.append([label, [counts_by_key.get(key - offset_ms, 0) for key in histogram.keys]])
+
+    # mark partial buckets at the edges
+    incomplete = []
+    if histogram.keys:
+        if histogram.keys[0] < from_ms:
+            incomplete.append((0, tinygraph.fmt_num(xs[0] + 1)))
+        if histogram.keys[-1] + interval_ms > to_ms:
+            incomplete.append((tinygraph.fmt_num(xs[-1]), tinygraph.fmt_num(view_width - xs[-1])))
+
+    data = {
+        "interval_ms": interval_ms,
+        "view_width": view_width,
+        "logs_url": logs_url,
+        "x": [round(x, 3) for x in xs],
+        "keys": histogram.keys,
+        "counts": histogram.counts,
+        "terms": [[term_label(key), counts] for key, counts in histogram.terms.items()],
+        "percentiles": [[str(pretty_percentile(p)), values] for p, values in histogram.percentiles.items()],
+        "overlays": overlay_counts,
+    }
+    if histogram.terms:
+        data["terms"].insert(0, [no_value_label, histogram.missing])
+
+    return SVG_TEMPLATE.render(width=width, height=height, query_str=query_str, query_title=query_title,
+                               view_width=tinygraph.fmt_num(view_width), chart_height=CHART_HEIGHT,
+                               bars=bars, percentile_steps=percentile_steps, percentile_line=percentile_line,
+                               overlay_lines=overlay_lines, profile_lines=profile_lines or [],
+                               incomplete=incomplete, label_y=label_y, data=to_json(data))
+
+
+SPARKLINE_TEMPLATE = Template(r"""<svg xmlns="http://www.w3.org/2000/svg" class="sparkline" width="{{ width }}" height="{{ height }}" viewBox="0 0 {{ view_width }} {{ chart_height }}" preserveAspectRatio="none"><title>{{ title | e }}</title><path fill="#00b2a5" fill-opacity="0.5" d="{{ path }}" /></svg>""")
+
+
+def render_sparkline(histogram: Histogram, from_ms, to_ms, width=120, height=16, title=""):
+    """ Renders histogram as a tiny inline svg, without any labels. """
+
+    interval_ms = histogram.interval_s * 1000
+    scale_x = tinygraph.Scale(CHART_HEIGHT, (from_ms, from_ms + interval_ms), (0, 1))
+    scale_y = tinygraph.Scale(CHART_HEIGHT, (0, histogram.max_count or 1), (CHART_HEIGHT, 0))
+    path = tinygraph.bars_path(scale_x.map_all(histogram.keys), [CHART_HEIGHT] * len(histogram.keys),
+                               scale_y.map_all(histogram.counts), min_height=2)
+    return SPARKLINE_TEMPLATE.render(width=width, height=height, title=title, path=path,
+                                     view_width=tinygraph.fmt_num(max(1, (to_ms - from_ms) / interval_ms)),
+                                     chart_height=CHART_HEIGHT)
@@ -1,24 +1,120 @@
+""" Translates Kibana urls to es-stream-logs ones. """
+
 import re
-from urllib.parse import unquote, urlparse
+from urllib.parse import unquote, urljoin, urlparse
 
+import aiohttp
 import requests
 
+import cache
+
+# short links and index patterns rarely change, but can be deleted or
+# replaced by new ones with the same name
+CACHE_TTL_S = 60 * 60
+SHORT_LINKS = cache.Cache(max_entries=1000)
+INDEX_PATTERNS = cache.Cache(max_entries=1000)
+
+TIMEOUT_S = 10
+
 
 def parse(kibana_url: str):
-    """ Parses a Kibana url into an es-stream-logs one. """
+    """ Parses a Kibana url into an es-stream-logs one.
 
-    if re.search(r"/app/kibana#/discover/\w+-\w+-\w+-\w+-\w+", kibana_url):
-        raise Exception("saved search not supported yet")
+    Blocks while resolving short links and index patterns, use
+    parse_async in the app. """
+
+    check_supported(kibana_url)
 
     if "/goto/" in kibana_url:
-        resp = requests.head(kibana_url, allow_redirects=True)
+        resp = requests.head(kibana_url, allow_redirects=True, timeout=TIMEOUT_S)
         resp.raise_for_status()
 
         kibana_url = resp.url
 
+    kibana_query = unquote(urlparse(kibana_url).fragment)
+    index = parse_index(kibana_query)
+    if needs_lookup(index):
+        resp = requests.get(index_pattern_url(kibana_url, index), timeout=TIMEOUT_S)
+        resp.raise_for_status()
+
+        index = resp.json()['attributes']['title']
+
+    return to_query(kibana_query, index)
+
+
+async def parse_async(kibana_url: str, session: aiohttp.ClientSession):
+    """ Parses a Kibana url into an es-stream-logs one, like parse.
+
+    Short links and index patterns are resolved using session and are
+    cached. """
+
+    check_supported(kibana_url)
+
+    if "/goto/" in kibana_url:
+        resolved = SHORT_LINKS.get(kibana_url)
+        if resolved is None:
+            resolved = await resolve_redirects(kibana_url, session)
+            SHORT_LINKS.set(kibana_url, resolved, ttl=CACHE_TTL_S)
+        kibana_url = resolved
+
+    kibana_query = unquote(urlparse(kibana_url).fragment)
+    index = parse_index(kibana_query)
+    if needs_lookup(index):
+        url = index_pattern_url(kibana_url, index)
+        title = INDEX_PATTERNS.get(url)
+        if title is None:
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=TIMEOUT_S)) as resp:
+                resp.raise_for_status()
+                title = (await resp.json())['attributes']['title']
+            INDEX_PATTERNS.set(url, title, ttl=CACHE_TTL_S)
+        index = title
+
+    return to_query(kibana_query, index)
+
+
+async def resolve_redirects(url: str, session: aiohttp.ClientSession, max_redirects=10):
+    """ Returns the url that url redirects to.
+
+    Redirects are followed manually, because aiohttp drops the fragment
+    of the redirect location, which contains the Kibana state. """
+
+    for _ in range(max_redirects):
+        async with session.head(url, allow_redirects=False, timeout=aiohttp.ClientTimeout(total=TIMEOUT_S)) as resp:
+            if resp.status not in (301, 302, 303, 307, 308):
+                resp.raise_for_status()
+                return url
+            url = urljoin(url, resp.headers["Location"])
+    raise Exception(f"too many redirects for {url}")
+
+
+def check_supported(kibana_url: str):
+    if re.search(r"/app/kibana#/discover/\w+-\w+-\w+-\w+-\w+", kibana_url):
+        raise Exception("saved search not supported yet")
+
+
+def parse_index(kibana_query: str):
+    """ Returns the index pattern of kibana_query, either its title or its id. """
+
+    # index:'application-*'
+    index = re.search(r"index:'?([^,'\"]+)'?", kibana_query)
+    if not index:
+        raise Exception("missing index", index)
+    return index[1]
+
+
+def needs_lookup(index: str):
+    """ Returns whether index is the id of an index pattern, not its title. """
+    return "-*" not in index
+
+
+def index_pattern_url(kibana_url: str, index_id: str):
     kibana_url = urlparse(kibana_url)
-    kibana_query = unquote(kibana_url.fragment)
-    print(kibana_query)
+    kibana_base = kibana_url.scheme + "://" + kibana_url.netloc
+    return kibana_base + "/api/saved_objects/index-pattern/" + index_id
+
+
+def to_query(kibana_query: str, index: str):
+    """ Translates the (unquoted) fragment of a Kibana url to es-stream-logs query params. """
 
     timestamp = re.search(r"from:([^,]+),(mode:[^,]+,)?to:([^,)]+)", kibana_query)
     from_timestamp = timestamp[1] if timestamp else 'now-15m'
@@ -36,18 +132,6 @@ def parse(kibana_url: str):
     if fields == "_source":
         fields = None
 
-    # index:'application-*'
-    index = re.search(r"index:'?([^,'\"]+)'?", kibana_query)
-    if not index:
-        raise Exception("missing index", index)
-    index = index[1]
-    if "-*" not in index:
-        kibana_base = kibana_url.scheme + "://" + kibana_url.netloc
-        resp = requests.get(kibana_base + "/api/saved_objects/index-pattern/" + index)
-        resp.raise_for_status()
-
-        index = resp.json()['attributes']['title']
-
     args = []
 
     # query:(match:(level:(query:ERROR,type:phrase)))
@@ -64,8 +148,7 @@ def parse(kibana_url: str):
             idx = kibana_query.index(query_marker, idx)
             idx += len(query_marker) - 1
 
-            depth, query = parse_parentheses(kibana_query[idx:])
-            print(idx, depth, query)
+            depth, query = parse_parentheses(kibana_query, idx)
             if depth == 3:
                 if query[0] == "match":
                     var_name = query[1][0]
@@ -95,32 +178,37 @@ def push(obj, levels, depth):
     levels.append(obj)
 
 
-def parse_parentheses(s):
+def parse_parentheses(s, start=0):
+    """ Parses the parenthesized group starting at s[start] into nested
+    lists, returns the maximum depth and the outermost group. """
+
     groups = []
     depth = 0
     max_depth = 0
 
-    group = ""
+    # characters of the current group, joined once it is complete
+    group = []
     try:
-        for ch in s:
+        for idx in range(start, len(s)):
+            ch = s[idx]
             if ch == '(':
-                if group != "":
-                    push(group, groups, depth)
-                    group = ""
+                if group:
+                    push("".join(group), groups, depth)
+                    group = []
 
                 push([], groups, depth)
                 depth += 1
                 max_depth = max(depth, max_depth)
             elif ch == ')':
-                if group != "":
-                    push(group, groups, depth)
-                    group = ""
+                if group:
+                    push("".join(group), groups, depth)
+                    group = []
                 depth -= 1
                 if depth == 0:
                     return max_depth, groups[0]
 
             else:
-                group += ch
+                group.append(ch)
     except IndexError:
         pass
 
@@ -0,0 +1,65 @@
+""" Field capabilities (i.e. mappings) of indices. """
+
+# fields of these types only match exact values, so filters can use
+# (cacheable) term queries instead of match_phrase queries
+KEYWORD_TYPES = {"keyword", "constant_keyword"}
+
+# percentiles can only be computed over the values of fields of these types
+NUMERIC_TYPES = {"long", "integer", "short", "byte", "unsigned_long", "double", "float", "half_float",
+                 "scaled_float", "date", "date_nanos"}
+
+# pseudo type for fields that are missing in some of the indices
+UNMAPPED = "unmapped"
+
+
+class FieldCaps:
+    """ Types and capabilities of the fields of an index pattern, as
+    returned by the `_field_caps` api. """
+
+    def __init__(self, fields):
+        self.fields = {name: {type_: caps for type_, caps in types.items() if type_ != UNMAPPED}
+                       for name, types in fields.items()}
+
+    def types(self, field):
+        """ Returns the types of field, over all indices. """
+        return set(self.fields.get(field, {}).keys())
+
+    def is_keyword(self, field):
+        types = self.types(field)
+        return bool(types) and types <= KEYWORD_TYPES
+
+    def is_aggregatable(self, field):
+        caps = self.fields.get(field)
+        return bool(caps) and all(cap.get("aggregatable") for cap in caps.values())
+
+    def aggregatable_field(self, field):
+        """ Returns field or its .keyword sub-field, whichever can be
+        aggregated on.  Fields that are not known are returned as is.
+
+        Raises ValueError if the field is known but can not be aggregated on. """
+
+        if self.is_aggregatable(field):
+            return field
+        if self.is_aggregatable(field + ".keyword"):
+            return field + ".keyword"
+        if field in self.fields:
+            types = ", ".join(sorted(self.types(field)))
+            raise ValueError(f"can not aggregate on field '{field}' of type {types}")
+        return field
+
+    def numeric_field(self, field):
+        """ Returns field if its values are numbers or dates, unlike its
+        .keyword sub-field.  Fields that are not known are returned as is.
+
+        Raises ValueError if the field is known but not numeric. """
+
+        types = self.types(field)
+        if types and not types <= NUMERIC_TYPES:
+            raise ValueError(f"can not compute percentiles of field '{field}' of type {', '.join(sorted(types))}")
+        return field
+
+
+async def fetch(es, index):
+    """ Fetches the field capabilities of all fields in index. """
+    resp = await es.field_caps(index=index, fields="*")
+    return FieldCaps(resp['fields'])
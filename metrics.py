@@ -0,0 +1,286 @@
+""" Metrics in the Prometheus text format.
+
+With multiple worker processes, each process writes its metrics to its
+own file in a shared directory and /metrics aggregates the files of all
+processes, so that it does not matter which worker serves it. """
+
+import json
+import math
+import os
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Metric:
+    """ A metric with values per combination of label values. """
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """ A value that can go up and down.
+
+    Over multiple processes, the values of live processes are combined
+    with mode, either "sum" or "max". """
+
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames=(), mode="sum"):
+        super().__init__(name, help, labelnames)
+        self.mode = mode
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """ Counts observations in buckets, values are [count per bucket..., sum]. """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts = self.values.get(key)
+        if counts is None:
+            counts = self.values[key] = [0] * len(self.buckets) + [0]
+        for idx, upper in enumerate(self.buckets):
+            if value <= upper:
+                counts[idx] += 1
+                break
+        counts[-1] += value
+
+
+def _merge(metric, into, values):
+    if metric.type == "histogram":
+        for key, counts in values:
+            merged = into.setdefault(key, [0] * len(counts))
+            for idx, count in enumerate(counts):
+                merged[idx] += count
+    elif metric.type == "gauge" and metric.mode == "max":
+        for key, value in values:
+            into[key] = max(into.get(key, value), value)
+    else:
+        for key, value in values:
+            into[key] = into.get(key, 0) + value
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [(name, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return f"{value:g}" if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """ The metrics of this process.
+
+    If directory is set, the metrics are written to a file per process
+    there and collected from all files. """
+
+    def __init__(self):
+        self.metrics = {}
+        self.directory = None
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=(), mode="sum"):
+        return self._register(Gauge(name, help, labelnames, mode))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"metrics-{pid}.json")
+
+    def write(self):
+        """ Writes the metrics of this process to its file, if a directory is set. """
+
+        if not self.directory:
+            return
+        data = {"pid": os.getpid(),
+                "metrics": {name: [[list(key), value] for key, value in metric.values.items()]
+                            for name, metric in self.metrics.items()}}
+        path = self._path(os.getpid())
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+
+    def collect(self):
+        """ Returns the values of all metrics by name, over all processes. """
+
+        if not self.directory:
+            return {name: dict(metric.values) for name, metric in self.metrics.items()}
+
+        self.write()
+        collected = {name: {} for name in self.metrics}
+        for filename in sorted(os.listdir(self.directory)):
+            if not (filename.startswith("metrics-") and filename.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            alive = _is_alive(data["pid"])
+            for name, values in data["metrics"].items():
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                # counters and histograms of exited processes still count,
+                # their gauges do not
+                if metric.type == "gauge" and not alive:
+                    continue
+                _merge(metric, collected[name], [(tuple(key), value) for key, value in values])
+        return collected
+
+    def render(self):
+        """ Renders all metrics in the Prometheus text format. """
+
+        lines = []
+        for name, values in self.collect().items():
+            metric = self.metrics[name]
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for key, value in sorted(values.items()):
+                if metric.type == "histogram":
+                    cumulative = 0
+                    for upper, count in zip(metric.buckets, value):
+                        cumulative += count
+                        labels = _format_labels(metric.labelnames, key, [("le", _format_value(float(upper)))])
+                        lines.append(f"{name}_bucket{labels} {cumulative}")
+                    labels = _format_labels(metric.labelnames, key)
+                    lines.append(f"{name}_sum{labels} {_format_value(float(value[-1]))}")
+                    lines.append(f"{name}_count{labels} {cumulative}")
+                else:
+                    lines.append(f"{name}{_format_labels(metric.labelnames, key)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.histogram("es_stream_logs_request_duration_seconds",
+                                      "Time until the response was sent completely, per route.",
+                                      ["route", "status"])
+SEARCH_TOOK = REGISTRY.histogram("es_stream_logs_search_took_seconds",
+                                 "Time elasticsearch reported for searches (took).", ["endpoint"])
+SEARCH_WALL = REGISTRY.histogram("es_stream_logs_search_wall_seconds",
+                                 "Wall-clock time of searches, including network and decoding.", ["endpoint"])
+ROWS_STREAMED = REGISTRY.counter("es_stream_logs_rows_streamed_total",
+                                 "Log rows streamed, per renderer.", ["renderer"])
+BYTES_STREAMED = REGISTRY.counter("es_stream_logs_bytes_streamed_total",
+                                  "Bytes of log streams sent, per renderer.", ["renderer"])
+ACTIVE_STREAMS = REGISTRY.gauge("es_stream_logs_active_streams", "Log streams that are currently open.")
+POLLS = REGISTRY.counter("es_stream_logs_polls_total", "Searches for new results of log streams.")
+EVENT_LOOP_LAG = REGISTRY.gauge("es_stream_logs_event_loop_lag_seconds",
+                                "Delay of a periodic timer on the event loop, the maximum of all workers.",
+                                mode="max")
+ES_CLIENTS = REGISTRY.counter("es_stream_logs_es_clients_created_total",
+                              "Elasticsearch clients created, per datacenter.", ["datacenter"])
+SEARCH_QUEUE_WAIT = REGISTRY.histogram("es_stream_logs_search_queue_wait_seconds",
+                                       "Time searches waited for a free slot, per datacenter and priority.",
+                                       ["datacenter", "priority"])
+SEARCHES_QUEUED = REGISTRY.gauge("es_stream_logs_searches_queued", "Searches waiting for a free slot, per datacenter.",
+                                 ["datacenter"])
+SEARCHES_REJECTED = REGISTRY.counter("es_stream_logs_searches_rejected_total",
+                                     "Searches rejected because the queue was full, per datacenter and priority.",
+                                     ["datacenter", "priority"])
+RESPONSE_CACHE_REQUESTS = REGISTRY.counter("es_stream_logs_response_cache_requests_total",
+                                           "Lookups in the response cache, per route and result (hit, miss or bypass).",
+                                           ["route", "result"])
+CACHE_BYTES = REGISTRY.gauge("es_stream_logs_cache_bytes", "Size of the in-process caches, per cache.", ["cache"])
+CACHE_ERRORS = REGISTRY.counter("es_stream_logs_cache_errors_total",
+                                "Failed requests to the cache backend, per cache.", ["cache"])
+SPOOL_REQUESTS = REGISTRY.counter("es_stream_logs_spool_requests_total",
+                                  "Lookups of finished searches in the spool, per result (hit, miss or bypass).",
+                                  ["result"])
+FANOUT_MISSING = REGISTRY.counter("es_stream_logs_fanout_missing_total",
+                                  "Searches over several datacenters that are missing one, per datacenter.",
+                                  ["datacenter"])
+CONFIG_RELOADS = REGISTRY.counter("es_stream_logs_config_reloads_total",
+                                  "Reloads of the config file after it changed, per result (ok or error).",
+                                  ["result"])
+
+
+def observe_search(endpoint, took_ms, wall_s):
+    """ Records the time elasticsearch took for a search and how long it took overall. """
+    SEARCH_TOOK.observe(took_ms / 1000, endpoint=endpoint)
+    SEARCH_WALL.observe(wall_s, endpoint=endpoint)
+
+
+class MetricsMiddleware:
+    """ Measures the time until the response is sent completely, which
+    for streamed responses is when the stream ends. """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_DURATION.observe(time.perf_counter() - start, route=route, status=status)
@@ -0,0 +1,155 @@
+""" Summaries of elasticsearch search profiles, i.e. of responses for
+searches with `"profile": true`. """
+
+from dataclasses import dataclass, field
+import re
+from typing import List, Optional
+
+# prefixes of filter parameters, see query.compile_plan
+FILTER_PREFIXES = "-:\\~/"
+
+
+@dataclass
+class Clause:
+    """ Time spent on a single query clause or aggregation, over all shards. """
+
+    kind: str
+    type: str
+    description: str
+    time_ms: float = 0
+    max_shard_ms: float = 0
+    # the url parameter that generated this clause, if known
+    param: Optional[str] = None
+
+
+@dataclass
+class Shard:
+    """ Time spent on a single shard. """
+
+    id: str
+    query_ms: float
+    rewrite_ms: float
+    aggregations_ms: float
+
+    @property
+    def total_ms(self):
+        return self.query_ms + self.rewrite_ms + self.aggregations_ms
+
+
+@dataclass
+class Summary:
+    shards: List[Shard] = field(default_factory=list)
+    clauses: List[Clause] = field(default_factory=list)
+
+    @property
+    def total_ms(self):
+        return sum(shard.total_ms for shard in self.shards)
+
+    def worst(self, num=3):
+        """ Returns the num clauses that took the most time. """
+        return [clause for clause in self.clauses[:num] if clause.time_ms > 0]
+
+    def worst_params(self, num=3):
+        """ Returns the url parameters of the num clauses that took the most time. """
+        return {clause.param for clause in self.worst(num) if clause.param}
+
+    def to_json(self):
+        return {
+            "total_ms": round(self.total_ms, 3),
+            "shards": [{"id": shard.id, "query_ms": round(shard.query_ms, 3),
+                        "rewrite_ms": round(shard.rewrite_ms, 3),
+                        "aggregations_ms": round(shard.aggregations_ms, 3)}
+                       for shard in self.shards],
+            "clauses": [{"kind": clause.kind, "type": clause.type, "description": clause.description,
+                         "time_ms": round(clause.time_ms, 3), "max_shard_ms": round(clause.max_shard_ms, 3),
+                         "param": clause.param}
+                        for clause in self.clauses],
+        }
+
+
+def filter_field(param):
+    """ Returns the field a filter parameter applies to, e.g. `level` for `-~level`. """
+    return param.lstrip(FILTER_PREFIXES)
+
+
+def find_param(kind, description, params):
+    """ Returns the url parameter (of params, as name -> value) that most
+    likely generated the clause with description. """
+
+    if kind == "aggregation":
+        # aggregations are named after the field they aggregate on
+        for name in ["aggregation_terms", "percentiles_terms"]:
+            if params.get(name) and description.removesuffix(".keyword") == params[name].removesuffix(".keyword"):
+                return name
+        if description == "num_results":
+            return "interval"
+        return None
+
+    if "@timestamp:" in description:
+        return "from"
+    for name in params:
+        field_name = filter_field(name)
+        if name in ["q", "aggregation_terms", "percentiles_terms"] or not field_name:
+            continue
+        # whole field names only, e.g. level: is not part of loglevel:
+        if re.search(rf"(?:^|[\s(])[+\-#]?{re.escape(field_name)}(?:\.keyword)?:", description):
+            return name
+    if "q" in params:
+        return "q"
+    return None
+
+
+def _self_ms(node):
+    """ Returns the time spent in node itself, without its children. """
+    children_ns = sum(child["time_in_nanos"] for child in node.get("children", []))
+    return max(0, node["time_in_nanos"] - children_ns) / 1_000_000
+
+
+def _walk(nodes):
+    for node in nodes:
+        yield node
+        yield from _walk(node.get("children", []))
+
+
+def summarize(profile, params):
+    """ Summarizes the profile of a search response per shard and per
+    clause, with the clauses that took the most time first.
+
+    params are the url parameters of the query, as name -> value, they are
+    used to find the parameter that generated each clause. """
+
+    summary = Summary()
+    clauses = {}
+
+    def add(kind, node, shard_times):
+        key = (kind, node["type"], node["description"])
+        clause = clauses.get(key)
+        if clause is None:
+            clause = Clause(kind=kind, type=node["type"], description=node["description"])
+            # compound clauses combine several parameters
+            if kind == "aggregation" or not node.get("children"):
+                clause.param = find_param(kind, node["description"], params)
+            clauses[key] = clause
+        time_ms = _self_ms(node)
+        shard_times[key] = shard_times.get(key, 0) + time_ms
+        clause.time_ms += time_ms
+
+    for shard in profile.get("shards", []):
+        shard_times = {}
+        query_ms = rewrite_ms = aggregations_ms = 0
+        for search in shard.get("searches", []):
+            query_ms += sum(node["time_in_nanos"] for node in search.get("query", [])) / 1_000_000
+            rewrite_ms += search.get("rewrite_time", 0) / 1_000_000
+            for node in _walk(search.get("query", [])):
+                add("query", node, shard_times)
+        aggregations_ms += sum(node["time_in_nanos"] for node in shard.get("aggregations", [])) / 1_000_000
+        for node in _walk(shard.get("aggregations", [])):
+            add("aggregation", node, shard_times)
+
+        for key, time_ms in shard_times.items():
+            clauses[key].max_shard_ms = max(clauses[key].max_shard_ms, time_ms)
+        summary.shards.append(Shard(id=shard.get("id", ""), query_ms=query_ms,
+                                    rewrite_ms=rewrite_ms, aggregations_ms=aggregations_ms))
+
+    summary.clauses = sorted(clauses.values(), key=lambda clause: clause.time_ms, reverse=True)
+    return summary
@@ -1,12 +1,26 @@
 """ This module handles query parsing and translation to elasticsearch. """
 
+import copy
+from dataclasses import dataclass
+import hashlib
+import json
+import time
+from typing import Optional, Tuple
+
 import fastapi
 import starlette.datastructures
 import urllib.parse
 
 from config import Config
+from mappings import FieldCaps
+from histogram import DEFAULT_RESOLUTION, MAX_RESOLUTION, MISSING_AGGREGATION, OTHER_TERM
+
+ONLY_ONCE_ARGUMENTS = ["from", "to", "dc", "index", "interval", "resolution"]
 
-ONLY_ONCE_ARGUMENTS = ["from", "to", "dc", "index", "interval"]
+# "terms" aggregates the top terms per histogram bucket, "global" first
+# finds the top terms over the whole time range and then counts only
+# those per bucket, with an explicit bucket for all other terms
+AGGREGATION_MODES = ["terms", "global"]
 
 
 def from_request(config, request: fastapi.Request):
@@ -27,21 +41,130 @@ def flatten_params(query_params: starlette.datastructures.QueryParams, exception
     return params
 
 
+@dataclass(frozen=True)
+class Plan:
+    """ The compiled filters of a query, i.e. everything except the time range.
+
+    Plans are built once per query and then shared between all searches
+    for it, e.g. for every poll when streaming logs. """
+
+    required: Tuple[dict, ...]
+    excluded: Tuple[dict, ...]
+
+
+def compile_plan(query_string, args, field_caps: Optional[FieldCaps] = None):
+    """ Compiles the filters given in args to elasticsearch queries.
+
+    If the field_caps of the index are known, exact values of keyword
+    fields are matched with term queries. """
+
+    required_filters = []
+    excluded_filters = []
+    if query_string:
+        required_filters.append(
+            {"query_string": {"query": query_string, "analyze_wildcard": True}})
+
+    compare_ops = {"<": "lt", ">": "gt"}
+    for key, val in args.items():
+        exclude = False
+        if key.startswith("-"):  # exclude results of this filter
+            exclude = True
+            key = key[1:]
+
+        if key.startswith(":"):  # deactivate/ignore this filter (ui feature)
+            continue
+
+        special = True
+        if key.startswith("\\"):  # don't parse special characters in filter
+            special = False
+            key = key[1:]
+
+        match_kind = "match_phrase"
+        if key.startswith("~"):
+            match_kind = "match"
+            key = key[1:]
+        elif key.startswith("/"):
+            match_kind = "regexp"
+            key = key[1:]
+
+        filters = []
+        if val == "":
+            filters.append({"exists": {"field": key}})
+        elif val[:1] in compare_ops:
+            compare_op = compare_ops[val[:1]]
+            try:
+                filters.append({"range": {key: {compare_op: int(val[1:])}}})
+            except ValueError:
+                msg = f"value for range query on '{key}' must be a number, but was '{val[1:]}'"
+                raise ValueError(msg)
+        elif match_kind == "match_phrase" and field_caps and field_caps.is_keyword(key):
+            if special and "," in val:
+                filters.append({"terms": {key: val.split(',')}})
+            else:
+                filters.append({"term": {key: val}})
+        else:
+            if special and "," in val:
+                filters.append({"bool": {
+                    "should": [{match_kind: {key: v}} for v in val.split(',')]
+                }})
+            else:
+                filters.append({match_kind: {key: val}})
+
+        if exclude:
+            excluded_filters.extend(filters)
+        else:
+            required_filters.extend(filters)
+
+    return Plan(required=tuple(required_filters), excluded=tuple(excluded_filters))
+
+
+def fingerprint(data):
+    """ Returns a stable hash of data, which must be serializable as json. """
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def normalize_timestamp(timestamp):
+    """ Returns timestamp in the same form for all ways to give the same
+    time, epoch millis if absolute and now-<seconds> if relative.
+    Timestamps only elasticsearch understands are returned as they are. """
+
+    if timestamp == "now":
+        return timestamp
+    try:
+        if timestamp.startswith("now-"):
+            return f"now-{parse_offset(timestamp[len('now-'):])}"
+        return int(parse_timestamp(timestamp) * 1000)
+    except (ValueError, IndexError):
+        return timestamp
+
+
 class Query:
     """ A Query contains all information necessary for handling a query
     to elasticsearch. """
 
     def __init__(self, config: Config, **kwargs):
         self.datacenter = kwargs.pop("dc", config.default_endpoint)
+        # several datacenters are searched at once, see fanout.py
+        self.datacenters = [datacenter.strip() for datacenter in self.datacenter.split(",") if datacenter.strip()]
         self.index = kwargs.pop("index", config.default_index)
 
         self.from_timestamp = kwargs.pop("from", "now-15m")
         self.to_timestamp = kwargs.pop("to", "now")
 
         self.interval = kwargs.pop("interval", "auto")
+        self.resolution = max(1, min(int(kwargs.pop("resolution", DEFAULT_RESOLUTION)), MAX_RESOLUTION))
+
+        self.request_cache = kwargs.pop("request_cache", "false") in ["true", "1"]
+        self.profile = kwargs.pop("profile", "false") in ["true", "1"]
+
+        compare = kwargs.pop("compare", None)
+        self.compare = [offset.strip() for offset in compare.split(",") if offset.strip()] if compare else []
 
         self.aggregation_terms = kwargs.pop("aggregation_terms", None)
         self.aggregation_size = int(kwargs.pop("aggregation_size", 5))
+        self.aggregation_mode = kwargs.pop("aggregation_mode", "terms")
+        if self.aggregation_mode not in AGGREGATION_MODES:
+            raise ValueError(f"aggregation_mode must be one of {', '.join(AGGREGATION_MODES)}, but was '{self.aggregation_mode}'")
         self.percentiles_terms = kwargs.pop("percentiles_terms", None)
         self.percentiles = list(map(float, kwargs.pop("percentiles", "50,90,99").split(",")))
         self.percentiles_str = ",".join(map(lambda p: str(int(p) if p.is_integer() else p), self.percentiles))
@@ -52,6 +175,15 @@ class Query:
 
         self.timeout = int(kwargs.pop("timeout", 30))
 
+        # only show a random fraction of the documents, e.g. 0.01 for huge
+        # time ranges, counts are estimated from it
+        self.sample = kwargs.pop("sample", None)
+        if self.sample is not None:
+            self.sample = float(self.sample)
+            # the largest probability of the random_sampler aggregation, other than 1
+            if not 0 < self.sample < 0.5:
+                raise ValueError(f"sample must be between 0 and 0.5 (exclusive), but was '{self.sample}'")
+
         self.sort = kwargs.pop("sort", "asc")
 
         self.query_string = kwargs.pop("q", None)
@@ -59,64 +191,35 @@ class Query:
         fields = kwargs.pop("fields", None)
         self.fields_original = fields
         self.fields = collect_fields(config, fields, index=self.index, **kwargs)
+        if len(self.datacenters) > 1 and self.fields and "_datacenter" not in self.fields:
+            self.fields.insert(1 if self.fields[0] == "@timestamp" else 0, "_datacenter")
+
+        # only used for rendering histograms
+        self.width = kwargs.pop("width", None)
+        self.height = kwargs.pop("height", None)
 
         self.args = kwargs
+        self.plan = compile_plan(self.query_string, self.args)
+
+        # from the parameters, so that they are the same before and after
+        # the field caps are known
+        self.filters_fingerprint = fingerprint([
+            sorted(self.datacenters), self.index, self.query_string,
+            # the order of filters does not change the results
+            sorted((key, val) for key, val in self.args.items() if not key.startswith(":"))])
+        self.fingerprint = self.params_fingerprint()
+
+    def params_fingerprint(self):
+        """ Returns the fingerprint of the parameters besides the filters,
+        before the aggregated fields are resolved by with_field_caps. """
+
+        return fingerprint([self.filters_fingerprint, self.sort,
+                            self.aggregation_terms, self.aggregation_size, self.aggregation_mode,
+                            self.percentiles_terms, self.percentiles, self.sample])
 
     def to_elasticsearch(self, from_timestamp, num_results=500):
         """ Create elasticsearch query from (query) parameters. """
 
-        required_filters = []
-        excluded_filters = []
-        if self.query_string:
-            required_filters.append(
-                {"query_string": {"query": self.query_string, "analyze_wildcard": True}})
-
-        compare_ops = {"<": "lt", ">": "gt"}
-        for key, val in self.args.items():
-            exclude = False
-            if key.startswith("-"):  # exclude results of this filter
-                exclude = True
-                key = key[1:]
-
-            if key.startswith(":"):  # deactivate/ignore this filter (ui feature)
-                continue
-
-            special = True
-            if key.startswith("\\"):  # don't parse special characters in filter
-                special = False
-                key = key[1:]
-
-            match_kind = "match_phrase"
-            if key.startswith("~"):
-                match_kind = "match"
-                key = key[1:]
-            elif key.startswith("/"):
-                match_kind = "regexp"
-                key = key[1:]
-
-            filters = []
-            if val == "":
-                filters.append({"exists": {"field": key}})
-            elif val[:1] in compare_ops:
-                compare_op = compare_ops[val[:1]]
-                try:
-                    filters.append({"range": {key: {compare_op: int(val[1:])}}})
-                except ValueError:
-                    msg = f"value for range query on '{key}' must be a number, but was '{val[1:]}'"
-                    raise ValueError(msg)
-            else:
-                if special and "," in val:
-                    filters.append({"bool": {
-                        "should": [{match_kind: {key: v}} for v in val.split(',')]
-                    }})
-                else:
-                    filters.append({match_kind: {key: val}})
-
-            if exclude:
-                excluded_filters.extend(filters)
-            else:
-                required_filters.extend(filters)
-
         timerange = {"range": {"@timestamp": {"gte": from_timestamp, "lt": self.to_timestamp}}}
         if self.sort == "desc" and self.from_timestamp != from_timestamp:
             timerange = {"range": {"@timestamp": {"gte": self.from_timestamp, "lt": from_timestamp}}}
@@ -125,23 +228,123 @@ class Query:
         if '_id' in self.args:
             timerange = {"match_all": {}}
 
+        # searches for aggregations only are sampled by sample_aggregations
+        sampling = [self.sample_filter()] if self.sample and num_results else []
+
         query = {
             "size": num_results,
-            "sort": [{"@timestamp": {"order": self.sort}}],
+            # sort values of date_nanos fields are epoch millis too, hits
+            # are cursored by them
+            "sort": [{"@timestamp": {"order": self.sort, "numeric_type": "date"}}],
             "track_total_hits": True,
             "query": {
                 "bool": {
-                    "must": [*required_filters, timerange],
-                    "must_not": excluded_filters
+                    # results are sorted by timestamp, so scoring is not needed
+                    "filter": [*self.plan.required, *sampling, timerange],
+                    "must_not": list(self.plan.excluded)
                 }
             }
         }
+        if self.profile:
+            query["profile"] = True
+        return query
+
+    # fingerprint (set in __init__) identifies the results of this query,
+    # independent of the time range, the order of parameters, whether
+    # defaults were given explicitly and the field caps
+
+    @property
+    def timerange(self):
+        """ Identifies the time range of this query, for cache keys. """
+        return [normalize_timestamp(self.from_timestamp), normalize_timestamp(self.to_timestamp)]
+
+    @property
+    def sample_seed(self):
+        """ Seeds the random sample, the same filters always get the same one. """
+        return int(self.filters_fingerprint[:8], 16)
+
+    def sample_filter(self):
+        """ Matches a random subset of about sample of the documents. """
+
+        return {"function_score": {
+            # uniformly distributed in [0, 1), stable per document
+            "functions": [{"random_score": {"seed": self.sample_seed, "field": "_seq_no"}}],
+            "boost_mode": "replace",
+            "min_score": 1 - self.sample,
+        }}
+
+    def sample_aggregations(self, aggs):
+        """ Returns aggs to compute on a random sample of the documents if
+        sampling, their counts are estimated for all documents then.  The
+        results are returned by sampled_aggregations. """
+
+        if not self.sample:
+            return aggs
+        return {"sample": {"random_sampler": {"probability": self.sample, "seed": self.sample_seed}, "aggs": aggs}}
+
+    def sampled_aggregations(self, aggregations):
+        """ Returns the results of aggregations from sample_aggregations. """
+        return aggregations["sample"] if self.sample else aggregations
+
+    def cache_key(self, *parts):
+        """ Returns a key for caching results of this query, parts must
+        identify everything else the results depend on, e.g. the time
+        range (see timerange). """
+        return fingerprint([self.fingerprint, *parts])
+
+    def with_field_caps(self, field_caps: FieldCaps):
+        """ Returns a copy of this query, using the field_caps of its index
+        to generate cheaper filters and to resolve aggregated fields.
+
+        Raises ValueError if a field can not be aggregated on, or if
+        percentiles are requested of a field that is not numeric. """
+
+        query = copy.copy(self)
+        if query.aggregation_terms:
+            query.aggregation_terms = field_caps.aggregatable_field(query.aggregation_terms)
+        if query.percentiles_terms:
+            query.percentiles_terms = field_caps.numeric_field(query.percentiles_terms)
+        query.plan = compile_plan(query.query_string, query.args, field_caps)
+        return query
+
+    def counting(self):
+        """ Returns a copy of this query whose aggregation only counts the
+        documents per bucket, without terms and percentiles. """
+
+        query = copy.copy(self)
+        query.aggregation_terms = None
+        query.percentiles_terms = None
+        query.fingerprint = query.params_fingerprint()
+        return query
+
+    def with_timerange(self, from_timestamp, to_timestamp):
+        """ Returns a copy of this query for a different time range. """
+        query = copy.copy(self)
+        query.from_timestamp = from_timestamp
+        query.to_timestamp = to_timestamp
         return query
 
-    def aggregation(self, name, interval):
-        """ Return (date_histogram) aggregation query. """
+    def aggregation(self, name, interval, top_terms=None):
+        """ Return (date_histogram) aggregation query.
+
+        With aggregation_mode "global", only the given top_terms are
+        counted per bucket.  Without top_terms, the top terms over the
+        whole time range are aggregated next to the histogram instead. """
         inner_aggs = {}
-        if self.aggregation_terms:
+        outer_aggs = {}
+        if self.aggregation_terms and self.aggregation_mode == "global":
+            if top_terms is None:
+                outer_aggs["top_terms"] = self.top_terms_aggregation()
+            else:
+                inner_aggs[self.aggregation_terms] = {
+                    "filters": {
+                        "filters": {str(term): {"term": {self.aggregation_terms: term}} for term in top_terms},
+                        # documents with a value that is not in the top terms
+                        "other_bucket_key": OTHER_TERM,
+                    }
+                }
+                inner_aggs[MISSING_AGGREGATION] = {"missing": {"field": self.aggregation_terms}}
+        elif self.aggregation_terms:
             inner_aggs[self.aggregation_terms] = {
                 "terms": {
                     "field": self.aggregation_terms,
@@ -170,8 +373,18 @@ class Query:
         }
         if self.percentiles_terms:
             aggregation[self.percentiles_terms] = inner_aggs[self.percentiles_terms]
+        aggregation.update(outer_aggs)
         return aggregation
 
+    def top_terms_aggregation(self):
+        """ Return aggregation for the top terms over the whole time range. """
+        return {
+            "terms": {
+                "field": self.aggregation_terms,
+                "size": self.aggregation_size,
+            }
+        }
+
     def as_url(self, base_url):
         """ Render query as url. """
         return base_url + '?' + self.as_params()
@@ -193,6 +406,8 @@ class Query:
         if self.aggregation_terms and not ("aggregation_terms", self.aggregation_terms) == without_param:
             params += [('aggregation_terms', self.aggregation_terms),
                        ('aggregation_size', str(self.aggregation_size))]
+            if self.aggregation_mode != "terms":
+                params += [('aggregation_mode', self.aggregation_mode)]
         if self.percentiles_terms and not ("percentiles_terms", self.percentiles_terms) == without_param:
             params += [('percentiles_terms', self.percentiles_terms),
                        ('percentiles', ",".join(map(str, self.percentiles)))]
@@ -200,6 +415,16 @@ class Query:
             params += [('sort', self.sort)]
         if self.interval != "auto":
             params += [('interval', self.interval)]
+        if self.resolution != DEFAULT_RESOLUTION:
+            params += [('resolution', str(self.resolution))]
+        if self.request_cache:
+            params += [('request_cache', 'true')]
+        if self.profile:
+            params += [('profile', '1')]
+        if self.sample:
+            params += [('sample', f"{self.sample:g}")]
+        if self.compare:
+            params += [('compare', ",".join(self.compare))]
         if self.query_string:
             params += [("q", self.query_string)]
         if self.fields_original:
@@ -207,6 +432,50 @@ class Query:
         return urllib.parse.urlencode(params)
 
 
+def parse_offset(offset):
+    """ Parse elastic-search style offset into seconds, e.g. 10s, 1m, 3h, 2d... """
+    suffix = offset[-1]
+    num = int(offset[:-1])
+    offset_in_s = 0
+    if suffix == "s":
+        offset_in_s = num
+    elif suffix == "m":
+        offset_in_s = num * 60
+    elif suffix == "h":
+        offset_in_s = num * 60 * 60
+    elif suffix == "d":
+        offset_in_s = num * 24 * 60 * 60
+    else:
+        raise ValueError(f"could not parse offset '{offset}'")
+    return offset_in_s
+
+
+def parse_timestamp(timestamp):
+    """ Parse elasticsearch-style timestamp, e.g. now-3h, 2019-09-09T00:00:00Z or epoch_millis. """
+    now = time.time()
+    if timestamp == "now":
+        return now
+    if timestamp.startswith("now-"):
+        offset = parse_offset(timestamp[len("now-"):])
+        return now - offset
+
+    # epoch millis
+    try:
+        return int(timestamp) / 1000
+    except ValueError:
+        pass
+
+    try:
+        return time.mktime(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+    except ValueError:
+        try:
+            return time.mktime(time.strptime(timestamp, '%Y-%m-%d'))
+        except ValueError:
+            pass
+
+    raise ValueError(f"could not parse timestamp '{timestamp}'")
+
+
 def collect_fields(cfg, fields, **kwargs):
     """ Collects fields by the given ones, or one of the default ones
         from the configuration. """
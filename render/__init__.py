@@ -1,6 +1,6 @@
 """ Handles rendering of results. """
 
-from .render_html import HTMLRenderer
+from .render_html import HTMLRenderer, HTMLRowsRenderer
 from .render_json import JSONRenderer
 
-__all__ = [HTMLRenderer, JSONRenderer]
+__all__ = [HTMLRenderer, HTMLRowsRenderer, JSONRenderer]
@@ -3,6 +3,7 @@
 import copy
 import json
 import string
+from urllib.parse import parse_qsl
 
 import elasticsearch
 
@@ -14,6 +15,29 @@ from config import Config
 from query import Query
 
 
+# compiled once, they are rendered for every row
+RESULT_TEMPLATE = Template(r"""
+<tr class="row{% if highlight %} highlight{% endif %}" data-source="{{ source_json | e }}" data-formatted-fields="{{ formatted_fields | e }}">
+    <td class="toggle-expand"{% if aggregation_color %} style="border-left: 0.5ex solid {{ aggregation_color }}; padding-left: 0.5ex;"{% endif %}>+</td>
+{% for field, val in fields.items() %}
+    <td data-field="{{ field | e }}" class="field-{{ field | e }}">
+        <span class="field-container">{{ val }}</span>
+        <a class="filter filter-include" title="Filter for results matching value" href="#">🔎</a>
+        <a class="filter filter-exclude" title="Exclude results matching value" href="#">🗑</a>
+    </td>
+{% endfor %}
+</tr>
+<tr class="source source-hidden"><td colspan="{{ 1 + len_fields }}"></td></tr>
+""")
+
+NOTICE_TEMPLATE = Template(r"""
+<tr data-source="{{ es_query_json | e }}">
+    <td class="toggle-expand">+</td>
+    <td class="{{ class_ }}" colspan="{{ width }}">{{ msg | e }}{% if more_url %} <a class="load-more" href="{{ more_url | e }}">Load more</a>{% endif %}</td>
+<tr class="source source-hidden"><td colspan="{{ 1 + width }}"></td></tr>
+""")
+
+
 class HTMLRenderer:
     """ Renders query result as HTML. """
 
@@ -90,6 +114,9 @@ class HTMLRenderer:
             </span>
         </span>
         <input type="text" name="aggregation_size" hidden value="{{ query.aggregation_size | e }}" />
+        {% if query.aggregation_mode != "terms" %}
+        <input type="text" name="aggregation_mode" hidden value="{{ query.aggregation_mode | e }}" />
+        {% endif %}
     {% endif %}
 
     {% if query.percentiles_terms %}
@@ -125,6 +152,14 @@ class HTMLRenderer:
             </select>
         </span>
 
+    {% if query.profile %}
+        <input type="text" name="profile" hidden value="1" />
+    {% endif %}
+
+    {% if query.sample %}
+        <input type="text" name="sample" hidden value="{{ "%g" | format(query.sample) }}" />
+    {% endif %}
+
         <input type="submit" value="Update" />
     </form>
 {% endblock query_form %}
@@ -165,6 +200,9 @@ class HTMLRenderer:
         datacenters = {}
         for datacenter in self.config.endpoints.keys():
             datacenters[datacenter] = datacenter == self.query.datacenter
+        if self.query.datacenter not in datacenters:
+            # several datacenters, e.g. dc1,dc2
+            datacenters[self.query.datacenter] = True
 
         sort_orders = {}
         for order in ["asc", "desc"]:
@@ -172,13 +210,63 @@ class HTMLRenderer:
 
         return template.render(map=map, str=str, len=len, min=min, aggregation_url=aggregation_url, fields=fields, datacenters=datacenters, query=self.query, indices=self.config.indices, sort_orders=sort_orders)
 
-    def num_results(self, results_total, took_ms, took_es_ms):
-        """ Render info about number of results. """
+    def num_results(self, results_total, took_ms, took_es_ms, estimated_total=None):
+        """ Render info about number of results, estimated_total is the
+        estimate for all documents if the results are a sample. """
+
+        estimated = f' data-estimated-total="{estimated_total}"' if estimated_total is not None else ""
+        return f"""<tr id="num-results" data-results-total="{results_total}"{estimated} data-took-ms="{took_ms}" data-took-es-ms="{took_es_ms}"></tr>"""
 
-        return f"""<tr id="num-results" data-results-total="{results_total}" data-took-ms="{took_ms}" data-took-es-ms="{took_es_ms}"></tr>"""
+    def timing(self, server_timing):
+        """ Render the timing of the request so far, as in the Server-Timing header. """
+
+        if not server_timing:
+            return ""
+        return f"""<tr class="server-timing" hidden data-server-timing="{escape(server_timing)}"></tr>"""
+
+    def queued(self, waited_s, es_query):
+        """ Render a notice that the search waited for a free slot. """
+
+        msg = f"Waited {waited_s:.1f}s for elasticsearch in {self.query.datacenter}, it is busy with other searches."
+        return self.__notice("queued", es_query, msg)
+
+    def profile(self, summary):
+        """ Render the profile of the search as a collapsible panel. """
+
+        template = Template(r"""
+<tr class="profile">
+    <td></td>
+    <td colspan="{{ width }}">
+        <details>
+            <summary>Profile: {{ "%.1f" | format(summary.total_ms) }} ms on {{ len(summary.shards) }} shards{% if worst %}, slowest: {{ worst[0].type | e }} {{ worst[0].description[:80] | e }}{% endif %}</summary>
+            <p>
+    {% for name, value in params %}
+                <code{% if name in worst_params %} class="profile-worst"{% endif %}>{{ name | e }}={{ value | e }}</code>
+    {% endfor %}
+            </p>
+            <table>
+                <tr><th>shard</th><th>query ms</th><th>rewrite ms</th><th>aggregations ms</th></tr>
+    {% for shard in summary.shards %}
+                <tr><td>{{ shard.id | e }}</td><td>{{ "%.1f" | format(shard.query_ms) }}</td><td>{{ "%.1f" | format(shard.rewrite_ms) }}</td><td>{{ "%.1f" | format(shard.aggregations_ms) }}</td></tr>
+    {% endfor %}
+            </table>
+            <table>
+                <tr><th>ms</th><th>max ms per shard</th><th>kind</th><th>type</th><th>clause</th><th>parameter</th></tr>
+    {% for clause in summary.clauses[:max_clauses] %}
+                <tr{% if clause in worst %} class="profile-worst"{% endif %}><td>{{ "%.1f" | format(clause.time_ms) }}</td><td>{{ "%.1f" | format(clause.max_shard_ms) }}</td><td>{{ clause.kind }}</td><td>{{ clause.type | e }}</td><td><code>{{ clause.description | e }}</code></td><td>{{ (clause.param or "") | e }}</td></tr>
+    {% endfor %}
+            </table>
+        </details>
+    </td>
+</tr>
+""")
+        return template.render(len=len, width=len(self.query.fields), summary=summary,
+                               worst=summary.worst(), worst_params=summary.worst_params(),
+                               params=parse_qsl(self.query.as_params()), max_clauses=20)
 
-    def result(self, hit, source):
-        """ Renders a single result. """
+    def result(self, hit, source, highlight=False):
+        """ Renders a single result, highlighted e.g. as the document
+        whose context is shown. """
 
         fields = {}
         for field in self.query.fields:
@@ -193,7 +281,7 @@ class HTMLRenderer:
             if field in self.config.field_format and val:
                 fmt = self.config.field_format[field]
                 val = FieldFormatter().format(fmt, __query=self.query.as_params(),
-                                              dc=self.query.datacenter, index=self.query.index,
+                                              dc=hit.get('_datacenter', self.query.datacenter), index=self.query.index,
                                               **hit['_source'])
             if field not in source:
                 val = '-'
@@ -208,25 +296,12 @@ class HTMLRenderer:
                 if val:
                     fmt = self.config.field_format[field]
                     val = FieldFormatter().format(fmt, __query=self.query.as_params(),
-                                                  dc=self.query.datacenter, index=self.query.index,
+                                                  dc=hit.get('_datacenter', self.query.datacenter), index=self.query.index,
                                                   **hit['_source'])
                     formatted_fields[field] = val
             except (IndexError, KeyError, ValueError):
                 pass
 
-        template = Template(r"""
-<tr class="row" data-source="{{ source_json | e }}" data-formatted-fields="{{ formatted_fields | e }}">
-    <td class="toggle-expand"{% if aggregation_color %} style="border-left: 0.5ex solid {{ aggregation_color }}; padding-left: 0.5ex;"{% endif %}>+</td>
-{% for field, val in fields.items() %}
-    <td data-field="{{ field | e }}" class="field-{{ field | e }}">
-        <span class="field-container">{{ val }}</span>
-        <a class="filter filter-include" title="Filter for results matching value" href="#">🔎</a>
-        <a class="filter filter-exclude" title="Exclude results matching value" href="#">🗑</a>
-    </td>
-{% endfor %}
-</tr>
-<tr class="source source-hidden"><td colspan="{{ 1 + len_fields }}"></td></tr>
-""")
         source_with_meta = hit['_source']
         source_with_meta['_id'] = hit['_id']
         source_with_meta['_index'] = hit['_index']
@@ -237,9 +312,9 @@ class HTMLRenderer:
                 aggregation_color = self.color_mapper.to_color(val)
             except (IndexError, KeyError, ValueError):
                 pass
-        return template.render(source_json=json.dumps(source_with_meta), len_fields=len(self.query.fields),
-                               fields=fields, formatted_fields=json.dumps(formatted_fields),
-                               aggregation_color=aggregation_color)
+        return RESULT_TEMPLATE.render(source_json=json.dumps(source_with_meta), len_fields=len(self.query.fields),
+                                      fields=fields, formatted_fields=json.dumps(formatted_fields),
+                                      aggregation_color=aggregation_color, highlight=highlight)
 
     def end(self):
         """ Renders end of results. """
@@ -248,10 +323,10 @@ class HTMLRenderer:
 </body>
 </html>"""
 
-    def warning(self, msg, es_query):
-        """ Render warning. """
+    def warning(self, msg, es_query, more_url=None):
+        """ Render warning, with a link to load the next page of results if more_url is given. """
 
-        return self.__notice("warning", es_query, msg)
+        return self.__notice("warning", es_query, msg, more_url)
 
     def error(self, ex, es_query):
         """ Render error. """
@@ -263,14 +338,23 @@ class HTMLRenderer:
             msg = f"ERROR!: {str(ex)}"
             return self.__notice("error", es_query, msg)
 
-    def __notice(self, class_, es_query, msg):
-        template = Template(r"""
-<tr data-source="{{ es_query_json | e }}">
-    <td class="toggle-expand">+</td>
-    <td class="{{ class_ }}" colspan="{{ width }}">{{ msg | e }}</td>
-<tr class="source source-hidden"><td colspan="{{ 1 + width }}"></td></tr>
-""")
-        return template.render(es_query_json=json.dumps(es_query), class_=class_, width=len(self.query.fields), msg=msg)
+    def __notice(self, class_, es_query, msg, more_url=None):
+        return NOTICE_TEMPLATE.render(es_query_json=json.dumps(es_query), class_=class_, width=len(self.query.fields), msg=msg,
+                                      more_url=more_url)
+
+
+class HTMLRowsRenderer(HTMLRenderer):
+    """ Renders only the rows of results, e.g. to append the next page of
+    results to the table of a page rendered by HTMLRenderer. """
+
+    def start(self):
+        return ""
+
+    def num_results(self, results_total, took_ms, took_es_ms, estimated_total=None):
+        return ""
+
+    def end(self):
+        return ""
 
 
 def nested_get(dct, keys):
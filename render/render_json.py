@@ -12,17 +12,26 @@ class JSONRenderer:
     def start(self):
         return "["
 
-    def num_results(self, results_total, took_ms, took_es_ms):
+    def num_results(self, results_total, took_ms, took_es_ms, estimated_total=None):
         return ""
 
-    def result(self, hit, source):
+    def profile(self, summary):
+        return ""
+
+    def timing(self, server_timing):
+        return ""
+
+    def queued(self, waited_s, es_query):
+        return ""
+
+    def result(self, hit, source, highlight=False):
         prefix = ", "
         if self.is_first:
             prefix = ""
             self.is_first = False
         return prefix + json.dumps(source)
 
-    def warning(self, msg, es_query):
+    def warning(self, msg, es_query, more_url=None):
         return ""
 
     def error(self, ex, es_query):
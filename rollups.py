@@ -0,0 +1,150 @@
+""" Local store for histogram buckets of closed time ranges.
+
+Buckets of time ranges that are closed (i.e. that will not receive any
+new data) never change, so they are stored locally in an sqlite database
+and long-range histograms only need to query elasticsearch for the part
+that is not stored yet. """
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from histogram import Histogram
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    series_key TEXT NOT NULL,
+    interval_s INTEGER NOT NULL,
+    covered_from INTEGER NOT NULL,
+    covered_to INTEGER NOT NULL,
+    last_access REAL NOT NULL,
+    PRIMARY KEY (series_key, interval_s)
+);
+
+CREATE TABLE IF NOT EXISTS buckets (
+    series_key TEXT NOT NULL,
+    interval_s INTEGER NOT NULL,
+    key INTEGER NOT NULL,
+    doc_count INTEGER NOT NULL,
+    terms TEXT,
+    percentiles TEXT,
+    PRIMARY KEY (series_key, interval_s, key)
+) WITHOUT ROWID;
+"""
+
+
+class RollupStore:
+    """ Stores histogram buckets per series (i.e. query) and interval.
+
+    For each series a single contiguous time range [covered_from,
+    covered_to) is stored.  Buckets without documents are not stored,
+    but are known to be empty if they are in the covered range.
+
+    The database is shared between processes, if it grows larger than
+    max_bytes the least recently used series are evicted. """
+
+    def __init__(self, directory, max_bytes):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "rollups.sqlite")
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+        # must be set before any tables are created
+        self.db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def load(self, series_key, interval_s, from_ms, to_ms):
+        """ Returns the stored histogram for [from_ms, to_ms) and the end
+        of the stored part of that range, or None if from_ms is not stored. """
+
+        with self.lock:
+            row = self.db.execute("SELECT covered_from, covered_to FROM series WHERE series_key = ? AND interval_s = ?",
+                                  (series_key, interval_s)).fetchone()
+            if not row or not row[0] <= from_ms < row[1]:
+                return None
+            covered_to = min(row[1], to_ms)
+
+            self.db.execute("UPDATE series SET last_access = ? WHERE series_key = ? AND interval_s = ?",
+                            (time.time(), series_key, interval_s))
+            rows = self.db.execute("SELECT key, doc_count, terms, percentiles FROM buckets "
+                                   "WHERE series_key = ? AND interval_s = ? AND key >= ? AND key < ? ORDER BY key",
+                                   (series_key, interval_s, from_ms, covered_to)).fetchall()
+
+        histogram = Histogram(interval_s=interval_s)
+        for idx, (key, doc_count, terms, percentiles) in enumerate(rows):
+            histogram.keys.append(key)
+            histogram.counts.append(doc_count)
+            # stored as pairs to keep the type of the terms, e.g. numbers
+            for term, count in json.loads(terms or "[]"):
+                histogram.terms.setdefault(term, [0] * len(rows))[idx] = count
+            for percentile, value in json.loads(percentiles or "{}").items():
+                histogram.percentiles.setdefault(percentile, [None] * len(rows))[idx] = value
+        histogram.terms = dict(sorted(histogram.terms.items(), key=lambda item: str(item[0])))
+        return histogram, covered_to
+
+    def store(self, series_key, interval_s, histogram: Histogram, from_ms, to_ms):
+        """ Stores the buckets of histogram in [from_ms, to_ms), which
+        must only contain complete buckets of a closed time range.
+
+        Extends the stored range if it overlaps or touches the existing
+        one, otherwise replaces it. """
+
+        rows = []
+        for idx, (key, count) in enumerate(zip(histogram.keys, histogram.counts)):
+            if not from_ms <= key < to_ms:
+                continue
+            terms = [[term, counts[idx]] for term, counts in histogram.terms.items() if counts[idx]]
+            percentiles = {percentile: values[idx] for percentile, values in histogram.percentiles.items()}
+            rows.append((series_key, interval_s, key, count,
+                         json.dumps(terms) if terms else None,
+                         json.dumps(percentiles) if percentiles else None))
+
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT covered_from, covered_to FROM series WHERE series_key = ? AND interval_s = ?",
+                                      (series_key, interval_s)).fetchone()
+                if row and row[0] <= to_ms and from_ms <= row[1]:
+                    from_ms, to_ms = min(row[0], from_ms), max(row[1], to_ms)
+                else:
+                    self.db.execute("DELETE FROM buckets WHERE series_key = ? AND interval_s = ?",
+                                    (series_key, interval_s))
+
+                self.db.executemany("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?, ?)", rows)
+                self.db.execute("INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?)",
+                                (series_key, interval_s, from_ms, to_ms, time.time()))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+            self._evict()
+
+    def size(self):
+        """ Returns the size of the stored data in bytes. """
+        page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+        page_count = self.db.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def _evict(self):
+        """ Evicts least recently used series until the store is smaller than max_bytes. """
+
+        evicted = False
+        while self.size() > self.max_bytes:
+            row = self.db.execute("SELECT series_key, interval_s FROM series ORDER BY last_access LIMIT 1").fetchone()
+            if not row:
+                break
+            self.db.execute("DELETE FROM buckets WHERE series_key = ? AND interval_s = ?", row)
+            self.db.execute("DELETE FROM series WHERE series_key = ? AND interval_s = ?", row)
+            evicted = True
+
+        if evicted:
+            self.db.execute("PRAGMA incremental_vacuum")
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,399 @@
+""" Caches that can be shared by all worker processes.
+
+Each cache is a namespace in a backend, which is configured once per
+process with `cache_url`:
+
+- not set: in-process caches, every worker has its own
+- `sqlite:///dev/shm/es-stream-logs/cache.sqlite`: an sqlite database
+  shared by all workers on a host, on a tmpfs it is kept in memory
+- `redis://host:6379/0`: a server speaking the Redis protocol, shared by
+  all hosts
+
+Shared backends store values as bytes, so caches define how to encode
+their values.  Errors of the backend are logged and treated as misses,
+the cache is an optimization only. """
+
+import asyncio
+from dataclasses import asdict
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, NamedTuple
+from urllib.parse import unquote, urlparse
+
+import cache
+from histogram import Histogram
+import mappings
+import metrics
+
+
+class CacheError(Exception):
+    """ Raised by backends if a command failed. """
+
+
+class ConnectionClosed(CacheError):
+    """ Raised if the server closed the connection. """
+
+
+class Codec(NamedTuple):
+    encode: Callable
+    decode: Callable
+
+
+BYTES = Codec(encode=lambda value: value, decode=lambda value: value)
+TEXT = Codec(encode=lambda value: value.encode("utf-8"), decode=lambda value: value.decode("utf-8"))
+
+
+def _encode_histogram(hist: Histogram):
+    data = asdict(hist)
+    # stored as pairs to keep the type of the terms, e.g. numbers
+    data["terms"] = list(data["terms"].items())
+    return json.dumps(data).encode("utf-8")
+
+
+def _decode_histogram(value):
+    data = json.loads(value)
+    data["terms"] = dict(data["terms"])
+    return Histogram(**data)
+
+
+HISTOGRAM = Codec(encode=_encode_histogram, decode=_decode_histogram)
+FIELD_CAPS = Codec(encode=lambda field_caps: json.dumps(field_caps.fields).encode("utf-8"),
+                   decode=lambda value: mappings.FieldCaps(json.loads(value)))
+
+
+class Backend:
+    """ Interface of cache backends. """
+
+    # whether values are stored as they are, instead of encoded as bytes
+    stores_objects = False
+
+    async def get(self, namespace, key):
+        """ Returns the value for key in namespace (a SharedCache), or None. """
+
+    async def set(self, namespace, key, value, ttl=None):
+        """ Stores value for key in namespace, expiring after ttl seconds if given. """
+
+    async def add(self, namespace, key, value, ttl=None):
+        """ Stores value like set if there is no value for key, returns
+        whether it was stored. """
+
+    async def close(self):
+        pass
+
+
+class MemoryBackend(Backend):
+    """ Keeps the values of every namespace in an in-process LRU cache,
+    bounded by the limits of the namespace. """
+
+    stores_objects = True
+
+    def __init__(self):
+        self.caches = {}
+
+    def _cache(self, namespace):
+        local = self.caches.get(namespace.name)
+        if local is None:
+            local = self.caches[namespace.name] = cache.Cache(namespace.max_entries, namespace.max_bytes)
+        return local
+
+    async def get(self, namespace, key):
+        return self._cache(namespace).get(key)
+
+    async def set(self, namespace, key, value, ttl=None):
+        local = self._cache(namespace)
+        local.set(key, value, ttl=ttl)
+        metrics.CACHE_BYTES.set(local.size, cache=namespace.name)
+
+    async def add(self, namespace, key, value, ttl=None):
+        if self._cache(namespace).get(key) is not None:
+            return False
+        await self.set(namespace, key, value, ttl)
+        return True
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires_at REAL,
+    last_access REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+"""
+
+
+class SqliteBackend(Backend):
+    """ Stores values in an sqlite database shared by all processes on
+    a host.  If the values are larger than max_bytes in total, the least
+    recently used ones are evicted. """
+
+    # only record accesses that are at least this much apart, to avoid a
+    # write for every read
+    ACCESS_RESOLUTION_S = 60
+    EVICT_EVERY_SETS = 50
+
+    def __init__(self, path, max_bytes):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.num_sets = 0
+
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # it is a cache, losing the last writes on a crash does not matter
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.executescript(SQLITE_SCHEMA)
+
+    def _get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT value, expires_at, last_access FROM entries WHERE key = ?",
+                                  (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires_at, last_access = row
+            if expires_at is not None and expires_at < now:
+                self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            if now - last_access > self.ACCESS_RESOLUTION_S:
+                self.db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+        return value
+
+    def _set(self, key, value, ttl):
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                            (key, value, len(value), now + ttl if ttl is not None else None, now))
+            self.num_sets += 1
+            if self.num_sets % self.EVICT_EVERY_SETS == 0:
+                self._evict(now)
+
+    def _add(self, key, value, ttl):
+        now = time.time()
+        with self.lock:
+            self.db.execute("DELETE FROM entries WHERE key = ? AND expires_at < ?", (key, now))
+            cursor = self.db.execute("INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?)",
+                                     (key, value, len(value), now + ttl if ttl is not None else None, now))
+            return cursor.rowcount == 1
+
+    def _evict(self, now):
+        self.db.execute("DELETE FROM entries WHERE expires_at < ?", (now,))
+        size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        while size > self.max_bytes:
+            rows = self.db.execute("SELECT key, size FROM entries ORDER BY last_access LIMIT 100").fetchall()
+            if not rows:
+                break
+            self.db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in rows])
+            size -= sum(row_size for _, row_size in rows)
+
+    async def get(self, namespace, key):
+        return await asyncio.to_thread(self._get, f"{namespace.name}:{key}")
+
+    async def set(self, namespace, key, value, ttl=None):
+        await asyncio.to_thread(self._set, f"{namespace.name}:{key}", value, ttl)
+
+    async def add(self, namespace, key, value, ttl=None):
+        return await asyncio.to_thread(self._add, f"{namespace.name}:{key}", value, ttl)
+
+    async def close(self):
+        self.db.close()
+
+
+class RedisBackend(Backend):
+    """ Stores values in a server speaking the Redis protocol (RESP),
+    which is responsible for evicting them, e.g. with
+    `maxmemory-policy allkeys-lru`. """
+
+    def __init__(self, host, port=6379, db=0, password=None, prefix="es-stream-logs:", max_idle=10, timeout_s=1):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.prefix = prefix
+        self.max_idle = max_idle
+        self.timeout_s = timeout_s
+        self.idle = []
+
+    async def _connect(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout_s)
+        try:
+            if self.password:
+                await self._execute(reader, writer, b"AUTH", self.password)
+            if self.db:
+                await self._execute(reader, writer, b"SELECT", str(self.db))
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def command(self, *args):
+        """ Sends a command and returns its reply, using an idle connection if there is one. """
+
+        reused = bool(self.idle)
+        reader, writer = self.idle.pop() if reused else await self._connect()
+        try:
+            reply = await asyncio.wait_for(self._execute(reader, writer, *args), self.timeout_s)
+        except (ConnectionClosed, ConnectionError):
+            writer.close()
+            # idle connections might have been closed by the server meanwhile
+            if reused:
+                return await self.command(*args)
+            raise
+        except BaseException:
+            # the connection might be in the middle of a reply
+            writer.close()
+            raise
+        if len(self.idle) < self.max_idle:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+        return reply
+
+    async def _execute(self, reader, writer, *args):
+        writer.write(encode_command(*args))
+        await writer.drain()
+        return await read_reply(reader)
+
+    async def get(self, namespace, key):
+        return await self.command(b"GET", f"{self.prefix}{namespace.name}:{key}")
+
+    async def set(self, namespace, key, value, ttl=None, *options):
+        args = [b"SET", f"{self.prefix}{namespace.name}:{key}", value]
+        if ttl is not None:
+            args += [b"PX", str(max(1, int(ttl * 1000)))]
+        return await self.command(*args, *options)
+
+    async def add(self, namespace, key, value, ttl=None):
+        return await self.set(namespace, key, value, ttl, b"NX") is not None
+
+    async def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle.clear()
+
+
+def encode_command(*args):
+    """ Encodes a command as an array of bulk strings. """
+
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def read_reply(reader):
+    """ Reads a reply, raises CacheError for error replies. """
+
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionClosed("connection closed")
+    kind, data = line[:1], line[1:-2]
+    if kind == b"+":
+        return data.decode("utf-8")
+    if kind == b"-":
+        raise CacheError(data.decode("utf-8", errors="replace"))
+    if kind == b":":
+        return int(data)
+    if kind == b"$":
+        length = int(data)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if kind == b"*":
+        length = int(data)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise CacheError(f"unexpected reply {line[:20]!r}")
+
+
+def from_url(url, max_bytes):
+    """ Returns the backend for url, see the module docstring. """
+
+    if not url or url == "memory":
+        return MemoryBackend()
+
+    parsed = urlparse(url)
+    if parsed.scheme == "sqlite":
+        return SqliteBackend(unquote(parsed.path), max_bytes)
+    if parsed.scheme == "redis":
+        db = int(parsed.path.lstrip("/") or 0)
+        password = unquote(parsed.password) if parsed.password else None
+        return RedisBackend(parsed.hostname or "localhost", parsed.port or 6379, db, password)
+    raise ValueError(f"unsupported cache url '{url}', must be memory, sqlite:///path or redis://host:port/db")
+
+
+BACKEND = MemoryBackend()
+
+
+def configure(backend: Backend):
+    """ Sets the backend of all caches of this process. """
+    global BACKEND
+    BACKEND = backend
+
+
+class SharedCache:
+    """ A cache in the configured backend.
+
+    max_entries and max_bytes only limit in-process caches, shared
+    backends have limits of their own. """
+
+    def __init__(self, name, codec=BYTES, max_entries=1000, max_bytes=None):
+        self.name = name
+        self.codec = codec
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def _key(key):
+        return key if isinstance(key, str) else json.dumps(key)
+
+    async def get(self, key):
+        """ Returns the value for key, or None if it is missing, expired or the backend failed. """
+
+        backend = BACKEND
+        try:
+            value = await backend.get(self, self._key(key))
+        except (CacheError, OSError, asyncio.TimeoutError, sqlite3.Error) as ex:
+            print(f"could not get from cache {self.name}:", ex)
+            metrics.CACHE_ERRORS.inc(cache=self.name)
+            return None
+        if value is None or backend.stores_objects:
+            return value
+        return self.codec.decode(value)
+
+    async def set(self, key, value, ttl=None):
+        """ Stores value for key, expiring after ttl seconds if given. """
+
+        backend = BACKEND
+        if not backend.stores_objects:
+            value = self.codec.encode(value)
+        try:
+            await backend.set(self, self._key(key), value, ttl)
+        except (CacheError, OSError, asyncio.TimeoutError, sqlite3.Error) as ex:
+            print(f"could not set in cache {self.name}:", ex)
+            metrics.CACHE_ERRORS.inc(cache=self.name)
+
+    async def add(self, key, value, ttl=None):
+        """ Stores value for key unless there is one already, returns
+        whether it was stored, e.g. to let only one of all processes do
+        something.  If the backend failed, it returns True, so that every
+        process goes on as if it had no shared backend. """
+
+        backend = BACKEND
+        if not backend.stores_objects:
+            value = self.codec.encode(value)
+        try:
+            return await backend.add(self, self._key(key), value, ttl)
+        except (CacheError, OSError, asyncio.TimeoutError, sqlite3.Error) as ex:
+            print(f"could not add to cache {self.name}:", ex)
+            metrics.CACHE_ERRORS.inc(cache=self.name)
+            return True
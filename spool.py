@@ -0,0 +1,210 @@
+""" Local spool of the results of finished searches, so that they can be
+rendered again (e.g. as json, with other fields or after a reload)
+without searching again.
+
+Each result set is stored in one file named by its key, `<key>.spool`:
+a header, the hits as json lines and the offsets of the hits, so that
+any hit can be read without reading the ones before it.  The hits are
+buffered while the results are streamed and written to a temporary file
+by flush(), which is moved in place once the stream finished, so that
+readers see either all of a result set or nothing.  It is read by
+memory-mapping it.
+
+The directory can be shared by all processes on a host, if it grows
+larger than max_bytes the least recently used result sets are removed. """
+
+from array import array
+import json
+import mmap
+import os
+import struct
+import time
+import uuid
+
+# magic, total number of results of the search, whether there were more
+# results than stored, offset of the offsets of the hits
+HEADER = struct.Struct("<8sQQQ")
+MAGIC = b"esspool2"
+SPOOLED, TMP = ".spool", ".tmp"
+# files of earlier versions, which are removed when evicting
+OUTDATED = (".hits", ".idx")
+
+# buffered hits are written once they are this large, see SpoolWriter.flush
+FLUSH_BYTES = 256 * 1024
+
+# temporary files of writers that did not finish, e.g. after a crash
+STALE_TMP_S = 60 * 60
+
+
+class SpooledResults:
+    """ The hits of a spooled search, by position. """
+
+    def __init__(self, path):
+        self.offsets = None
+        with open(path, "rb") as f:
+            # empty files cannot be mapped
+            if not os.fstat(f.fileno()).st_size:
+                raise ValueError(f"{path} is not spooled results")
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, self.results_total, more, index_offset = HEADER.unpack_from(self.map)
+        except struct.error:
+            magic = None
+        if magic != MAGIC or not HEADER.size <= index_offset < len(self.map) or (len(self.map) - index_offset) % 8:
+            self.close()
+            raise ValueError(f"{path} is not spooled results")
+        self.more = bool(more)
+        self.offsets = memoryview(self.map)[index_offset:].cast("Q")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return json.loads(self.map[self.offsets[idx]:self.offsets[idx + 1]])
+
+    def covers(self, max_results):
+        """ Returns whether the first max_results hits ("all" for all) are stored. """
+        return not self.more or (max_results != "all" and max_results <= len(self))
+
+    def close(self):
+        if self.offsets is not None:
+            self.offsets.release()
+            self.offsets = None
+        self.map.close()
+
+
+class SpoolWriter:
+    """ Appends the hits of a stream to the spool, they become visible
+    once finish() is called.  Result sets larger than the spool are
+    discarded.
+
+    append() only buffers the hits, flush(), finish() and discard() do
+    file operations and are called outside of the event loop, e.g. with
+    asyncio.to_thread once should_flush() returns True. """
+
+    def __init__(self, spool, key):
+        self.spool = spool
+        self.key = key
+        self.tmp_path = spool.path(key, f".{uuid.uuid4().hex[:8]}{SPOOLED}{TMP}")
+        self.file = open(self.tmp_path, "wb")
+        # the header is written once the stream finished
+        self.file.write(bytes(HEADER.size))
+        self.buffer = []
+        self.offsets = array("Q", [HEADER.size])
+        self.flushed = HEADER.size
+        self.done = False
+
+    def append(self, hit):
+        if self.done:
+            return
+        data = json.dumps(hit).encode("utf-8") + b"\n"
+        self.buffer.append(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+        if self.offsets[-1] > self.spool.max_bytes:
+            self.discard()
+
+    def should_flush(self):
+        return not self.done and self.offsets[-1] - self.flushed >= FLUSH_BYTES
+
+    def flush(self):
+        """ Writes the buffered hits to the temporary file. """
+
+        if self.done:
+            return
+        buffer, self.buffer = self.buffer, []
+        self.file.writelines(buffer)
+        self.flushed = self.offsets[-1]
+
+    def finish(self, results_total, more):
+        """ Moves the result set in place, more tells whether the search
+        had more results than were appended. """
+
+        if self.done:
+            return
+        self.flush()
+        self.done = True
+        self.file.write(self.offsets.tobytes())
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, results_total, int(more), self.offsets[-1]))
+        self.file.close()
+        os.replace(self.tmp_path, self.spool.path(self.key))
+        self.spool.evict()
+
+    def discard(self):
+        """ Removes what was written, unless it was finished already. """
+
+        if self.done:
+            return
+        self.done = True
+        self.buffer = []
+        self.file.close()
+        try:
+            os.unlink(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class Spool:
+    """ A directory of spooled result sets, at most max_bytes large. """
+
+    def __init__(self, directory, max_bytes):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key, suffix=SPOOLED):
+        return os.path.join(self.directory, key + suffix)
+
+    def open(self, key):
+        """ Returns the spooled results for key, or None if there are none. """
+
+        try:
+            results = SpooledResults(self.path(key))
+        except (FileNotFoundError, ValueError):
+            return None
+        # the modification time is the last access, for evicting
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            pass
+        return results
+
+    def writer(self, key):
+        return SpoolWriter(self, key)
+
+    def evict(self):
+        """ Removes the least recently used result sets until the spool is
+        smaller than max_bytes, and stale temporary files. """
+
+        now = time.time()
+        result_sets = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith(TMP):
+                if now - stat.st_mtime > STALE_TMP_S:
+                    self._unlink(entry.path)
+            elif entry.name.endswith(OUTDATED):
+                self._unlink(entry.path)
+            elif entry.name.endswith(SPOOLED):
+                result_sets.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in result_sets)
+        for _, size, path in sorted(result_sets):
+            if total <= self.max_bytes:
+                break
+            self._unlink(path)
+            total -= size
+
+    def size(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory) if not entry.name.endswith(TMP))
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
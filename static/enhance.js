@@ -7,7 +7,12 @@ var resultsRefresh = window.setInterval(function() {
         let resultsTotal = parseInt(numResultsEl.dataset['resultsTotal']);
         let tookMs = parseInt(numResultsEl.dataset['tookMs']);
         let tookEsMs = parseInt(numResultsEl.dataset['tookEsMs']);
-        numHitsMsg += ` of ${resultsTotal.toLocaleString()} results (took ${tookMs}ms total, es ${tookEsMs}ms)`;
+        numHitsMsg += ` of ${resultsTotal.toLocaleString()} results`;
+        if (numResultsEl.dataset['estimatedTotal']) {
+            let estimatedTotal = parseInt(numResultsEl.dataset['estimatedTotal']);
+            numHitsMsg += ` in the sample, ~${estimatedTotal.toLocaleString()} in total`;
+        }
+        numHitsMsg += ` (took ${tookMs}ms total, es ${tookEsMs}ms)`;
 
         if (resultsCount == 1 && resultsTotal == 1) {
             expandSource(document.querySelector('tr.row > td.toggle-expand'));
@@ -48,6 +53,19 @@ window.addEventListener("DOMContentLoaded", function() {
     histogramRefresh = false;
 });
 
+// the document shown by /context
+function scrollToHighlight() {
+    let highlighted = document.querySelector("tr.row.highlight");
+    if (highlighted) {
+        highlighted.scrollIntoView({"block": "center"});
+    }
+}
+if (document.readyState == "loading") {
+    window.addEventListener("DOMContentLoaded", scrollToHighlight);
+} else {
+    scrollToHighlight();
+}
+
 var histogramLinks = document.querySelector("#histogram_links");
 var markdownButton = document.createElement("a");
 markdownButton.textContent = "📄";
@@ -210,6 +228,12 @@ document.body.addEventListener('click', function(ev) {
         return;
     }
 
+    if (ev.target.classList.contains("load-more")) {
+        ev.preventDefault();
+        loadMore(ev.target);
+        return;
+    }
+
     if (ev.target.classList.contains("filter")) {
         let key = ev.target.parentElement.dataset['field'];
         // either span.field-container content or the first element of that for trace links
@@ -232,6 +256,27 @@ document.querySelector(".results tbody").addEventListener('mouseover', function(
     ev.target.href = addFilter(key, value, ev.target.classList.contains("filter-exclude"));
 });
 
+// replaces the notice that there are more results with the next page of
+// them, which ends with a notice for the page after it
+function loadMore(link) {
+    let notice = link.closest("tr");
+    link.classList.remove("load-more");
+    link.textContent = "Loading...";
+    fetch(link.href).then((resp) => {
+        if (!resp.ok) {
+            return resp.text().then((msg) => { throw new Error(msg || resp.statusText); });
+        }
+        return resp.text();
+    }).then((rows) => {
+        // the row for the details of the notice
+        notice.nextElementSibling.remove();
+        notice.insertAdjacentHTML("afterend", rows);
+        notice.remove();
+    }, (err) => {
+        link.textContent = `Could not load more: ${err.message}`;
+    });
+}
+
 function collectFieldStats(field) {
     var values = document.getElementsByClassName(field.dataset['class']);
     var total = 0;
@@ -276,6 +321,10 @@ function expandSource(element) {
         container.appendChild(toggleTable);
         container.appendChild(new Text(" "));
         container.appendChild(toggleJSON);
+        container.appendChild(new Text(" "));
+        container.appendChild(makeElement("a", {"href": contextLink(source, false)}, "Context"));
+        container.appendChild(new Text(" "));
+        container.appendChild(makeElement("a", {"href": contextLink(source, true)}, "Context with filters"));
         container.appendChild(renderSourceTable(source, formattedFields));
         sourceContainer.appendChild(container);
         sourceContainer.parentElement.classList.remove("source-hidden");
@@ -288,6 +337,27 @@ function expandSource(element) {
     }
 }
 
+function contextLink(source, withFilters) {
+    let current = new URL(location.href);
+    let u = new URL("/context", location.href);
+    if (withFilters) {
+        u.search = current.search;
+        ["from", "to"].forEach((param) => u.searchParams.delete(param));
+    } else {
+        ["index", "fields"].forEach((param) => {
+            if (current.searchParams.has(param)) {
+                u.searchParams.set(param, current.searchParams.get(param));
+            }
+        });
+    }
+    if (source["_datacenter"] || current.searchParams.has("dc")) {
+        u.searchParams.set("dc", source["_datacenter"] || current.searchParams.get("dc"));
+    }
+    u.searchParams.set("_index", source["_index"]);
+    u.searchParams.set("_id", source["_id"]);
+    return u.href;
+}
+
 function renderSourceJSON(source) {
     return makeElement("pre", {}, JSON.stringify(source, "", "  "));
 }
@@ -357,7 +427,7 @@ function renderSourceTable(source, formattedFields) {
     });
 
     // carry over common fields
-    let commonFields = ["index", "dc", "from", "to", "interval", "aggregation_terms", "aggregation_size", "percentiles_terms", "percentiles", "fields", "sort"];
+    let commonFields = ["index", "dc", "from", "to", "interval", "aggregation_terms", "aggregation_size", "aggregation_mode", "percentiles_terms", "percentiles", "fields", "sort", "profile", "sample"];
     commonFields.forEach((field) => {
         if (!query[field]) {
             return;
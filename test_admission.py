@@ -0,0 +1,83 @@
+import asyncio
+import unittest
+
+import admission
+from admission import HEAVY, INTERACTIVE, TAIL, Limiter, Overloaded
+
+
+class LimiterTestCase(unittest.IsolatedAsyncioTestCase):
+    async def run_searches(self, limiter, searches):
+        """ Starts searches (user, priority) while the only slot is taken,
+        returns the order in which they got a slot. """
+
+        order = []
+
+        async def search(user, priority):
+            await limiter.acquire(user, priority)
+            order.append((user, priority))
+            await asyncio.sleep(0)
+            limiter.release()
+
+        await limiter.acquire("blocker", INTERACTIVE)
+        tasks = [asyncio.create_task(search(user, priority)) for user, priority in searches]
+        await asyncio.sleep(0)
+        limiter.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    async def test_no_waiting_below_limit(self):
+        limiter = Limiter(max_concurrent=2, max_queued=0)
+        self.assertEqual(0, await limiter.acquire("a", HEAVY))
+        self.assertEqual(0, await limiter.acquire("b", HEAVY))
+        with self.assertRaises(Overloaded):
+            await limiter.acquire("c", TAIL)
+
+    async def test_priorities(self):
+        limiter = Limiter(max_concurrent=1, max_queued=10)
+        order = await self.run_searches(limiter, [("a", HEAVY), ("a", INTERACTIVE), ("b", TAIL)])
+        self.assertEqual([("b", TAIL), ("a", INTERACTIVE), ("a", HEAVY)], order)
+
+    async def test_round_robin_over_users(self):
+        limiter = Limiter(max_concurrent=1, max_queued=10)
+        order = await self.run_searches(limiter, [("a", HEAVY), ("a", HEAVY), ("a", HEAVY), ("b", HEAVY), ("c", HEAVY)])
+        self.assertEqual(["a", "b", "c", "a", "a"], [user for user, _ in order])
+
+    async def test_cancelled_while_waiting(self):
+        limiter = Limiter(max_concurrent=1, max_queued=10)
+        await limiter.acquire("a", INTERACTIVE)
+        waiting = asyncio.create_task(limiter.acquire("b", INTERACTIVE))
+        await asyncio.sleep(0)
+        self.assertEqual(1, limiter.num_waiting)
+
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual(0, limiter.num_waiting)
+        limiter.release()
+        self.assertEqual(0, limiter.active)
+
+    async def test_resize(self):
+        limiter = Limiter(max_concurrent=1, max_queued=10)
+        await limiter.acquire("a", INTERACTIVE)
+        waiting = asyncio.create_task(limiter.acquire("b", INTERACTIVE))
+        await asyncio.sleep(0)
+
+        limiter.resize(2, 10)
+        await waiting
+        self.assertEqual(2, limiter.active)
+
+        limiter.resize(1, 10)
+        limiter.release()
+        limiter.release()
+        self.assertEqual(0, limiter.active)
+
+    async def test_limiter_per_datacenter(self):
+        self.addCleanup(admission.LIMITERS.clear)
+        limiter = admission.limiter("dc1", 1, 10)
+        self.assertIs(limiter, admission.limiter("dc1", 2, 10))
+        self.assertEqual(2, limiter.max_concurrent)
+        self.assertIsNot(limiter, admission.limiter("dc2", 1, 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import time
+import unittest
+
+from cache import Cache
+
+
+class CacheTestCase(unittest.TestCase):
+    def test_lru(self):
+        cache = Cache(max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(1, cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_ttl(self):
+        cache = Cache()
+        cache.set("a", 1, ttl=-1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(0, len(cache))
+
+    def test_max_bytes(self):
+        cache = Cache(max_entries=10, max_bytes=10)
+        cache.set("a", b"1234")
+        cache.set("b", b"1234")
+        self.assertEqual(8, cache.size)
+        cache.set("c", b"1234")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(8, cache.size)
+
+        # replacing an entry does not count it twice
+        cache.set("c", b"12")
+        self.assertEqual(6, cache.size)
+
+        # too large to be cached at all
+        cache.set("d", b"12345678901")
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual(b"1234", cache.get("b"))
+
+    def test_expired_size(self):
+        cache = Cache(max_bytes=10)
+        cache.set("a", b"1234", ttl=0.001)
+        time.sleep(0.002)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(0, cache.size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import json
+import os
+import tempfile
+import unittest
+
+import config
+from config import Config
+
+
+DEFAULT_FIELDS = [
+    {"match_params": {"logger_name": "TracingServletFilter"}, "fields": ["tracing"]},
+    {"match_params": {"request.path": "", "index": "application-*"}, "fields": ["request"]},
+    {"match_params": {"index": "application-*"}, "fields": ["application"]},
+    {"match_params": {"index": "cdn-*"}, "fields": ["cdn"]},
+    {"match_params": {"index": ""}, "fields": ["fallback"]},
+]
+
+
+def new_config(**kwargs):
+    return Config(**{"default_endpoint": "dc1", "endpoints": {"dc1": ["http://localhost:9200"]}, "indices": [],
+                     "field_format": {}, "default_fields": DEFAULT_FIELDS, "queries": [], **kwargs})
+
+
+class DefaultFieldsTestCase(unittest.TestCase):
+    def test_matches_first_in_order(self):
+        cfg = new_config()
+        cases = [
+            ({"index": "application-*"}, ["application"]),
+            ({"index": "application-*", "request.path": "/api"}, ["request"]),
+            ({"index": "application-*", "logger_name": "TracingServletFilter"}, ["tracing"]),
+            ({"index": "cdn-*"}, ["cdn"]),
+            ({"index": "syslog-*"}, ["fallback"]),
+            ({"level": "ERROR"}, None),
+        ]
+        for kwargs, expected in cases:
+            with self.subTest(kwargs=kwargs):
+                self.assertEqual(expected, cfg.find_default_fields(**kwargs))
+                # memoized
+                self.assertEqual(expected, cfg.find_default_fields(**kwargs))
+
+    def test_same_as_linear_search(self):
+        cfg = new_config()
+        for kwargs in [{"index": "application-*", "request.path": "/"}, {"logger_name": "Tracing"},
+                       {"index": ["cdn-*", "x"]}, {}]:
+            linear = next((df.fields for df in cfg.default_fields if df.matches(kwargs)), None)
+            self.assertEqual(linear, cfg.find_default_fields(**kwargs))
+
+    def test_returns_copy(self):
+        cfg = new_config()
+        cfg.find_default_fields(index="cdn-*").append("modified")
+        self.assertEqual(["cdn"], cfg.find_default_fields(index="cdn-*"))
+
+
+class ValidateTestCase(unittest.TestCase):
+    def test_valid(self):
+        new_config().validate()
+
+    def test_invalid(self):
+        cases = [
+            {"default_endpoint": "dc2"},
+            {"endpoints": {"dc1": []}},
+            {"endpoints": {"dc1": ["localhost:9200"]}},
+            {"field_format": {"request.url": 1}},
+            {"trace_sample_rate": 2},
+            # wrong types, which must not raise anything but ValueError
+            {"endpoints": ["http://localhost:9200"]},
+            {"endpoints": {"dc1": "http://localhost:9200"}},
+            {"field_format": ["request.url"]},
+            {"queries": "level=ERROR"},
+            {"rollups_max_mb": "256"},
+            {"tail_max_idle_s": None},
+            {"trusted_proxies": "10.0.0.1"},
+        ]
+        for kwargs in cases:
+            with self.subTest(kwargs=kwargs):
+                with self.assertRaises(ValueError):
+                    new_config(**kwargs).validate()
+
+    def test_from_file(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump({"default_endpoint": "dc1", "endpoints": {"dc1": ["http://localhost:9200"]}, "indices": [],
+                       "field_format": {}, "default_fields": [], "queries": [], "unknown": 1}, f)
+        try:
+            with self.assertRaises(TypeError):
+                config.from_file(f.name)
+        finally:
+            os.unlink(f.name)
+
+
+if __name__ == '__main__':
+    unittest.main()
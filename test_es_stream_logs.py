@@ -1,8 +1,29 @@
+import asyncio
 import datetime
+import os
+import tempfile
 import time
 import unittest
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-from es_stream_logs import parse_doc_timestamp, parse_timestamp
+import elastic_transport
+import elasticsearch
+from starlette.requests import Request
+
+from config import Config
+import es_stream_logs
+from es_stream_logs import (RESPONSE_CACHE_CLOSED_TTL_S, RESPONSE_CACHE_RECENT_TTL_S, ClientDisconnected,
+                            aggregation_svg, decode_cursor, encode_cursor, es_error_response, fetch_context,
+                            hit_timestamp_ms, parse_doc_timestamp, parse_iso8601_ms, parse_timestamp, response_ttl,
+                            search_user, serve_aggregation, sparkline_queries, split_for_request_cache,
+                            spooled_position, stream_logs, stream_spooled, to_raw_es_query, unless_disconnected)
+from fanout import FanOutClient
+from query import Query
+from render import JSONRenderer
+from rollups import RollupStore
+import shared_cache
+from spool import Spool
 
 
 class ParseTimestampTestCase(unittest.TestCase):
@@ -68,3 +89,508 @@ class ParseDocTimestampTestCase(unittest.TestCase):
         self.assertRaises(ValueError, lambda: parse_doc_timestamp("not a timestamp"))
 
         self.assertRaises(ValueError, lambda: parse_doc_timestamp('1970-01-01T00:00:00+01:00'))
+
+
+class ParseIso8601TestCase(unittest.TestCase):
+    def test_utc(self):
+        self.assertEqual(0, parse_iso8601_ms('1970-01-01T00:00:00Z'))
+        self.assertEqual(1635774591123, parse_iso8601_ms('2021-11-01T13:49:51.123Z'))
+        # without timezone
+        self.assertEqual(1635774591123, parse_iso8601_ms('2021-11-01T13:49:51.123'))
+
+    def test_offset(self):
+        self.assertEqual(1635774591123, parse_iso8601_ms('2021-11-01T14:49:51.123+01:00'))
+        self.assertEqual(1635774591000, parse_iso8601_ms('2021-11-01T08:49:51-05:00'))
+
+    def test_nanos(self):
+        self.assertEqual(1635774591123, parse_iso8601_ms('2021-11-01T13:49:51.123456789Z'))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, lambda: parse_iso8601_ms("not a timestamp"))
+
+    def test_hit_timestamp(self):
+        source = {'@timestamp': '2021-11-01T13:49:51.123Z'}
+        self.assertEqual(1635774591123, hit_timestamp_ms({'_source': source}))
+        # sort values are used if present
+        self.assertEqual(42, hit_timestamp_ms({'_source': source, 'sort': [42]}))
+
+
+class SplitForRequestCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = Config(default_endpoint='default', endpoints=[], indices=[],
+                             field_format={}, default_fields={}, queries=[])
+
+    def test_split(self):
+        query = Query(self.config, **{"from": "now-1h", "to": "now"})
+        closed, current = split_for_request_cache(query, 60_000)
+
+        from_ms, boundary_ms = int(closed.from_timestamp), int(closed.to_timestamp)
+        self.assertEqual(0, from_ms % 60_000)
+        self.assertEqual(0, boundary_ms % 60_000)
+        self.assertEqual(str(boundary_ms), current.from_timestamp)
+        self.assertEqual("now", current.to_timestamp)
+
+    def test_closed(self):
+        query = Query(self.config, **{"from": "now-2h", "to": "now-1h"})
+        (closed,) = split_for_request_cache(query, 60_000)
+        self.assertEqual(0, int(closed.from_timestamp) % 60_000)
+        self.assertEqual(0, int(closed.to_timestamp) % 60_000)
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = Config(default_endpoint='default', endpoints=[], indices=[],
+                             field_format={}, default_fields={}, queries=[])
+
+    def test_ttl(self):
+        closed_to = str(int((time.time() - 3600) * 1000))
+        recent_to = str(int(time.time() * 1000))
+        cases = [
+            ({"from": "now-1h", "to": "now"}, RESPONSE_CACHE_RECENT_TTL_S),
+            ({"from": "2021-11-01T00:00:00Z", "to": "now-1d"}, RESPONSE_CACHE_RECENT_TTL_S),
+            ({"from": "0", "to": recent_to}, RESPONSE_CACHE_RECENT_TTL_S),
+            ({"from": "0", "to": closed_to}, RESPONSE_CACHE_CLOSED_TTL_S),
+            ({"from": "0", "to": closed_to, "_id": "abc"}, RESPONSE_CACHE_RECENT_TTL_S),
+        ]
+        for params, ttl in cases:
+            with self.subTest(params):
+                self.assertEqual(ttl, response_ttl(Query(self.config, **params)))
+
+
+class RawQueryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = Config(default_endpoint='default', endpoints=[], indices=[],
+                             field_format={}, default_fields={}, queries=[])
+
+    def test_sample(self):
+        query = Query(self.config, sample='0.1', aggregation_terms='level', max_results='10')
+        es_query = to_raw_es_query(query)
+        self.assertEqual(10, es_query["size"])
+        # hits are sampled by a post filter, so that the aggregations are only sampled once
+        self.assertEqual(query.sample_filter(), es_query["post_filter"])
+        self.assertNotIn(query.sample_filter(), es_query["query"]["bool"]["filter"])
+        self.assertEqual(0.1, es_query["aggs"]["sample"]["random_sampler"]["probability"])
+        self.assertIn("num_results", es_query["aggs"]["sample"]["aggs"])
+
+        es_query = to_raw_es_query(Query(self.config, sample='0.1', max_results='10'))
+        self.assertIn(query.sample_filter(), es_query["query"]["bool"]["filter"])
+        self.assertNotIn("aggs", es_query)
+
+
+class SparklineQueriesTestCase(unittest.TestCase):
+    def test_datacenters(self):
+        config = Config(default_endpoint='dc1', endpoints={"dc1": ["http://dc1:9200"], "dc2": ["http://dc2:9200"]},
+                        indices=[], field_format={}, default_fields={},
+                        queries=["/logs?level=ERROR", "/logs?dc=dc1,dc2&level=ERROR", "/logs?dc=dc3"])
+        queries = sparkline_queries(config)
+        self.assertEqual(["dc1", "dc1,dc2"], list(queries))
+        self.assertEqual(["/logs?dc=dc1,dc2&level=ERROR"], [query_url for query_url, _ in queries["dc1,dc2"]])
+
+
+class SearchUserTestCase(unittest.TestCase):
+    def request(self, client, forwarded_for=None, es_user=None):
+        headers = [(b"x-forwarded-for", forwarded_for.encode("ascii"))] if forwarded_for else []
+        request = Request({"type": "http", "headers": headers, "client": (client, 12345)})
+        if es_user:
+            request.state.es_user = es_user
+        return request
+
+    def test_search_user(self):
+        config = Config(default_endpoint='default', endpoints={}, indices=[], field_format={}, default_fields={},
+                        queries=[], trusted_proxies=["10.0.0.1", "10.0.0.2"])
+        with mock.patch.object(es_stream_logs, "CONFIG", config):
+            self.assertEqual("alice", search_user(self.request("192.0.2.1", "192.0.2.9", es_user="alice")))
+            # anyone can send X-Forwarded-For, only proxies are trusted with it
+            self.assertEqual("192.0.2.1", search_user(self.request("192.0.2.1", "192.0.2.9")))
+            self.assertEqual("192.0.2.9", search_user(self.request("10.0.0.1", "192.0.2.9")))
+            self.assertEqual("192.0.2.9", search_user(self.request("10.0.0.1", "1.2.3.4, 192.0.2.9, 10.0.0.2")))
+            self.assertEqual("10.0.0.1", search_user(self.request("10.0.0.1")))
+
+
+class SlowElasticsearch:
+    """ Returns the same document for every search, after delay_s. """
+
+    def __init__(self, delay_s=0):
+        self.delay_s = delay_s
+        self.searches = 0
+        self.cancelled = 0
+
+    async def search(self, index, body, request_timeout):
+        self.searches += 1
+        try:
+            await asyncio.sleep(self.delay_s)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        hit = {"_id": "1", "_index": "logs", "_source": {"@timestamp": "2021-11-01T13:49:51.000Z", "message": "hi"}}
+        return {"took": 1, "timed_out": False, "_shards": {"failed": 0},
+                "hits": {"total": {"value": 1}, "hits": [hit]}}
+
+
+class StreamLogsTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.config = Config(default_endpoint='default', endpoints={"default": ["http://localhost:9200"]},
+                             indices=[], field_format={}, default_fields={}, queries=[])
+        self.query = Query(self.config, **{"from": "now-1m", "to": "now", "fields": "message"})
+
+    async def test_cancelled_while_searching(self):
+        search_cancelled = asyncio.Event()
+
+        async def search():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                search_cancelled.set()
+                raise
+
+        waiting = asyncio.ensure_future(unless_disconnected(search(), asyncio.Event()))
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        # the cancellation is passed on, not turned into a disconnect
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertTrue(search_cancelled.is_set())
+
+        disconnected = asyncio.Event()
+        disconnected.set()
+        with self.assertRaises(ClientDisconnected):
+            await unless_disconnected(search(), disconnected)
+        self.assertEqual(42, await unless_disconnected(asyncio.sleep(0, 42), asyncio.Event()))
+
+    async def test_cancels_search_on_disconnect(self):
+        es = SlowElasticsearch(delay_s=10)
+        disconnected = asyncio.Event()
+        stream = stream_logs(es, JSONRenderer(), self.query, disconnected=disconnected)
+        self.assertEqual("[", await anext(stream))
+
+        asyncio.get_running_loop().call_later(0.05, disconnected.set)
+        start = time.monotonic()
+        chunks = [chunk async for chunk in stream]
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual([], chunks)
+        self.assertEqual(1, es.cancelled)
+
+    async def test_idle_limit(self):
+        es = SlowElasticsearch()
+        stream = stream_logs(es, JSONRenderer(), self.query, max_idle_s=0.5)
+        chunks = [chunk async for chunk in stream]
+        self.assertEqual(["[", '{"message": "hi"}', "]"], [chunk for chunk in chunks if chunk.strip()])
+        self.assertEqual(2, es.searches)
+
+    async def test_missing_datacenter(self):
+        """ Live tails continue in the other datacenters while one is down,
+        for more results than fit in one search. """
+
+        es = FanOutClient({"dc1": LiveElasticsearch(1200),
+                           "dc2": LiveElasticsearch(error=elasticsearch.ConnectionError("down"))}, deadline_s=1)
+        query = Query(self.config, **{"from": "now-1m", "to": "now", "dc": "dc1,dc2", "max_results": "all"})
+        renderer = MoreRenderer()
+        disconnected = asyncio.Event()
+
+        async def disconnect_when_done():
+            while len(renderer.ids) < 1200:
+                await asyncio.sleep(0.01)
+            disconnected.set()
+
+        watcher = asyncio.create_task(disconnect_when_done())
+        self.addCleanup(watcher.cancel)
+        [chunk async for chunk in stream_logs(es, renderer, query, disconnected=disconnected, max_idle_s=1.5)]
+        self.assertEqual([str(idx) for idx in range(1200)], renderer.ids)
+
+
+class LiveElasticsearch:
+    """ Serves documents with consecutive timestamps (in millis) from the
+    start of the searched time range, or fails every search with error. """
+
+    def __init__(self, num_docs=0, error=None):
+        self.docs = [{"_index": "logs", "_id": str(idx), "sort": [1000 + idx], "_source": {"message": str(idx)}}
+                     for idx in range(num_docs)]
+        self.error = error
+
+    async def search(self, index, body, request_timeout):
+        if self.error:
+            raise self.error
+        start = body["query"]["bool"]["filter"][-1]["range"]["@timestamp"]["gte"]
+        hits = [doc for doc in self.docs if isinstance(start, str) or doc["sort"][0] >= start][:body["size"]]
+        return {"took": 1, "timed_out": False, "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+                "hits": {"total": {"value": len(hits), "relation": "eq"}, "hits": hits}}
+
+
+class HistogramElasticsearch:
+    """ Serves one document per minute for histogram searches.  The
+    searches at the positions in incomplete (0 for the primary one) have a
+    failed shard, or time out if timed_out is set. """
+
+    def __init__(self, incomplete=(), timed_out=False):
+        self.incomplete = incomplete
+        self.timed_out = timed_out
+
+    def response(self, position, body):
+        timerange = body["query"]["bool"]["filter"][-1]["range"]["@timestamp"]
+        buckets = [{"key": key, "doc_count": 1} for key in range(int(timerange["gte"]), int(timerange["lt"]), 60_000)]
+        failed = int(position in self.incomplete and not self.timed_out)
+        return {"took": 1, "timed_out": position in self.incomplete and self.timed_out,
+                "_shards": {"total": 2, "successful": 2 - failed, "skipped": 0, "failed": failed},
+                "hits": {"total": {"value": len(buckets), "relation": "eq"}, "hits": []},
+                "aggregations": {"num_results": {"buckets": buckets}}}
+
+    async def search(self, index, body, request_timeout, request_cache=None):
+        return self.response(0, body)
+
+    async def msearch(self, body, request_timeout):
+        return {"took": 1, "responses": [self.response(position, search) for position, search in enumerate(body[1::2])]}
+
+    async def field_caps(self, **kwargs):
+        return {"indices": [], "fields": {}}
+
+
+class AggregationSvgTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.rollups = RollupStore(tmpdir.name, 1024 * 1024)
+        patcher = mock.patch.object(es_stream_logs, "get_rollups", mock.AsyncMock(return_value=self.rollups))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        shared_cache.configure(shared_cache.MemoryBackend())
+        self.addCleanup(shared_cache.configure, shared_cache.MemoryBackend())
+
+        self.config = Config(default_endpoint='default', endpoints={"default": ["http://localhost:9200"]},
+                             indices=[], field_format={}, default_fields={}, queries=[])
+        self.request = Request({"type": "http", "headers": [], "client": ("192.0.2.1", 12345)})
+        hour_ms = 60 * 60 * 1000
+        self.from_ms = int(time.time() * 1000) // hour_ms * hour_ms - 3 * hour_ms
+
+    def query(self, **params):
+        return Query(self.config, **{"from": str(self.from_ms), "to": str(self.from_ms + 60 * 60 * 1000),
+                                     "interval": "1m", **params})
+
+    def stored_series(self):
+        return self.rollups.db.execute("SELECT COUNT(*) FROM series").fetchone()[0]
+
+    async def test_stores_complete_rollups(self):
+        await aggregation_svg(HistogramElasticsearch(), self.request, self.query())
+        self.assertEqual(1, self.stored_series())
+
+    async def test_incomplete_overlays_not_cached(self):
+        query = self.query(compare="1d")
+        for timed_out in (False, True):
+            with self.subTest(timed_out=timed_out):
+                with mock.patch.object(es_stream_logs.HISTOGRAM_CACHE, "set") as cache_set:
+                    await aggregation_svg(HistogramElasticsearch(incomplete={1}, timed_out=timed_out), self.request,
+                                          query)
+                cache_set.assert_not_called()
+        with mock.patch.object(es_stream_logs.HISTOGRAM_CACHE, "set") as cache_set:
+            await aggregation_svg(HistogramElasticsearch(), self.request, query)
+        cache_set.assert_called_once()
+
+    async def serve(self, es, **params):
+        """ Requests the histogram of query with params, returns the
+        response, whether it was looked up in the cache and whether it was cached. """
+
+        query_string = self.query(**params).as_params().encode("utf-8")
+        request = Request({"type": "http", "method": "GET", "path": "/aggregation.svg", "headers": [],
+                           "query_string": query_string, "client": ("192.0.2.1", 12345)})
+        with mock.patch.object(es_stream_logs, "CONFIG", self.config), \
+                mock.patch.object(es_stream_logs, "es_client_from", mock.AsyncMock(return_value=(es, None))), \
+                mock.patch.object(es_stream_logs, "cached_response", mock.AsyncMock(return_value=None)) as cached, \
+                mock.patch.object(es_stream_logs, "cache_response") as cache_response:
+            resp = await serve_aggregation(request)
+        return resp, cached.called, cache_response.called
+
+    async def test_response_cache(self):
+        resp, looked_up, cached = await self.serve(HistogramElasticsearch())
+        self.assertNotIn("X-Incomplete-Results", resp.headers)
+        self.assertEqual((True, True), (looked_up, cached))
+        resp, _, cached = await self.serve(HistogramElasticsearch(incomplete={0}, timed_out=True))
+        self.assertEqual("true", resp.headers["X-Incomplete-Results"])
+        self.assertFalse(cached)
+        resp, _, cached = await self.serve(HistogramElasticsearch(incomplete={1}), compare="1d")
+        self.assertEqual("true", resp.headers["X-Incomplete-Results"])
+        self.assertFalse(cached)
+
+        # profiles are neither served from the cache nor cached
+        resp, looked_up, cached = await self.serve(HistogramElasticsearch(), profile="1")
+        self.assertEqual((False, False), (looked_up, cached))
+
+    async def test_failed_shards_not_stored(self):
+        for timed_out in (False, True):
+            with self.subTest(timed_out=timed_out):
+                await aggregation_svg(HistogramElasticsearch(incomplete={0}, timed_out=timed_out), self.request,
+                                      self.query())
+                self.assertEqual(0, self.stored_series())
+
+
+class ContextElasticsearch:
+    """ Serves documents at the given timestamps (in millis), with ids by position. """
+
+    def __init__(self, timestamps):
+        self.docs = [{"_index": "logs", "_id": str(idx), "sort": [ts],
+                      "_source": {"@timestamp": datetime.datetime.fromtimestamp(ts / 1000, datetime.UTC).isoformat()}}
+                     for idx, ts in enumerate(timestamps)]
+
+    async def get(self, index, id):
+        doc = self.docs[int(id)]
+        return {"_index": index, "_id": id, "_source": doc["_source"]}
+
+    async def search(self, index, body, request_timeout):
+        search_after = body["search_after"][0]
+        if body["sort"][0]["@timestamp"]["order"] == "desc":
+            hits = [doc for doc in reversed(self.docs) if doc["sort"][0] < search_after]
+        else:
+            hits = [doc for doc in self.docs if doc["sort"][0] > search_after]
+        return {"took": 1, "hits": {"hits": hits[:body["size"]]}}
+
+
+class FetchContextTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        config = Config(default_endpoint='default', endpoints={"default": ["http://localhost:9200"]},
+                        indices=[], field_format={}, default_fields={}, queries=[])
+        self.query = Query(config)
+
+    async def test_before_and_after(self):
+        es = ContextElasticsearch([1000, 2000, 3000, 4000, 5000, 6000])
+        context = await fetch_context(es, self.query, "logs", "2", 2)
+        self.assertEqual(["0", "1"], [hit["_id"] for hit in context.before])
+        self.assertEqual("2", context.doc["_id"])
+        self.assertEqual(["3", "4"], [hit["_id"] for hit in context.after])
+
+    async def test_same_timestamp(self):
+        es = ContextElasticsearch([1000, 2000, 2000, 2000, 3000])
+        context = await fetch_context(es, self.query, "logs", "2", 5)
+        ids = [hit["_id"] for hit in context.before + [context.doc] + context.after]
+        self.assertEqual(["0", "1", "2", "3", "4"], sorted(ids))
+        self.assertEqual(["0", "4"], [ids[0], ids[-1]])
+
+    def test_errors(self):
+        def meta(status):
+            return elastic_transport.ApiResponseMeta(status=status, http_version="1.1",
+                                                     headers=elastic_transport.HttpHeaders(), duration=0,
+                                                     node=elastic_transport.NodeConfig("http", "localhost", 9200))
+
+        cases = [
+            (elasticsearch.AuthorizationException(message="forbidden", meta=meta(403), body={}), 403),
+            (elasticsearch.ApiError(message="unavailable", meta=meta(503), body={}), 502),
+            (elasticsearch.ConnectionTimeout("timed out"), 504),
+            (elasticsearch.ConnectionError("refused"), 502),
+        ]
+        for ex, status in cases:
+            with self.subTest(ex):
+                self.assertEqual(status, es_error_response(ex).status_code)
+
+
+class PagedElasticsearch:
+    """ Serves documents at the given timestamps (in millis) for searches by time range. """
+
+    def __init__(self, timestamps):
+        self.docs = [{"_index": "logs", "_id": str(idx), "sort": [ts], "_source": {"message": str(idx)}}
+                     for idx, ts in enumerate(timestamps)]
+        self.searches = 0
+
+    async def search(self, index, body, request_timeout):
+        self.searches += 1
+        timerange = body["query"]["bool"]["filter"][-1]["range"]["@timestamp"]
+        hits = [doc for doc in self.docs if int(timerange["gte"]) <= doc["sort"][0] < int(timerange["lt"])]
+        if body["sort"][0]["@timestamp"]["order"] == "desc":
+            hits.reverse()
+        return {"took": 1, "timed_out": False, "_shards": {"failed": 0},
+                "hits": {"total": {"value": len(hits)}, "hits": hits[:body["size"]]}}
+
+
+class MoreResultsTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.config = Config(default_endpoint='default', endpoints={"default": ["http://localhost:9200"]},
+                             indices=[], field_format={}, default_fields={}, queries=[])
+
+    def test_cursor(self):
+        cursor = encode_cursor(1635774591000, ["a", "b,c"])
+        self.assertEqual((1635774591000, ["a", "b,c"]), decode_cursor(cursor))
+        for invalid in ["", "garbage", encode_cursor("now", []), encode_cursor(1, [1])]:
+            with self.subTest(invalid):
+                with self.assertRaises(ValueError):
+                    decode_cursor(invalid)
+
+    async def pages(self, es, sort, results_spool=None):
+        """ Streams pages of 2 results, following the cursors of the more
+        links, from the results spooled as sort if results_spool is given. """
+
+        query = Query(self.config, **{"from": "0", "to": "10000", "max_results": "2", "sort": sort})
+        pages, after = [], None
+        while True:
+            renderer = MoreRenderer()
+            if results_spool:
+                spooled = results_spool.open(sort)
+                start = spooled_position(spooled, query, after) if after else 0
+                [chunk async for chunk in stream_spooled(spooled, renderer, query, start=start)]
+            else:
+                [chunk async for chunk in stream_logs(es, renderer, query, after=after)]
+            pages.append(renderer.ids)
+            if not renderer.more_url:
+                return pages
+            after = decode_cursor(parse_qs(urlparse(renderer.more_url).query)["after"][0])
+
+    async def test_pages(self):
+        es = PagedElasticsearch([1000, 2000, 2000, 2000, 3000, 4000])
+        self.assertEqual([["0", "1"], ["2", "3"], ["4", "5"]], await self.pages(es, "asc"))
+        self.assertEqual([["5", "4"], ["3", "2"], ["1", "0"]], await self.pages(es, "desc"))
+
+    async def test_no_results_shown(self):
+        es = PagedElasticsearch([1000, 2000])
+        query = Query(self.config, **{"from": "0", "to": "10000", "max_results": "0"})
+        renderer = MoreRenderer()
+        [chunk async for chunk in stream_logs(es, renderer, query)]
+        self.assertEqual([], renderer.ids)
+        self.assertTrue(renderer.warned)
+        self.assertIsNone(renderer.more_url)
+
+    async def test_spooled_pages(self):
+        es = PagedElasticsearch([1000, 2000, 2000, 2000, 3000, 4000])
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        results_spool = Spool(tmpdir.name, 1024 * 1024)
+        for sort in ("asc", "desc"):
+            with self.subTest(sort):
+                query = Query(self.config, **{"from": "0", "to": "10000", "max_results": "all", "sort": sort})
+                [chunk async for chunk in stream_logs(es, MoreRenderer(), query,
+                                                      results_spool=results_spool, spool_key=sort)]
+                self.assertEqual(await self.pages(es, sort), await self.pages(es, sort, results_spool))
+
+    async def test_spool_discarded_on_disconnect(self):
+        es = PagedElasticsearch([1000, 2000, 2000, 2000, 3000, 4000])
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        results_spool = Spool(tmpdir.name, 1024 * 1024)
+        query = Query(self.config, **{"from": "0", "to": "10000", "max_results": "all"})
+
+        # nothing is written if the client leaves before the stream started
+        stream = stream_logs(es, MoreRenderer(), query, results_spool=results_spool, spool_key="asc")
+        await stream.aclose()
+        self.assertEqual([], os.listdir(tmpdir.name))
+
+        renderer = MoreRenderer()
+        stream = stream_logs(es, renderer, query, results_spool=results_spool, spool_key="asc")
+        async for _ in stream:
+            if renderer.ids:
+                break
+        await stream.aclose()
+        self.assertEqual([], os.listdir(tmpdir.name))
+        self.assertIsNone(results_spool.open("asc"))
+
+
+class MoreRenderer(JSONRenderer):
+    """ Records the ids of the results and the url of the next page. """
+
+    def __init__(self):
+        super().__init__()
+        self.ids = []
+        self.more_url = None
+        self.warned = False
+
+    def result(self, hit, source, highlight=False):
+        self.ids.append(hit["_id"])
+        return super().result(hit, source, highlight)
+
+    def warning(self, msg, es_query, more_url=None):
+        self.warned = True
+        self.more_url = more_url
+        return ""
@@ -0,0 +1,152 @@
+import asyncio
+import unittest
+
+import elasticsearch
+
+import fanout
+from fanout import FanOutClient
+
+
+def search_response(timestamps, took=1, aggregations=None):
+    resp = {
+        "took": took,
+        "timed_out": False,
+        "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+        "hits": {"total": {"value": len(timestamps), "relation": "eq"}, "max_score": None,
+                 "hits": [{"_index": "logs", "_id": str(ts), "_source": {"@timestamp": ts}, "sort": [ts]}
+                          for ts in timestamps]},
+    }
+    if aggregations:
+        resp["aggregations"] = aggregations
+    return resp
+
+
+class FakeClient:
+    def __init__(self, response=None, delay_s=0, error=None):
+        self.response = response
+        self.delay_s = delay_s
+        self.error = error
+        self.cancelled = False
+
+    async def search(self, **kwargs):
+        try:
+            await asyncio.sleep(self.delay_s)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error:
+            raise self.error
+        return self.response
+
+    async def msearch(self, body, **kwargs):
+        return {"took": 1, "responses": [await self.search() for _ in body[1::2]]}
+
+    async def field_caps(self, **kwargs):
+        return self.response
+
+
+class FanOutTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_merges_hits_by_timestamp(self):
+        client = FanOutClient({"dc1": FakeClient(search_response([1, 4, 5])),
+                               "dc2": FakeClient(search_response([2, 3, 6]))}, deadline_s=1)
+        resp = await client.search(index="logs", body={"size": 5, "sort": [{"@timestamp": {"order": "asc"}}]})
+        self.assertEqual([1, 2, 3, 4, 5], [hit["sort"][0] for hit in resp["hits"]["hits"]])
+        self.assertEqual(["dc1", "dc2", "dc2", "dc1", "dc1"], [hit["_datacenter"] for hit in resp["hits"]["hits"]])
+        self.assertEqual(6, resp["hits"]["total"]["value"])
+        self.assertEqual(2, resp["_shards"]["total"])
+        self.assertNotIn("missing_datacenters", resp)
+
+    async def test_merges_descending(self):
+        client = FanOutClient({"dc1": FakeClient(search_response([5, 1])),
+                               "dc2": FakeClient(search_response([6, 3]))}, deadline_s=1)
+        resp = await client.search(index="logs", body={"size": 10, "sort": [{"@timestamp": {"order": "desc"}}]})
+        self.assertEqual([6, 5, 3, 1], [hit["sort"][0] for hit in resp["hits"]["hits"]])
+
+    async def test_deadline(self):
+        slow = FakeClient(search_response([2]), delay_s=10)
+        client = FanOutClient({"dc1": FakeClient(search_response([1])), "dc2": slow}, deadline_s=0.05)
+        resp = await asyncio.wait_for(client.search(index="logs", body={}), 1)
+        self.assertEqual([1], [hit["sort"][0] for hit in resp["hits"]["hits"]])
+        self.assertIn("dc2", resp["missing_datacenters"])
+        self.assertTrue(resp["timed_out"])
+        self.assertTrue(slow.cancelled)
+
+    async def test_failed_datacenter(self):
+        error = elasticsearch.ConnectionError("connection refused")
+        client = FanOutClient({"dc1": FakeClient(search_response([1])), "dc2": FakeClient(error=error)}, deadline_s=1)
+        resp = await client.search(index="logs", body={})
+        self.assertEqual(["dc2"], list(resp["missing_datacenters"]))
+
+        # only raised if all datacenters fail
+        client = FanOutClient({"dc1": FakeClient(error=error), "dc2": FakeClient(error=error)}, deadline_s=1)
+        with self.assertRaises(elasticsearch.ConnectionError):
+            await client.search(index="logs", body={})
+
+    async def test_msearch(self):
+        client = FanOutClient({"dc1": FakeClient(search_response([1])),
+                               "dc2": FakeClient(search_response([2]))}, deadline_s=1)
+        resp = await client.msearch(body=[{"index": "logs"}, {"size": 0}, {"index": "logs"}, {"size": 0}])
+        self.assertEqual([2, 2], [r["hits"]["total"]["value"] for r in resp["responses"]])
+
+    async def test_field_caps(self):
+        client = FanOutClient({
+            "dc1": FakeClient({"indices": ["a"], "fields": {"level": {"keyword": {"aggregatable": True}}}}),
+            "dc2": FakeClient({"indices": ["b"], "fields": {"level": {"keyword": {"aggregatable": False}},
+                                                            "message": {"text": {"aggregatable": False}}}}),
+        }, deadline_s=1)
+        resp = await client.field_caps(index="logs", fields="*")
+        self.assertEqual(["a", "b"], resp["indices"])
+        self.assertFalse(resp["fields"]["level"]["keyword"]["aggregatable"])
+        self.assertIn("message", resp["fields"])
+
+
+class MergeAggregationsTestCase(unittest.TestCase):
+    def test_histogram_with_terms_and_percentiles(self):
+        def bucket(key, count, terms, p50):
+            return {"key": key, "key_as_string": str(key), "doc_count": count,
+                    "level": {"buckets": [{"key": term, "doc_count": c} for term, c in terms]},
+                    "duration": {"values": {"50.0": p50}}}
+
+        dc1 = {"num_results": {"buckets": [bucket(0, 3, [("INFO", 3)], 10), bucket(60, 1, [("ERROR", 1)], 20)]}}
+        dc2 = {"num_results": {"buckets": [bucket(60, 3, [("INFO", 2), ("ERROR", 1)], 40),
+                                           bucket(120, 2, [("INFO", 2)], None)]}}
+        requested = {"num_results": {"date_histogram": {"field": "@timestamp", "fixed_interval": "60s"},
+                                     "aggs": {"level": {"terms": {"field": "level"}},
+                                              "duration": {"percentiles": {"field": "duration"}}}}}
+        merged = fanout.merge_aggregations([(dc1, 4), (dc2, 5)], requested)
+        buckets = merged["num_results"]["buckets"]
+        self.assertEqual([0, 60, 120], [b["key"] for b in buckets])
+        self.assertEqual([3, 4, 2], [b["doc_count"] for b in buckets])
+        self.assertEqual([("ERROR", 2), ("INFO", 2)], [(t["key"], t["doc_count"]) for t in buckets[1]["level"]["buckets"]])
+        # weighted by the number of documents
+        self.assertEqual(35, buckets[1]["duration"]["values"]["50.0"])
+        self.assertIsNone(buckets[2]["duration"]["values"]["50.0"])
+
+    def test_terms_keep_size(self):
+        dc1 = {"top_terms": {"buckets": [{"key": "a", "doc_count": 5}, {"key": "b", "doc_count": 1}]}}
+        dc2 = {"top_terms": {"buckets": [{"key": "c", "doc_count": 4}, {"key": "b", "doc_count": 4}]}}
+        merged = fanout.merge_aggregations([(dc1, 6), (dc2, 8)])
+        self.assertEqual(["a", "b"], [b["key"] for b in merged["top_terms"]["buckets"]])
+
+    def test_terms_of_dates(self):
+        def bucket(key, count):
+            return {"key": key, "key_as_string": str(key), "doc_count": count}
+
+        dc1 = {"sampler": {"doc_count": 6, "top_terms": {"buckets": [bucket(2, 5), bucket(1, 1)]}}}
+        dc2 = {"sampler": {"doc_count": 8, "top_terms": {"buckets": [bucket(3, 4), bucket(1, 4)]}}}
+        requested = {"sampler": {"random_sampler": {"probability": 0.1},
+                                 "aggs": {"top_terms": {"terms": {"field": "created", "size": 2}}}}}
+        merged = fanout.merge_aggregations([(dc1, 6), (dc2, 8)], requested)
+        self.assertEqual([2, 1], [b["key"] for b in merged["sampler"]["top_terms"]["buckets"]])
+
+    def test_filters_and_missing(self):
+        dc1 = {"level": {"buckets": {"INFO": {"doc_count": 1}, "__other__": {"doc_count": 2}}},
+               "__missing__": {"doc_count": 1}}
+        dc2 = {"level": {"buckets": {"INFO": {"doc_count": 3}}}, "__missing__": {"doc_count": 2}}
+        merged = fanout.merge_aggregations([(dc1, 3), (dc2, 3)])
+        self.assertEqual({"INFO": {"doc_count": 4}, "__other__": {"doc_count": 2}}, merged["level"]["buckets"])
+        self.assertEqual(3, merged["__missing__"]["doc_count"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+
+import histogram
+import tinygraph
+
+
+def bucket(key, count, **sub_aggs):
+    return {"key": key, "key_as_string": str(key), "doc_count": count, **sub_aggs}
+
+
+class TinygraphTest(unittest.TestCase):
+    def test_stack(self):
+        self.assertEqual([([0, 0], [1, 2]), ([1, 2], [4, 6])],
+                         tinygraph.stack([[1, 2], [3, 4]]))
+
+    def test_bars_path(self):
+        self.assertEqual("M0 100V50h1V100Z",
+                         tinygraph.bars_path([0, 1], [100, 100], [50, 100]))
+        self.assertEqual("M0 100V99.5h1V100Z",
+                         tinygraph.bars_path([0], [100], [99.9], min_height=0.5))
+
+    def test_line_path(self):
+        self.assertEqual("M0 1L2 3", tinygraph.line_path([0, 1, 2], [1, None, 3]))
+        self.assertEqual("", tinygraph.line_path([0], [None]))
+
+
+class HistogramTest(unittest.TestCase):
+    def test_from_aggregations(self):
+        aggregations = {"num_results": {"buckets": [
+            bucket(0, 10, level={"buckets": [{"key": "INFO", "doc_count": 7}]}),
+            bucket(1000, 5, level={"buckets": [{"key": "ERROR", "doc_count": 2}, {"key": "INFO", "doc_count": 3}]}),
+        ]}}
+
+        hist = histogram.from_aggregations(aggregations, 1, aggregation_terms="level")
+        self.assertEqual([0, 1000], hist.keys)
+        self.assertEqual([10, 5], hist.counts)
+        self.assertEqual({"ERROR": [0, 2], "INFO": [7, 3]}, hist.terms)
+        self.assertEqual([3, 0], hist.missing)
+
+    def test_from_aggregations_top_terms(self):
+        aggregations = {"num_results": {"buckets": [
+            bucket(0, 10,
+                   status={"buckets": {"200": {"doc_count": 5}, "500": {"doc_count": 1}, histogram.OTHER_TERM: {"doc_count": 4}}},
+                   missing_terms={"doc_count": 3}),
+        ]}}
+
+        hist = histogram.from_aggregations(aggregations, 1, aggregation_terms="status", top_terms=[200, 500])
+        self.assertEqual({200: [5], 500: [1], histogram.OTHER_TERM: [1]}, hist.terms)
+        self.assertEqual([3], hist.missing)
+
+    def test_render_svg_size(self):
+        """ Rendered size should be dominated by the data, not by markup per bucket. """
+
+        num_buckets = 2000
+        hist = histogram.Histogram(interval_s=1,
+                                   keys=[i * 1000 for i in range(num_buckets)],
+                                   counts=[i % 17 for i in range(num_buckets)])
+        svg = histogram.render_svg(hist, 0, num_buckets * 1000, "100%", 125, "/logs?")
+        self.assertEqual(1, svg.count('<path class="bars"'))
+        self.assertLess(len(svg), 100 * num_buckets)
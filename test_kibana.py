@@ -0,0 +1,67 @@
+import unittest
+
+import aiohttp
+from aiohttp import web
+
+import kibana
+
+DISCOVER_URL = ("/app/kibana#/discover?_g=(refreshInterval:(pause:!t,value:0),time:(from:now-1h,to:now))"
+                "&_a=(columns:!(level,message),index:'{index}',interval:auto,"
+                "query:(language:lucene,query:''),"
+                "filters:!((query:(match:(level:(query:ERROR,type:phrase))))))")
+
+
+class ParseParenthesesTest(unittest.TestCase):
+    def test_nested(self):
+        self.assertEqual((3, ["match", ["level", ["query:ERROR,type:phrase"]]]),
+                         kibana.parse_parentheses("(match:(level:(query:ERROR,type:phrase)))"))
+
+    def test_start(self):
+        self.assertEqual((1, ["a"]), kibana.parse_parentheses("x:(a),(b)", 2))
+
+    def test_mismatch(self):
+        with self.assertRaises(ValueError):
+            kibana.parse_parentheses("(a:(b)")
+
+
+class ParseAsyncTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.requests = []
+
+        async def goto(request):
+            self.requests.append(request.path)
+            raise web.HTTPFound(DISCOVER_URL.format(index="0a1b2c"))
+
+        async def index_pattern(request):
+            self.requests.append(request.path)
+            return web.json_response({"attributes": {"title": "application-*"}})
+
+        async def kibana_app(request):
+            return web.Response(text="kibana")
+
+        app = web.Application()
+        app.router.add_route("*", "/goto/{id}", goto)
+        app.router.add_get("/api/saved_objects/index-pattern/{id}", index_pattern)
+        app.router.add_route("*", "/app/kibana", kibana_app)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.base_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        self.session = aiohttp.ClientSession()
+
+        kibana.SHORT_LINKS.entries.clear()
+        kibana.INDEX_PATTERNS.entries.clear()
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.runner.cleanup()
+
+    async def test_short_link(self):
+        expected = "index=application-*&from=now-1h&to=now&interval=auto&level=ERROR&fields=@timestamp,level,message"
+        for _ in range(2):
+            query = await kibana.parse_async(self.base_url + "/goto/abc", self.session)
+            self.assertEqual(expected, query)
+
+        # short link and index pattern are only resolved once
+        self.assertEqual(["/goto/abc", "/api/saved_objects/index-pattern/0a1b2c"], self.requests)
@@ -0,0 +1,45 @@
+import json
+import os
+import tempfile
+import unittest
+
+import metrics
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.requests = self.registry.counter("requests_total", "Requests.", ["route"])
+        self.streams = self.registry.gauge("streams", "Open streams.")
+        self.duration = self.registry.histogram("duration_seconds", "Duration.", buckets=(0.1, 1))
+
+    def test_render(self):
+        self.requests.inc(route="/logs")
+        self.requests.inc(2, route="/logs")
+        self.duration.observe(0.05)
+        self.duration.observe(5)
+
+        text = self.registry.render()
+        self.assertIn('requests_total{route="/logs"} 3\n', text)
+        self.assertIn('duration_seconds_bucket{le="0.1"} 1\n', text)
+        self.assertIn('duration_seconds_bucket{le="1"} 1\n', text)
+        self.assertIn('duration_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('duration_seconds_sum 5.05\n', text)
+        self.assertIn('duration_seconds_count 2\n', text)
+
+    def test_multiple_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.registry.directory = directory
+            self.requests.inc(route="/logs")
+            self.streams.inc()
+
+            # another worker that is still running, and one that exited
+            others = [(os.getppid(), 1), (2 ** 22 + 1, 5)]
+            for pid, streams in others:
+                with open(os.path.join(directory, f"metrics-{pid}.json"), "w") as f:
+                    json.dump({"pid": pid, "metrics": {"requests_total": [[["/logs"], 2]],
+                                                       "streams": [[[], streams]]}}, f)
+
+            collected = self.registry.collect()
+            self.assertEqual({("/logs",): 5}, collected["requests_total"])
+            self.assertEqual({(): 2}, collected["streams"])
@@ -0,0 +1,57 @@
+import unittest
+
+import profiling
+
+
+def node(type_, description, time_ms, *children):
+    return {"type": type_, "description": description, "time_in_nanos": int(time_ms * 1_000_000),
+            "children": list(children)}
+
+
+PROFILE = {"shards": [
+    {
+        "id": "[node][logs-1][0]",
+        "searches": [{
+            "query": [node("BooleanQuery", "+message:/.*timeout.*/ +@timestamp:[1 TO 2]", 12,
+                           node("RegexpQuery", "message:/.*timeout.*/", 10),
+                           node("IndexOrDocValuesQuery", "@timestamp:[1 TO 2]", 1))],
+            "rewrite_time": 500_000,
+        }],
+        "aggregations": [node("DateHistogramAggregator", "num_results", 5,
+                              node("PercentilesAggregator", "duration", 4))],
+    },
+    {
+        "id": "[node][logs-1][1]",
+        "searches": [{
+            "query": [node("BooleanQuery", "+message:/.*timeout.*/ +@timestamp:[1 TO 2]", 3,
+                           node("RegexpQuery", "message:/.*timeout.*/", 2))],
+            "rewrite_time": 0,
+        }],
+        "aggregations": [],
+    },
+]}
+
+
+class SummarizeTest(unittest.TestCase):
+    def test_summarize(self):
+        params = {"/message": ".*timeout.*", "percentiles_terms": "duration", "from": "now-15m"}
+        summary = profiling.summarize(PROFILE, params)
+
+        self.assertEqual(2, len(summary.shards))
+        self.assertAlmostEqual(17.5, summary.shards[0].total_ms)
+
+        worst = summary.worst(1)[0]
+        self.assertEqual("RegexpQuery", worst.type)
+        self.assertAlmostEqual(12, worst.time_ms)
+        self.assertAlmostEqual(10, worst.max_shard_ms)
+        self.assertEqual("/message", worst.param)
+        self.assertEqual({"/message", "percentiles_terms"}, summary.worst_params(2))
+
+    def test_find_param(self):
+        params = {"-level": "debug", "q": "error"}
+        self.assertEqual("-level", profiling.find_param("query", "-level.keyword:debug", params))
+        self.assertEqual("q", profiling.find_param("query", "message:error", params))
+        self.assertEqual("from", profiling.find_param("query", "@timestamp:[1 TO 2]", params))
+        self.assertEqual("q", profiling.find_param("query", "+loglevel:debug", params))
+        self.assertEqual("-level", profiling.find_param("query", "#(message:error -level:debug)", params))
+        self.assertEqual("interval", profiling.find_param("aggregation", "num_results", params))
@@ -1,6 +1,7 @@
 import unittest
 
 from config import Config
+from mappings import FieldCaps
 from query import Query
 
 
@@ -35,6 +36,177 @@ class QueryTest(unittest.TestCase):
         query = Query(self.config, level='WARN')
         self.assertEqual(query.as_url('/'), '/?dc=default&index=application-%2A&from=now-15m&to=now&interval=auto&level=WARN')
 
+    def test_compare(self):
+        """ Test parsing of time-shifted comparisons. """
+
+        query = Query(self.config, compare='1d, 7d')
+        self.assertEqual(query.compare, ['1d', '7d'])
+        self.assertEqual(query.args, {})
+        self.assertTrue(query.as_url('/').endswith('&compare=1d%2C7d'))
+
+    def test_request_cache(self):
+        """ Test that request_cache is not used as a filter. """
+
+        query = Query(self.config, request_cache='true')
+        self.assertTrue(query.request_cache)
+        self.assertEqual(query.args, {})
+        self.assertTrue(query.as_url('/').endswith('&request_cache=true'))
+        self.assertFalse(Query(self.config).request_cache)
+
+    def test_with_timerange(self):
+        """ Test copying query for another time range. """
+
+        query = Query(self.config, level='WARN')
+        shifted = query.with_timerange('0', '1000')
+        self.assertEqual((shifted.from_timestamp, shifted.to_timestamp), ('0', '1000'))
+        self.assertEqual((query.from_timestamp, query.to_timestamp), ('now-15m', 'now'))
+        self.assertEqual(shifted.args, {'level': 'WARN'})
+
+    def test_aggregation_global(self):
+        """ Test aggregation of global top terms. """
+
+        query = Query(self.config, aggregation_terms='status', aggregation_mode='global')
+        aggregation = query.aggregation('num_results', '1m')
+        self.assertEqual(aggregation['top_terms'], {'terms': {'field': 'status', 'size': 5}})
+        self.assertNotIn('status', aggregation['num_results']['aggs'])
+
+        aggregation = query.aggregation('num_results', '1m', top_terms=[200, 'ok'])
+        filters = aggregation['num_results']['aggs']['status']['filters']
+        self.assertEqual(filters['filters'], {'200': {'term': {'status': 200}}, 'ok': {'term': {'status': 'ok'}}})
+        self.assertIn('other_bucket_key', filters)
+
+        self.assertRaises(ValueError, lambda: Query(self.config, aggregation_mode='unknown'))
+
+    def test_fingerprint(self):
+        """ Test fingerprints are independent of parameter order, defaults and time range. """
+
+        query = Query(self.config, level='WARN', application_name='my-app')
+        self.assertEqual(query.fingerprint,
+                         Query(self.config, application_name='my-app', level='WARN').fingerprint)
+        self.assertEqual(query.fingerprint,
+                         Query(self.config, dc='default', index='application-*', sort='asc',
+                               application_name='my-app', level='WARN').fingerprint)
+        self.assertEqual(query.fingerprint,
+                         query.with_timerange('now-1d', 'now-1h').fingerprint)
+
+        self.assertNotEqual(query.fingerprint, Query(self.config, level='WARN').fingerprint)
+        self.assertNotEqual(query.fingerprint,
+                            Query(self.config, level='WARN', application_name='my-app',
+                                  aggregation_terms='level').fingerprint)
+        self.assertNotEqual(query.cache_key(0, 1000), query.cache_key(0, 2000))
+        self.assertEqual(query.fingerprint,
+                         Query(self.config, level='WARN', application_name='my-app', **{':ignored': 'x'}).fingerprint)
+
+    def test_counting(self):
+        """ Test counting queries aggregate the number of results only, whatever else was aggregated. """
+
+        query = Query(self.config, level='WARN', aggregation_terms='status', percentiles_terms='duration')
+        aggregation = query.counting().aggregation('num_results', '1m')
+        self.assertEqual(['num_results'], list(aggregation))
+        self.assertEqual({}, aggregation['num_results']['aggs'])
+        self.assertEqual(query.to_elasticsearch('now-15m'), query.counting().to_elasticsearch('now-15m'))
+        self.assertEqual(Query(self.config, level='WARN').fingerprint, query.counting().fingerprint)
+        self.assertEqual('status', query.aggregation_terms)
+
+    def test_fingerprint_field_caps(self):
+        """ Test fingerprints and samples do not change once the field caps are known. """
+
+        field_caps = FieldCaps({
+            'level': {'keyword': {'aggregatable': True}},
+            'message': {'text': {'aggregatable': False}},
+            'message.keyword': {'keyword': {'aggregatable': True}},
+        })
+        query = Query(self.config, level='WARN', aggregation_terms='message', sample='0.1')
+        with_field_caps = query.with_field_caps(field_caps)
+        self.assertNotEqual(query.plan, with_field_caps.plan)
+        self.assertEqual(query.fingerprint, with_field_caps.fingerprint)
+        self.assertEqual(query.cache_key(query.timerange), with_field_caps.cache_key(with_field_caps.timerange))
+        self.assertEqual(query.sample_seed, with_field_caps.sample_seed)
+
+    def test_timerange(self):
+        """ Test time ranges are identified independent of how they were given. """
+
+        query = Query(self.config, **{'from': 'now-1h', 'to': 'now'})
+        self.assertEqual(['now-3600', 'now'], query.timerange)
+        self.assertEqual(query.timerange, query.with_timerange('now-60m', 'now').timerange)
+        self.assertNotEqual(query.timerange, query.with_timerange('now-2h', 'now').timerange)
+
+        query = query.with_timerange('1635774591000', '2021-11-02')
+        self.assertEqual(query.timerange, query.with_timerange('1635774591000', str(query.timerange[1])).timerange)
+        self.assertEqual('now/d', query.with_timerange('now/d', 'now').timerange[0])
+
+    def test_sample(self):
+        """ Test sampling filters the results and wraps aggregations in a random sampler. """
+
+        query = Query(self.config, sample='0.01', level='WARN')
+        self.assertEqual(query.args, {'level': 'WARN'})
+        self.assertTrue(query.as_url('/').endswith('&sample=0.01'))
+        self.assertNotEqual(query.fingerprint, Query(self.config, level='WARN').fingerprint)
+
+        filters = query.to_elasticsearch('now-15m')['query']['bool']['filter']
+        self.assertEqual(0.99, filters[-2]['function_score']['min_score'])
+        self.assertIn('range', filters[-1])
+        # aggregations are sampled by the random sampler instead
+        filters = query.to_elasticsearch('now-15m', num_results=0)['query']['bool']['filter']
+        self.assertFalse(any('function_score' in f for f in filters))
+
+        aggs = query.sample_aggregations(query.aggregation('num_results', '1m'))
+        self.assertEqual({'probability': 0.01, 'seed': query.sample_seed}, aggs['sample']['random_sampler'])
+        self.assertIn('num_results', aggs['sample']['aggs'])
+        self.assertEqual({'doc_count': 3, 'num_results': {}},
+                         query.sampled_aggregations({'sample': {'doc_count': 3, 'num_results': {}}}))
+
+        unsampled = Query(self.config)
+        self.assertEqual({'num_results': {}}, unsampled.sample_aggregations({'num_results': {}}))
+        self.assertEqual({'num_results': {}}, unsampled.sampled_aggregations({'num_results': {}}))
+
+        for invalid in ['0', '0.5', '2', 'all', 'nan']:
+            with self.subTest(invalid):
+                self.assertRaises(ValueError, lambda: Query(self.config, sample=invalid))
+
+    def test_plan_is_shared(self):
+        """ Test the compiled filters are reused for every search. """
+
+        query = Query(self.config, level='WARN')
+        first = query.to_elasticsearch('now-15m')
+        second = query.to_elasticsearch('1000')
+        self.assertIs(first['query']['bool']['filter'][0], second['query']['bool']['filter'][0])
+        self.assertEqual(second['query']['bool']['filter'][-1],
+                         {'range': {'@timestamp': {'gte': '1000', 'lt': 'now'}}})
+
+    def test_field_caps(self):
+        """ Test keyword fields are filtered with term queries and aggregated fields are resolved. """
+
+        field_caps = FieldCaps({
+            'level': {'keyword': {'aggregatable': True}},
+            'message': {'text': {'aggregatable': False}},
+            'message.keyword': {'keyword': {'aggregatable': True}},
+            'duration': {'long': {'aggregatable': True}, 'unmapped': {'aggregatable': False}},
+        })
+
+        query = Query(self.config, level='WARN,ERROR', message='hello', aggregation_terms='message')
+        query = query.with_field_caps(field_caps)
+        filters = query.to_elasticsearch('now-15m')['query']['bool']['filter']
+        self.assertEqual(filters[0], {'terms': {'level': ['WARN', 'ERROR']}})
+        self.assertEqual(filters[1], {'match_phrase': {'message': 'hello'}})
+        self.assertEqual(query.aggregation_terms, 'message.keyword')
+
+        query = Query(self.config, percentiles_terms='duration').with_field_caps(field_caps)
+        self.assertEqual(query.percentiles_terms, 'duration')
+
+        query = Query(self.config, aggregation_terms='unknown').with_field_caps(field_caps)
+        self.assertEqual(query.aggregation_terms, 'unknown')
+
+        # percentiles of the .keyword sub-field would fail the search
+        self.assertRaises(ValueError,
+                          lambda: Query(self.config, percentiles_terms='message').with_field_caps(field_caps))
+        self.assertRaises(ValueError,
+                          lambda: Query(self.config, percentiles_terms='level').with_field_caps(field_caps))
+
+        field_caps = FieldCaps({'message': {'text': {'aggregatable': False}}})
+        self.assertRaises(ValueError,
+                          lambda: Query(self.config, aggregation_terms='message').with_field_caps(field_caps))
+
     def assert_defaults(self, query, args=None):
         """ Assert query params. """
         self.assertEqual(query.datacenter, 'default')
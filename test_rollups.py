@@ -0,0 +1,47 @@
+import tempfile
+import unittest
+
+from histogram import Histogram
+from rollups import RollupStore
+
+
+class RollupStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = RollupStore(self.tmpdir.name, max_bytes=10 * 1024 * 1024)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmpdir.cleanup()
+
+    def test_load_missing(self):
+        self.assertIsNone(self.store.load("query", 60, 0, 60_000))
+
+    def test_store_and_extend(self):
+        first = Histogram(interval_s=60, keys=[0, 60_000], counts=[1, 2],
+                          terms={200: [1, 1]}, percentiles={"50.0": [3.0, None]})
+        self.store.store("query", 60, first, 0, 120_000)
+
+        hist, covered_to = self.store.load("query", 60, 0, 600_000)
+        self.assertEqual(120_000, covered_to)
+        self.assertEqual([0, 60_000], hist.keys)
+        self.assertEqual({200: [1, 1]}, hist.terms)
+        self.assertEqual({"50.0": [3.0, None]}, hist.percentiles)
+
+        second = Histogram(interval_s=60, keys=[120_000, 240_000], counts=[3, 4])
+        self.store.store("query", 60, second, 120_000, 300_000)
+
+        hist, covered_to = self.store.load("query", 60, 60_000, 600_000)
+        self.assertEqual(300_000, covered_to)
+        self.assertEqual([60_000, 120_000, 240_000], hist.keys)
+        self.assertEqual([2, 3, 4], hist.counts)
+
+    def test_eviction(self):
+        self.store.max_bytes = 64 * 1024
+        hist = Histogram(interval_s=60, keys=[i * 60_000 for i in range(1000)], counts=[1] * 1000)
+        for series in range(10):
+            self.store.store(f"query-{series}", 60, hist, 0, 1000 * 60_000)
+
+        self.assertLessEqual(self.store.size(), self.store.max_bytes)
+        self.assertIsNotNone(self.store.load("query-9", 60, 0, 60_000))
+        self.assertIsNone(self.store.load("query-0", 60, 0, 60_000))
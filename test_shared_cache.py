@@ -0,0 +1,149 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+from histogram import Histogram
+import mappings
+import shared_cache
+from shared_cache import SharedCache
+
+
+class FakeRedis:
+    """ A stand-in for a Redis server, supporting GET, SET (with PX and NX) and SELECT. """
+
+    def __init__(self):
+        self.data = {}
+        self.connections = 0
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                command = await shared_cache.read_reply(reader)
+                name, args = command[0].upper(), command[1:]
+                if name == b"GET":
+                    value, expires_at = self.data.get(args[0], (None, None))
+                    if value is None or (expires_at and expires_at < time.time()):
+                        writer.write(b"$-1\r\n")
+                    else:
+                        writer.write(b"$%d\r\n%s\r\n" % (len(value), value))
+                elif name == b"SET":
+                    options = [arg.upper() for arg in args[2:]]
+                    expires_at = time.time() + int(args[options.index(b"PX") + 3]) / 1000 if b"PX" in options else None
+                    _, current_expires_at = self.data.get(args[0], (None, 0))
+                    if b"NX" in options and args[0] in self.data and not (current_expires_at and current_expires_at < time.time()):
+                        writer.write(b"$-1\r\n")
+                    else:
+                        self.data[args[0]] = (args[1], expires_at)
+                        writer.write(b"+OK\r\n")
+                elif name == b"SELECT":
+                    writer.write(b"+OK\r\n")
+                else:
+                    writer.write(b"-ERR unknown command\r\n")
+                await writer.drain()
+        except shared_cache.ConnectionClosed:
+            writer.close()
+
+
+class SharedCacheTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        await shared_cache.BACKEND.close()
+        shared_cache.configure(shared_cache.MemoryBackend())
+
+    async def check_backend(self):
+        responses = SharedCache("responses", max_bytes=1024)
+        await responses.set("a", b"response")
+        self.assertEqual(b"response", await responses.get("a"))
+        self.assertIsNone(await responses.get("b"))
+
+        await responses.set("expired", b"response", ttl=0.001)
+        await asyncio.sleep(0.01)
+        self.assertIsNone(await responses.get("expired"))
+
+        histograms = SharedCache("histograms", shared_cache.HISTOGRAM)
+        hist = Histogram(interval_s=60, keys=[0, 60_000], counts=[3, 4], terms={404: [1, 2], "ERROR": [2, 2]},
+                         percentiles={"50.0": [1.5, None]}, total_percentiles={"50.0": 2.0})
+        await histograms.set(["query", 0, 120_000], hist)
+        self.assertEqual(hist, await histograms.get(["query", 0, 120_000]))
+
+        field_caps = SharedCache("field_caps", shared_cache.FIELD_CAPS)
+        await field_caps.set("logs-*", mappings.FieldCaps({"level": {"keyword": {"aggregatable": True}}}))
+        self.assertTrue((await field_caps.get("logs-*")).is_keyword("level"))
+
+        locks = SharedCache("locks", shared_cache.TEXT)
+        self.assertTrue(await locks.add("refresh", "1", ttl=0.05))
+        self.assertFalse(await locks.add("refresh", "2", ttl=0.05))
+        self.assertEqual("1", await locks.get("refresh"))
+        await asyncio.sleep(0.1)
+        self.assertTrue(await locks.add("refresh", "2", ttl=0.05))
+
+    async def test_memory(self):
+        await self.check_backend()
+
+    async def test_sqlite(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        shared_cache.configure(shared_cache.from_url(f"sqlite://{tmpdir.name}/cache.sqlite", 1024 * 1024))
+        await self.check_backend()
+
+        # visible to other processes
+        other = shared_cache.SqliteBackend(os.path.join(tmpdir.name, "cache.sqlite"), 1024 * 1024)
+        self.assertEqual(b"response", await other.get(SharedCache("responses"), "a"))
+        await other.close()
+
+    async def test_sqlite_evicts(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        backend = shared_cache.SqliteBackend(os.path.join(tmpdir.name, "cache.sqlite"), max_bytes=1000)
+        backend.EVICT_EVERY_SETS = 1
+        responses = SharedCache("responses")
+        for idx in range(20):
+            await backend.set(responses, str(idx), b"x" * 100)
+        size = backend.db.execute("SELECT SUM(size) FROM entries").fetchone()[0]
+        self.assertLessEqual(size, 1000)
+        self.assertEqual(b"x" * 100, await backend.get(responses, "19"))
+        await backend.close()
+
+    async def test_redis(self):
+        redis = FakeRedis()
+        port = await redis.start()
+        self.addAsyncCleanup(redis.stop)
+        shared_cache.configure(shared_cache.from_url(f"redis://127.0.0.1:{port}/1", 0))
+        await self.check_backend()
+        self.assertIn(b"es-stream-logs:responses:a", redis.data)
+        # connections are reused
+        self.assertEqual(1, redis.connections)
+
+    async def test_redis_unavailable(self):
+        redis = FakeRedis()
+        port = await redis.start()
+        await redis.stop()
+        shared_cache.configure(shared_cache.from_url(f"redis://127.0.0.1:{port}", 0))
+        responses = SharedCache("responses")
+        await responses.set("a", b"response")
+        self.assertIsNone(await responses.get("a"))
+
+    def test_encode_command(self):
+        self.assertEqual(b"*2\r\n$3\r\nGET\r\n$3\r\nkey\r\n", shared_cache.encode_command(b"GET", "key"))
+
+    def test_from_url(self):
+        self.assertIsInstance(shared_cache.from_url(None, 0), shared_cache.MemoryBackend)
+        redis = shared_cache.from_url("redis://:secret@cache:6380/2", 0)
+        self.assertEqual(("cache", 6380, 2, "secret"), (redis.host, redis.port, redis.db, redis.password))
+        with self.assertRaises(ValueError):
+            shared_cache.from_url("memcached://cache", 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
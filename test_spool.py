@@ -0,0 +1,136 @@
+import os
+import tempfile
+import time
+import unittest
+
+import spool
+from spool import Spool
+
+
+class SpoolTestCase(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.directory = tmpdir.name
+
+    def write(self, results_spool, key, hits, results_total=None, more=False):
+        writer = results_spool.writer(key)
+        for hit in hits:
+            writer.append(hit)
+        writer.finish(len(hits) if results_total is None else results_total, more)
+
+    def test_roundtrip(self):
+        results_spool = Spool(self.directory, 1024 * 1024)
+        hits = [{"_id": str(idx), "_source": {"message": f"hello {idx} ✓"}} for idx in range(10)]
+        self.write(results_spool, "a", hits, results_total=100, more=True)
+
+        spooled = results_spool.open("a")
+        self.addCleanup(spooled.close)
+        self.assertEqual(10, len(spooled))
+        self.assertEqual(100, spooled.results_total)
+        self.assertEqual(hits[7], spooled[7])
+        self.assertEqual(hits, [spooled[idx] for idx in range(len(spooled))])
+        self.assertIsNone(results_spool.open("b"))
+
+    def test_empty(self):
+        results_spool = Spool(self.directory, 1024)
+        self.write(results_spool, "a", [])
+        spooled = results_spool.open("a")
+        self.addCleanup(spooled.close)
+        self.assertEqual(0, len(spooled))
+        self.assertTrue(spooled.covers("all"))
+
+    def test_covers(self):
+        results_spool = Spool(self.directory, 1024 * 1024)
+        self.write(results_spool, "all", [{"_id": "1"}, {"_id": "2"}])
+        self.write(results_spool, "first", [{"_id": "1"}, {"_id": "2"}], results_total=5, more=True)
+
+        complete, first = results_spool.open("all"), results_spool.open("first")
+        self.addCleanup(complete.close)
+        self.addCleanup(first.close)
+        self.assertTrue(complete.covers(10))
+        self.assertTrue(complete.covers("all"))
+        self.assertTrue(first.covers(2))
+        self.assertFalse(first.covers(3))
+        self.assertFalse(first.covers("all"))
+
+    def test_unfinished_not_visible(self):
+        results_spool = Spool(self.directory, 1024)
+        writer = results_spool.writer("a")
+        writer.append({"_id": "1"})
+        self.assertIsNone(results_spool.open("a"))
+        writer.discard()
+        self.assertEqual([], os.listdir(self.directory))
+
+        # too large for the spool
+        writer = results_spool.writer("b")
+        writer.append({"_id": "1", "_source": {"message": "x" * 2000}})
+        writer.finish(1, False)
+        self.assertIsNone(results_spool.open("b"))
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_evicts_least_recently_used(self):
+        results_spool = Spool(self.directory, 1024 * 1024)
+        hits = [{"_id": "1", "_source": {"message": "x" * 300}}]
+        for idx, key in enumerate(["a", "b", "c"]):
+            self.write(results_spool, key, hits)
+            past = time.time() - 100 + idx
+            os.utime(results_spool.path(key), (past, past))
+        results_spool.open("a").close()
+
+        results_spool.max_bytes = 2 * results_spool.size() // 3
+        results_spool.evict()
+        self.assertLessEqual(results_spool.size(), results_spool.max_bytes)
+        self.assertIsNone(results_spool.open("b"))
+        self.assertIsNotNone(results_spool.open("a"))
+
+    def test_invalid(self):
+        results_spool = Spool(self.directory, 1024)
+        for key, content in (("a", b"garbage"), ("b", b""), ("c", spool.HEADER.pack(spool.MAGIC, 1, 0, 1000))):
+            with open(results_spool.path(key), "wb") as f:
+                f.write(content)
+            self.assertIsNone(results_spool.open(key))
+
+    def test_flush(self):
+        results_spool = Spool(self.directory, 10 * 1024 * 1024)
+        hits = [{"_id": str(idx), "_source": {"message": "x" * 1000}} for idx in range(1000)]
+        writer = results_spool.writer("a")
+        flushes = 0
+        for hit in hits:
+            writer.append(hit)
+            if writer.should_flush():
+                writer.flush()
+                flushes += 1
+        self.assertGreater(flushes, 1)
+        self.assertIsNone(results_spool.open("a"))
+        writer.finish(len(hits), False)
+
+        spooled = results_spool.open("a")
+        self.addCleanup(spooled.close)
+        self.assertEqual(hits, [spooled[idx] for idx in range(len(spooled))])
+        self.assertEqual(["a.spool"], os.listdir(self.directory))
+
+    def test_replaces_at_once(self):
+        results_spool = Spool(self.directory, 1024 * 1024)
+        self.write(results_spool, "a", [{"_id": "old"}])
+        spooled = results_spool.open("a")
+        self.addCleanup(spooled.close)
+        self.write(results_spool, "a", [{"_id": "new"}, {"_id": "newer"}])
+
+        # readers of the old file keep it, the next ones see the new one
+        self.assertEqual([{"_id": "old"}], [spooled[idx] for idx in range(len(spooled))])
+        replaced = results_spool.open("a")
+        self.addCleanup(replaced.close)
+        self.assertEqual(["new", "newer"], [replaced[idx]["_id"] for idx in range(len(replaced))])
+
+    def test_removes_outdated(self):
+        results_spool = Spool(self.directory, 1024 * 1024)
+        for suffix in spool.OUTDATED:
+            with open(results_spool.path("a", suffix), "wb") as f:
+                f.write(b"{}\n")
+        self.write(results_spool, "b", [{"_id": "1"}])
+        self.assertEqual(["b.spool"], os.listdir(self.directory))
+
+
+if __name__ == '__main__':
+    unittest.main()
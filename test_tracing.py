@@ -0,0 +1,48 @@
+import unittest
+
+import tracing
+
+
+class RecordingHook(tracing.Hook):
+    def __init__(self):
+        self.stages = []
+        self.ended = []
+
+    def on_stage(self, trace, name, start, duration):
+        self.stages.append(name)
+
+    def on_end(self, trace):
+        self.ended.append(trace.name)
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.hook = RecordingHook()
+        tracing.add_hook(self.hook)
+
+    def tearDown(self):
+        tracing.HOOKS.remove(self.hook)
+
+    def test_stages(self):
+        trace = tracing.Trace("logs")
+        for _ in range(2):
+            with trace.stage("render"):
+                pass
+        trace.add("es", 0.0123)
+        trace.end()
+        trace.end()
+
+        self.assertEqual(["render", "render", "es"], self.hook.stages)
+        self.assertEqual(["logs"], self.hook.ended)
+        self.assertTrue(trace.server_timing().endswith(", es;dur=12.3"))
+        self.assertIn("Server-Timing", trace.headers())
+
+    def test_not_sampled(self):
+        trace = tracing.Trace("logs", sampled=False)
+        with trace.stage("render"):
+            pass
+        trace.end()
+
+        self.assertEqual([], self.hook.stages)
+        self.assertEqual([], self.hook.ended)
+        self.assertEqual({}, trace.headers())
@@ -17,11 +17,71 @@ class Scale:
         self.num_steps = num_steps
         self.factor = (range_max - range_min) / (domain_max - domain_min)
         self.domain_min = domain_min
+        self.range_min = range_min
 
     def map(self, value_in_domain):
         """ Maps value_in_domain to the corresponding value in the
         output range. """
-        return (value_in_domain - self.domain_min) * self.factor
+        return self.range_min + (value_in_domain - self.domain_min) * self.factor
+
+    def map_all(self, values_in_domain):
+        """ Maps all values_in_domain to the output range at once. """
+        domain_min, range_min, factor = self.domain_min, self.range_min, self.factor
+        return [range_min + (value - domain_min) * factor for value in values_in_domain]
+
+
+def stack(series):
+    """ Stacks series on top of each other, returning the (bottom, top)
+    offsets for each series.
+
+    All series must have the same length, e.g. `stack([[1, 2], [3, 4]])`
+    returns `[([0, 0], [1, 2]), ([1, 2], [4, 6])]`. """
+
+    stacked = []
+    bottom = None
+    for values in series:
+        if bottom is None:
+            bottom = [0] * len(values)
+        top = [b + v for b, v in zip(bottom, values)]
+        stacked.append((bottom, top))
+        bottom = top
+    return stacked
+
+
+def fmt_num(value):
+    """ Formats value compactly for use in svg paths. """
+    return f"{round(value, 2):g}"
+
+
+def bars_path(xs, bottoms, tops, width=1, min_height=0):
+    """ Renders bars as a single svg path.
+
+    Each bar starts at xs[i] and spans from bottoms[i] to tops[i], bars
+    with no height are skipped.  All coordinates are in the (svg) output
+    range, i.e. top is less than bottom for upright bars. """
+
+    width = fmt_num(width)
+    return "".join([f"M{fmt_num(x)} {fmt_num(bottom)}V{fmt_num(min(top, bottom - min_height))}h{width}V{fmt_num(bottom)}Z"
+                    for x, bottom, top in zip(xs, bottoms, tops) if top < bottom])
+
+
+def steps_path(xs, ys, width=1):
+    """ Renders horizontal lines of given width starting at xs[i] at
+    height ys[i] as a single svg path.  Skips points where y is None. """
+
+    width = fmt_num(width)
+    return "".join([f"M{fmt_num(x)} {fmt_num(y)}h{width}"
+                    for x, y in zip(xs, ys) if y is not None])
+
+
+def line_path(xs, ys):
+    """ Renders a line through all points as a single svg path.  Skips
+    points where y is None. """
+
+    points = [f"{fmt_num(x)} {fmt_num(y)}" for x, y in zip(xs, ys) if y is not None]
+    if not points:
+        return ""
+    return "M" + "L".join(points)
 
 
 E10 = math.sqrt(50)
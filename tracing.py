@@ -0,0 +1,106 @@
+""" Timing of the stages of requests, e.g. building the query, waiting
+for elasticsearch and rendering.
+
+Timings are sent as Server-Timing headers and passed to hooks, which can
+export them to a tracing system.  Only a sample of the requests is
+traced, the others only pay for a few no-op calls. """
+
+import random
+import time
+
+# fraction of the requests that are traced
+SAMPLE_RATE = 1.0
+
+HOOKS = []
+
+
+class Hook:
+    """ Interface for tracers, register them with add_hook. """
+
+    def on_stage(self, trace, name, start, duration):
+        """ Called when a stage of trace ended, start is from time.perf_counter(). """
+
+    def on_end(self, trace):
+        """ Called once when trace ended. """
+
+
+def add_hook(hook: Hook):
+    HOOKS.append(hook)
+
+
+class _Stage:
+    __slots__ = ("trace", "name", "start")
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.add(self.name, time.perf_counter() - self.start, self.start)
+
+
+class _NoStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_STAGE = _NoStage()
+
+
+class Trace:
+    """ The time spent in each stage of a request, stages can be entered
+    multiple times, e.g. once per rendered row. """
+
+    def __init__(self, name, sampled=True):
+        self.name = name
+        self.sampled = sampled
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.ended = False
+
+    def stage(self, name):
+        """ Returns a context manager that adds the time spent in it to stage name. """
+        if not self.sampled:
+            return NO_STAGE
+        return _Stage(self, name)
+
+    def add(self, name, duration, start=None):
+        """ Adds duration (in seconds) to stage name, e.g. for times measured elsewhere. """
+        if not self.sampled:
+            return
+        self.stages[name] = self.stages.get(name, 0) + duration
+        for hook in HOOKS:
+            hook.on_stage(self, name, start, duration)
+
+    def end(self):
+        if not self.sampled or self.ended:
+            return
+        self.ended = True
+        for hook in HOOKS:
+            hook.on_end(self)
+
+    def server_timing(self):
+        """ Returns the stages in the format of the Server-Timing header. """
+        return ", ".join(f"{name};dur={duration * 1000:.1f}" for name, duration in self.stages.items())
+
+    def headers(self):
+        """ Returns the Server-Timing header, if this trace is sampled. """
+        if not self.sampled or not self.stages:
+            return {}
+        return {"Server-Timing": self.server_timing()}
+
+
+def start(name):
+    """ Starts a trace for request name, which is only recorded if it is sampled. """
+    return Trace(name, sampled=SAMPLE_RATE >= 1 or random.random() < SAMPLE_RATE)
+
+
+def disabled():
+    return Trace("disabled", sampled=False)